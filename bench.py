@@ -0,0 +1,234 @@
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import numpy as np
+
+# Benchmarks of the operators, gradients, MAP estimates and samplers over a matrix of geometries (image sizes x numbers of
+# angles). Every geometry is run in a fresh process, so that its peak memory (maximum resident set size) is measured
+# alone and the OpenMP threads of one case do not affect the next. The results are written to a JSON file with the
+# versions and the machine, and they can be compared to an earlier file (a baseline) to quantify regressions.
+#
+#   python bench.py --output new.json --baseline old.json
+#   python bench.py --compare new.json old.json
+#
+# Metrics ending with _s are seconds per call and _mb megabytes (lower is better), the ones ending with _per_s are rates
+# and _speedup ratios to one thread (higher is better).
+# A call is timed as the best average over repeat rounds.
+
+SIZES = (64, 128, 256, 512)
+ANGLES = (8, 30, 90, 180)
+PARTS = ('radon', 'spmv', 'grad', 'map', 'mwg', 'mwgscaling', 'hmc')
+PRIORS = ('tikhonov', 'tv', 'cauchy', 'wavelet')
+
+def besttime(f, repeat=5, number=None):
+    if number is None:
+        start = time.perf_counter()
+        f()
+        first = time.perf_counter() - start
+        number = max(1, int(0.05/max(first, 1e-9)))
+    best = np.inf
+    for r in range(repeat):
+        start = time.perf_counter()
+        for k in range(number):
+            f()
+        best = min(best, (time.perf_counter() - start)/number)
+    return best
+
+# Seconds per MwG sweep of the TV prior with the given number of threads. The first run colors the pixels (kept in t.Q)
+# and warms up, and the setup of a run is cancelled by timing runs of sweeps and 2*sweeps sweeps.
+def mwgsweeptime(t, sweeps, threads):
+    t.num_threads = threads
+    run = lambda n: t.mwg_tv(10.0, M=n, Madapt=n//2, thinning=1, seed=1)
+    run(2)
+    short = besttime(lambda: run(sweeps), repeat=3, number=1)
+    long = besttime(lambda: run(2*sweeps), repeat=3, number=1)
+    return max(long - short, 1e-12)/sweeps
+
+# Peak resident set size of this process in megabytes (ru_maxrss is in kilobytes on Linux and in bytes on macOS).
+def peakmemory():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if (sys.platform == 'darwin'):
+        return rss/2.0**20
+    return rss/2.0**10
+
+# Runs the parts of one geometry and returns its metrics.
+def runcase(size, angles, parts, threads, iters, verbose):
+    from main import tomography
+    from matrices import radonmatrix
+    metrics = {}
+    theta = np.linspace(0.0, np.pi, angles, endpoint=False)
+    out = sys.stdout if verbose else open(os.devnull, 'w')
+    with contextlib.redirect_stdout(out):
+        if 'radon' in parts:
+            start = time.perf_counter()
+            A = radonmatrix(size, theta, Nthreads=threads)
+            metrics['radonmatrix_s'] = time.perf_counter() - start
+            metrics['nnz'] = int(A.nnz)
+            del A
+        np.random.seed(1)
+        image = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'shepp.png')
+        t = tomography(image, size, angles, 0.02, num_threads=threads)
+        M = t.radonoperator
+        x = np.random.rand(M.shape[1])
+        y = np.random.rand(M.shape[0])
+        if 'spmv' in parts:
+            metrics['spmv_s'] = besttime(lambda: M.dot(x))
+            metrics['spmvt_s'] = besttime(lambda: M.T.dot(y))
+        # The MAP estimates set up the prior of t.Q, which the gradients of the same prior then use.
+        gradients = {'tikhonov': [('tikhonov', t.grad_tikhonov)], 'tv': [('tv', t.grad_tv)],
+                     'cauchy': [('isocauchy', t.grad_isocauchy)], 'wavelet': [('wavelet', lambda z: t.valgrad_wavelet(z)[1])]}
+        maps = {'tikhonov': lambda k: t.map_tikhonov(1.0, maxiter=k, retim=False),
+                'tv': lambda k: t.map_tv(10.0, maxiter=k, retim=False),
+                'cauchy': lambda k: t.map_cauchy(0.05, maxiter=k, retim=False),
+                'wavelet': lambda k: t.map_wavelet(1.0, maxiter=k, retim=False)}
+        x = 1 + 0.05*np.random.randn(M.shape[1])
+        for prior in PRIORS:
+            if ('map' in parts or 'grad' in parts):
+                res = maps[prior](iters['map'] if 'map' in parts else 1)
+                if ('map' in parts and res.spent > 0):
+                    metrics['map_' + prior + '_its_per_s'] = res.totaliternum/res.spent
+            if 'grad' in parts:
+                for (name, f) in gradients[prior]:
+                    metrics['grad_' + name + '_s'] = besttime(lambda: f(x))
+        if 'grad' in parts:
+            t.map_cauchy(0.05, maxiter=1, isotropic=False)
+            metrics['grad_cauchy_s'] = besttime(lambda: t.grad_cauchy(x))
+        if 'mwg' in parts:
+            metrics['mwg_tv_sweeps_per_s'] = 1.0/mwgsweeptime(t, iters['mwg'], threads)
+        if 'mwgscaling' in parts:
+            counts = sorted(set([2**k for k in range(threads.bit_length()) if 2**k <= threads] + [threads]))
+            single = None
+            for n in counts:
+                sweep = mwgsweeptime(t, iters['mwgscaling'], n)
+                if single is None:
+                    single = sweep
+                metrics['mwg_tv_' + str(n) + 't_sweeps_per_s'] = 1.0/sweep
+                metrics['mwg_tv_' + str(n) + 't_speedup'] = single/sweep
+            t.num_threads = threads
+        if 'hmc' in parts:
+            start = time.perf_counter()
+            t.hmcmc_tv(10.0, M=iters['hmc'], Madapt=iters['hmc']//2)
+            metrics['hmc_tv_its_per_s'] = iters['hmc']/(time.perf_counter() - start)
+    if not verbose:
+        out.close()
+    metrics['peak_rss_mb'] = peakmemory()
+    return metrics
+
+def metadata(threads):
+    import scipy
+    import Cython
+    meta = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(), 'numpy': np.__version__,
+            'scipy': scipy.__version__, 'cython': Cython.__version__, 'platform': platform.platform(),
+            'machine': platform.machine(), 'processor': platform.processor(), 'cpus': os.cpu_count(), 'threads': threads,
+            'node': platform.node(), 'argv': sys.argv[1:]}
+    try:
+        meta['commit'] = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                        cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        meta['commit'] = None
+    return meta
+
+def runbenchmarks(sizes=SIZES, angles=ANGLES, parts=PARTS, threads=None, iters=None, verbose=False):
+    if threads is None:
+        threads = os.cpu_count()
+    its = {'map': 20, 'mwg': 20, 'mwgscaling': 20, 'hmc': 10}
+    if iters is not None:
+        its.update(iters)
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for size in sizes:
+        for n in angles:
+            print('Benchmarking ' + str(size) + 'x' + str(size) + ' with ' + str(n) + ' angles.', flush=True)
+            with context.Pool(1) as pool:
+                metrics = pool.apply(runcase, (size, n, tuple(parts), threads, its, verbose))
+            results.append({'size': size, 'angles': n, 'metrics': metrics})
+    return {'metadata': metadata(threads), 'iterations': its, 'results': results}
+
+def lowerbetter(name):
+    return name.endswith('_mb') or (name.endswith('_s') and not name.endswith('_per_s'))
+
+# Compares the results to a baseline. Returns the rows (size, angles, metric, baseline, new, change) where change is the
+# relative improvement (positive) or regression (negative), and the number of regressions worse than tolerance.
+def compare(new, baseline, tolerance=0.1):
+    old = {(r['size'], r['angles']): r['metrics'] for r in baseline['results']}
+    rows = []
+    regressions = 0
+    for r in new['results']:
+        key = (r['size'], r['angles'])
+        if key not in old:
+            continue
+        for (name, value) in sorted(r['metrics'].items()):
+            if (name == 'nnz' or name not in old[key] or not old[key][name]):
+                continue
+            base = old[key][name]
+            if lowerbetter(name):
+                change = base/value - 1.0 if value > 0 else np.inf
+            else:
+                change = value/base - 1.0
+            if (change < -tolerance):
+                regressions = regressions + 1
+            rows.append((key[0], key[1], name, base, value, change))
+    return rows, regressions
+
+def printcomparison(rows, tolerance):
+    print('%5s %6s %-28s %12s %12s %9s' % ('size', 'angles', 'metric', 'baseline', 'new', 'change'))
+    for (size, angles, name, base, value, change) in rows:
+        mark = ''
+        if (change < -tolerance):
+            mark = ' regression'
+        elif (change > tolerance):
+            mark = ' improvement'
+        print('%5d %6d %-28s %12.5g %12.5g %+8.1f%%%s' % (size, angles, name, base, value, 100.0*change, mark))
+
+def printresults(results):
+    for r in results['results']:
+        print(str(r['size']) + 'x' + str(r['size']) + ', ' + str(r['angles']) + ' angles:')
+        for (name, value) in sorted(r['metrics'].items()):
+            print('    %-28s %12.5g' % (name, value))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks of the tomography library.')
+    parser.add_argument('--sizes', default=list(SIZES), nargs='+', type=int, help='Image sizes. Default=64 128 256 512')
+    parser.add_argument('--angles', default=list(ANGLES), nargs='+', type=int, help='Numbers of angles. Default=8 30 90 180')
+    parser.add_argument('--parts', default=list(PARTS), nargs='+', choices=PARTS, help='What to benchmark. Default=all')
+    parser.add_argument('--threads', default=None, type=int, help='Number of OpenMP threads. Default=number of CPUs')
+    parser.add_argument('--map-iters', default=20, type=int, help='MAP iterations per prior. Default=20')
+    parser.add_argument('--mwg-sweeps', default=20, type=int, help='Timed MwG sweeps (after a warm-up). Default=20')
+    parser.add_argument('--scaling-sweeps', default=20, type=int, help='MwG sweeps per thread count in mwgscaling. Default=20')
+    parser.add_argument('--hmc-iters', default=10, type=int, help='HMC iterations. Default=10')
+    parser.add_argument('--output', default=None, type=str, help='JSON file of the results.')
+    parser.add_argument('--baseline', default=None, type=str, help='JSON file of earlier results to compare to.')
+    parser.add_argument('--compare', default=None, nargs=2, type=str, metavar=('NEW', 'BASELINE'),
+                        help='Only compare two result files.')
+    parser.add_argument('--tolerance', default=0.1, type=float, help='Relative change counted as a regression. Default=0.1')
+    parser.add_argument('--verbose', default=False, action='store_true', help='Show the output of the methods.')
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare[0], 'r') as f:
+            results = json.load(f)
+        with open(args.compare[1], 'r') as f:
+            baseline = json.load(f)
+    else:
+        results = runbenchmarks(args.sizes, args.angles, args.parts, args.threads,
+                                {'map': args.map_iters, 'mwg': args.mwg_sweeps, 'mwgscaling': args.scaling_sweeps, 'hmc': args.hmc_iters}, args.verbose)
+        printresults(results)
+        if args.output is not None:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=1)
+        if args.baseline is not None:
+            with open(args.baseline, 'r') as f:
+                baseline = json.load(f)
+    if baseline is not None:
+        rows, regressions = compare(results, baseline, args.tolerance)
+        printcomparison(rows, args.tolerance)
+        print(str(regressions) + ' regressions.')
+        sys.exit(1 if regressions > 0 else 0)
@@ -0,0 +1,94 @@
+import numpy as np
+
+# L-BFGS for K independent minimization problems of the same size, whose objectives are evaluated together. Valgrad(X, cols)
+# gets the points of the problems cols (the columns of X, D x len(cols)) and returns their objectives (len(cols),) and
+# gradients (D x len(cols)), so that a block kernel (cyt.blockvalgrad) can apply its operators to all of them at once.
+# Every problem has its own curvature history, backtracking line search (Armijo) and stopping test, and it is dropped from
+# the block when it stops, so its solution does not depend on the other problems that are solved with it. A problem stops
+# when the largest absolute gradient is below gtol, when the relative decrease of its objective is below ftol (the
+# defaults of scipy's L-BFGS-B), when its line search fails or after maxiter iterations. Pairs with a nonpositive
+# curvature are not stored (nonconvex objectives). Callback is called after every iteration of the block.
+# Returns the solutions (D x K) and the number of iterations of each problem.
+def lbfgs(valgrad, X0, maxiter=400, m=10, gtol=1e-5, ftol=2.220446049250313e-09, maxls=20, c1=1e-4, callback=None):
+    X = np.array(X0, dtype=np.float64, order='F')
+    (D, K) = X.shape
+    (f, G) = valgrad(X, np.arange(K))
+    f = np.array(f, dtype=np.float64)
+    G = np.array(G, dtype=np.float64, order='F')
+    S = [[] for k in range(K)]
+    Y = [[] for k in range(K)]
+    iters = np.zeros(K, dtype=int)
+    active = [k for k in range(K) if maxiter > 0 and np.max(np.abs(G[:, k])) > gtol]
+    while len(active) > 0:
+        P = np.zeros((D, len(active)))
+        step = np.ones(len(active))
+        for (i, k) in enumerate(active):
+            P[:, i] = direction(G[:, k], S[k], Y[k])
+            if (len(S[k]) == 0):
+                step[i] = min(1.0, 1.0/np.linalg.norm(G[:, k]))
+        slope = np.sum(P*G[:, active], axis=0)
+        for (i, k) in enumerate(active):
+            if (slope[i] >= 0):
+                # Not a descent direction (only after rounding): restart from the gradient.
+                S[k] = []
+                Y[k] = []
+                P[:, i] = -G[:, k]
+                slope[i] = -np.dot(G[:, k], G[:, k])
+                step[i] = min(1.0, 1.0/np.sqrt(-slope[i]))
+        searching = list(range(len(active)))
+        fnew = np.zeros(len(active))
+        Gnew = np.zeros((D, len(active)), order='F')
+        failed = np.zeros(len(active), dtype=bool)
+        for ls in range(maxls):
+            cols = [active[i] for i in searching]
+            Xt = X[:, cols] + step[searching]*P[:, searching]
+            (ft, Gt) = valgrad(Xt, np.array(cols))
+            still = []
+            for (j, i) in enumerate(searching):
+                fnew[i] = ft[j]
+                Gnew[:, i] = Gt[:, j]
+                if not (ft[j] <= f[active[i]] + c1*step[i]*slope[i]):
+                    still.append(i)
+                    step[i] = 0.5*step[i]
+            searching = still
+            if (len(searching) == 0):
+                break
+        failed[searching] = True
+        stopped = []
+        for (i, k) in enumerate(active):
+            if failed[i]:
+                stopped.append(k)
+                continue
+            s = step[i]*P[:, i]
+            y = Gnew[:, i] - G[:, k]
+            if (np.dot(s, y) > 1e-10*np.dot(y, y)):
+                S[k].append(s)
+                Y[k].append(y)
+                if (len(S[k]) > m):
+                    del S[k][0]
+                    del Y[k][0]
+            X[:, k] = X[:, k] + s
+            fold = f[k]
+            f[k] = fnew[i]
+            G[:, k] = Gnew[:, i]
+            iters[k] += 1
+            if (iters[k] >= maxiter or np.max(np.abs(G[:, k])) <= gtol or fold - f[k] <= ftol*max(abs(fold), abs(f[k]), 1.0)):
+                stopped.append(k)
+        active = [k for k in active if k not in stopped]
+        if callback is not None:
+            callback(X)
+    return (X, iters)
+
+# Search direction -H g of L-BFGS by the two-loop recursion, with the initial Hessian s'y/y'y of the latest pair.
+def direction(g, S, Y):
+    q = np.array(g)
+    a = np.zeros(len(S))
+    for j in range(len(S) - 1, -1, -1):
+        a[j] = np.dot(S[j], q)/np.dot(Y[j], S[j])
+        q = q - a[j]*Y[j]
+    if (len(S) > 0):
+        q = q*np.dot(S[-1], Y[-1])/np.dot(Y[-1], Y[-1])
+    for j in range(len(S)):
+        b = np.dot(Y[j], q)/np.dot(Y[j], S[j])
+        q = q + (a[j] - b)*S[j]
+    return -q
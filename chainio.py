@@ -0,0 +1,157 @@
+import os
+import queue
+import threading
+import numpy as np
+
+# Streaming storage of MCMC chains.
+# Chainwriter appends samples to a resizable, chunked HDF5 dataset 'chain' (dim x samples), so that saving a chain during a run
+# never rewrites the samples which are already on disk. The writing is done by a background thread. The queue of pending
+# blocks is bounded, so a sampler that produces samples faster than they can be written waits instead of filling the memory.
+# Chainsink is the buffer the samplers write their thinned samples into. It keeps the whole chain in memory (as the samplers
+# always did) or, if streaming, only a block of samples which is handed to the writer when it's full.
+
+# Keyword arguments of h5py's create_dataset for the given compression. 'lzf' (default) and 'gzip' are built in h5py,
+# 'blosc' and 'lz4' need the hdf5plugin package.
+def compressionargs(compression):
+    if compression is None or compression == 'none':
+        return {}
+    if compression in ('lzf', 'gzip'):
+        return {'compression': compression}
+    if compression in ('blosc', 'lz4'):
+        try:
+            import hdf5plugin
+        except ImportError:
+            raise Exception('Package hdf5plugin is needed for ' + compression + ' compression.')
+        if compression == 'blosc':
+            return dict(hdf5plugin.Blosc(cname='lz4', clevel=5, shuffle=hdf5plugin.Blosc.SHUFFLE))
+        return dict(hdf5plugin.LZ4())
+    raise Exception('Unknown compression ' + str(compression) + '.')
+
+# Reserves a new file base + ext by creating it empty, or base-1 + ext, base-2 + ext, ... if it exists, so that processes
+# which get the same name (e.g. the timestamped intermediate files of parallel chains) don't write into the same file.
+def uniquename(base, ext):
+    path = os.path.dirname(os.path.abspath(base))
+    os.makedirs(path, exist_ok=True)
+    k = 0
+    while True:
+        filename = base + ('' if k == 0 else '-' + str(k)) + ext
+        try:
+            os.close(os.open(filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return filename
+        except FileExistsError:
+            k += 1
+
+class chainwriter:
+    def __init__(self, filename, dim, compression='lzf', dtype=np.float32, chunksamples=None, maxpending=4):
+        import h5py
+        path = os.path.dirname(os.path.abspath(filename))
+        os.makedirs(path, exist_ok=True)
+        if chunksamples is None:
+            # Chunks of about 1 MB.
+            chunksamples = int(max(1, min(1024, 2**20 // (np.dtype(dtype).itemsize*dim))))
+        self.filename = filename
+        self.dim = dim
+        self.dtype = dtype
+        self.count = 0
+        self.error = None
+        self.file = h5py.File(filename, 'w')
+        self.dataset = self.file.create_dataset('chain', shape=(dim, 0), maxshape=(dim, None), dtype=dtype,
+                                                chunks=(dim, chunksamples), **compressionargs(compression))
+        self.pending = queue.Queue(maxsize=maxpending)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            block = self.pending.get()
+            if block is None:
+                break
+            if self.error is not None:
+                continue
+            try:
+                n = self.dataset.shape[1]
+                self.dataset.resize((self.dim, n + block.shape[1]))
+                self.dataset[:, n:n + block.shape[1]] = block
+                self.file.flush()
+            except Exception as e:
+                self.error = e
+
+    # Appends the columns of samples (dim x k) to the chain. The block is copied, so the caller may reuse its buffer at once.
+    def append(self, samples):
+        if self.error is not None:
+            raise self.error
+        samples = np.reshape(samples, (self.dim, -1))
+        if samples.shape[1] == 0:
+            return
+        self.pending.put(np.array(samples, dtype=self.dtype))
+        self.count = self.count + samples.shape[1]
+
+    # Waits until all the samples are written and closes the file.
+    def close(self):
+        if self.thread is not None:
+            self.pending.put(None)
+            self.thread.join()
+            self.thread = None
+            self.file.close()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class chainsink:
+    # Nsamples is the number of samples (columns) of the whole chain. If filename is None, the chain is kept in memory only.
+    # If streaming is True, only blocksize samples are in memory and the chain is in the file only.
+    def __init__(self, dim, nsamples, filename=None, streaming=False, blocksize=64, compression='lzf'):
+        if streaming and filename is None:
+            raise Exception('Streaming a chain needs a file.')
+        self.streaming = streaming
+        self.filename = filename
+        self.writer = None
+        self.start = 0
+        self.written = 0
+        self.stored = 0
+        if filename is not None:
+            self.writer = chainwriter(filename, dim, compression=compression)
+        if streaming:
+            self.buffer = np.zeros((dim, min(blocksize, nsamples)))
+        else:
+            self.buffer = np.zeros((dim, nsamples))
+
+    # Column of buffer into which sample k is written.
+    def slot(self, k):
+        return k - self.start
+
+    # Marks sample k as written. A full block is sent to the file.
+    def commit(self, k):
+        self.stored = k + 1
+        if self.streaming and (self.stored - self.start == self.buffer.shape[1]):
+            self.flush()
+
+    def store(self, k, x):
+        self.buffer[:, self.slot(k)] = np.ravel(x)
+        self.commit(k)
+
+    # Sends the samples which are not yet in the file to the writer.
+    def flush(self):
+        if self.writer is None:
+            return
+        self.writer.append(self.buffer[:, self.written - self.start:self.stored - self.start])
+        self.written = self.stored
+        if self.streaming:
+            self.start = self.stored
+
+    # Writes the rest of the samples and closes the file. Returns the chain if it was kept in memory, otherwise None.
+    # If truncate is True, the columns after the last stored sample are left out (the chain was stopped early).
+    def close(self, truncate=False):
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
+        if self.streaming:
+            return None
+        if truncate:
+            return self.buffer[:, 0:self.stored]
+        return self.buffer
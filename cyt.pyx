@@ -2,21 +2,29 @@ import numpy as np
 cimport numpy as np
 cimport cython
 import scipy.sparse as sp
-from cython.parallel import prange
+from cython.parallel import prange, parallel
 from scipy.sparse import csr_matrix,csc_matrix,coo_matrix
 import math
-from libc.math cimport sqrt,fabs,exp, cos, tan,sin,M_SQRT2,M_PI,abs
+from libc.math cimport sqrt,fabs,exp, cos, tan,sin,M_SQRT2,M_PI,abs,log
 from libcpp.list cimport list as cpplist
+from libcpp.vector cimport vector
 import time
 from tqdm import tqdm
 import sys
+from matrices cimport linearoperator
+from matrices import differenceoperator, waveletoperator
+from spmv cimport sparseoperator
+from cython.parallel import threadid as thid
+cimport openmp
  
 # Class for passing extra arguments for functions.
 # M, Lx and Ly refer to matrices, y to a measurement vector, s2 to sigma squared. Variables a andb are used
 # as regularization parameters.  Logdensity is points to a given log-PDF function  and gradi to its gradient.
+# Work holds the preallocated buffers of the fused value and gradient kernels (see valgrad) and Nthreads the number of
+# their OpenMP threads (None: the threads of M, or the OpenMP default if M has none).
 class argumentspack():
-    __slots__ = ['M', 'Lx', 'Ly', 'y', 's2', 'a' ,'b', 'logdensity', 'gradi','boun','boundarya']
-    def __init__(self,logdensity= lambda x,Q: 1,gradi = lambda x,Q: 0,M=None, Lx=None, Ly=None, y=0, s2=1.0, a=1.0, b=0.01,boundarya = 1,boun=None):
+    __slots__ = ['M', 'Lx', 'Ly', 'y', 's2', 'a' ,'b', 'logdensity', 'gradi','boun','boundarya','work','Nthreads']
+    def __init__(self,logdensity= lambda x,Q: 1,gradi = lambda x,Q: 0,M=None, Lx=None, Ly=None, y=0, s2=1.0, a=1.0, b=0.01,boundarya = 1,boun=None,Nthreads=None):
         self.M = M
         self.Lx = Lx
         self.Ly = Ly
@@ -28,20 +36,314 @@ class argumentspack():
         self.b = b
         self.logdensity = logdensity
         self.gradi = gradi
-
-def savechain(chain,intername):
-    import h5py
-    import os
-    filename = intername() + ".hdf5"
-    print(filename)
-    path = os.path.dirname(os.path.abspath(filename))
-    if not os.path.exists(path):
-        os.makedirs(path)
-    with h5py.File(filename, 'w') as f:
-        compression = 'gzip'
-        chain = chain.astype(np.float32)
-        f.create_dataset('chain', data=chain, compression=compression)
-    f.close()
+        self.work = {}
+        self.Nthreads = Nthreads
+
+# Online posterior statistics of a sampler, kept in O(dim) memory so that also the runs without a stored chain give
+# uncertainty maps. For every pixel:
+# - mean and variance with Welford's algorithm,
+# - quantiles with the P^2 algorithm of Jain and Chlamtac (five markers per quantile, no samples are stored),
+# - effective sample size by batch means. At most maxbatches batch means are kept; when they are all full, neighbouring
+#   batches are merged and the batch size is doubled, so the batch size grows with the chain as it should.
+# A sample is added with begin() followed by add(j, value) for every pixel, which may be called in parallel for different pixels
+# (the MwG samplers do it inside their sweeps), or with update(x) for a whole vector.
+cdef class posteriorstats:
+    cdef public int dim
+    cdef public long n
+    cdef public long batchsize
+    cdef public int nbatches
+    cdef public int maxbatches
+    cdef long inbatch
+    cdef public object levels
+    cdef double[::1] mean
+    cdef double[::1] m2
+    cdef double[:, ::1] batchsum
+    cdef double[:, :, ::1] q
+    cdef double[:, :, ::1] npos
+    cdef double[::1] p
+    cdef double[:, ::1] dn
+    cdef double[:, ::1] ninit
+
+    def __init__(self, dim, quantiles=(0.025, 0.975), maxbatches=32):
+        cdef int k
+        if (maxbatches < 4 or maxbatches % 2 != 0):
+            raise Exception('Number of batches must be even and at least 4.')
+        self.dim = dim
+        self.n = 0
+        self.batchsize = 1
+        self.nbatches = 0
+        self.inbatch = 0
+        self.maxbatches = maxbatches
+        self.levels = np.array(quantiles, dtype=np.float64)
+        nq = self.levels.shape[0]
+        self.mean = np.zeros((dim,))
+        self.m2 = np.zeros((dim,))
+        self.batchsum = np.zeros((dim, maxbatches))
+        self.q = np.zeros((nq, dim, 5))
+        self.npos = np.zeros((nq, dim, 5))
+        self.p = self.levels
+        # Increments and initial values of the desired marker positions.
+        dn = np.zeros((nq, 5))
+        ninit = np.zeros((nq, 5))
+        for k in range(nq):
+            pk = self.levels[k]
+            dn[k, :] = [0.0, pk/2.0, pk, (1.0+pk)/2.0, 1.0]
+            ninit[k, :] = [1.0, 1.0+2.0*pk, 1.0+4.0*pk, 3.0+2.0*pk, 5.0]
+        self.dn = dn
+        self.ninit = ninit
+
+    # Starts a new sample. Closes the current batch if it's full and merges the batches if all of them are in use.
+    def begin(self):
+        if (self.inbatch == self.batchsize):
+            self.nbatches = self.nbatches + 1
+            self.inbatch = 0
+            if (self.nbatches == self.maxbatches):
+                b = np.asarray(self.batchsum)
+                h = self.maxbatches//2
+                b[:, 0:h] = b[:, 0::2] + b[:, 1::2]
+                b[:, h:] = 0.0
+                self.nbatches = h
+                self.batchsize = 2*self.batchsize
+        self.n = self.n + 1
+        self.inbatch = self.inbatch + 1
+
+    @cython.cdivision(True)
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef void add(self, int j, double v) noexcept nogil:
+        cdef double delta = v - self.mean[j]
+        cdef int k
+        self.mean[j] = self.mean[j] + delta/self.n
+        self.m2[j] = self.m2[j] + delta*(v - self.mean[j])
+        self.batchsum[j, self.nbatches] = self.batchsum[j, self.nbatches] + v
+        for k in range(self.p.shape[0]):
+            self.psquare(k, j, v)
+
+    # One step of the P^2 algorithm for quantile k of pixel j.
+    @cython.cdivision(True)
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef void psquare(self, int k, int j, double v) noexcept nogil:
+        cdef double* q = &self.q[k, j, 0]
+        cdef double* m = &self.npos[k, j, 0]
+        cdef int i, c, e
+        cdef double t, d, qp
+        if (self.n <= 5):
+            # Five first observations are kept sorted.
+            c = self.n - 1
+            q[c] = v
+            while (c > 0 and q[c-1] > q[c]):
+                t = q[c-1]
+                q[c-1] = q[c]
+                q[c] = t
+                c = c - 1
+            m[self.n - 1] = self.n
+            return
+        if (v < q[0]):
+            q[0] = v
+            c = 0
+        elif (v >= q[4]):
+            q[4] = v
+            c = 3
+        else:
+            c = 0
+            while (v >= q[c+1]):
+                c = c + 1
+        for i in range(c+1, 5):
+            m[i] = m[i] + 1.0
+        for i in range(1, 4):
+            d = self.ninit[k, i] + (self.n - 5)*self.dn[k, i] - m[i]
+            if ((d >= 1.0 and m[i+1] - m[i] > 1.0) or (d <= -1.0 and m[i-1] - m[i] < -1.0)):
+                e = 1 if d > 0 else -1
+                qp = q[i] + e/(m[i+1] - m[i-1])*((m[i] - m[i-1] + e)*(q[i+1] - q[i])/(m[i+1] - m[i])
+                                                 + (m[i+1] - m[i] - e)*(q[i] - q[i-1])/(m[i] - m[i-1]))
+                if not (q[i-1] < qp and qp < q[i+1]):
+                    qp = q[i] + e*(q[i+e] - q[i])/(m[i+e] - m[i])
+                q[i] = qp
+                m[i] = m[i] + e
+
+    # Adds the sample x (all the pixels).
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def update(self, x):
+        cdef double[::1] xv = np.ascontiguousarray(np.ravel(x), dtype=np.float64)
+        cdef int j
+        self.begin()
+        with nogil:
+            for j in range(self.dim):
+                self.add(j, xv[j])
+
+    # Posterior variance of each pixel.
+    def variance(self):
+        if (self.n < 2):
+            return np.zeros((self.dim,))
+        return np.asarray(self.m2)/(self.n - 1)
+
+    # Estimated quantiles, one row per level. With fewer than five samples the nearest stored sample is returned.
+    def quantiles(self):
+        q = np.asarray(self.q)
+        if (self.n >= 5):
+            return np.copy(q[:, :, 2])
+        if (self.n == 0):
+            return np.zeros((self.levels.shape[0], self.dim))
+        idx = np.minimum(np.round(self.levels*(self.n - 1)).astype(int), self.n - 1)
+        return np.stack([q[k, :, idx[k]] for k in range(self.levels.shape[0])])
+
+    # Batch means estimate of the effective sample size of each pixel. Only the completed batches are used.
+    def ess(self):
+        if (self.nbatches < 2):
+            return np.zeros((self.dim,))
+        b = np.asarray(self.batchsum)[:, 0:self.nbatches]/self.batchsize
+        varb = np.var(b, axis=1, ddof=1)
+        used = self.nbatches*self.batchsize
+        var = self.variance()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ess = np.where(varb > 0, used*var/(self.batchsize*varb), used)
+        return ess
+
+    # Split R-hat of each pixel. The two halves are the first and the second half of the completed batches (the oldest batch
+    # is left out if their number is odd), and the variance within the halves is recovered from the total variance and the
+    # means of the halves, so no samples are needed.
+    def rhat(self):
+        if (self.nbatches < 4):
+            return np.full((self.dim,), np.inf)
+        h = self.nbatches//2
+        b = np.asarray(self.batchsum)
+        n = h*self.batchsize
+        m1 = np.sum(b[:, self.nbatches-2*h:self.nbatches-h], axis=1)/n
+        m2 = np.sum(b[:, self.nbatches-h:self.nbatches], axis=1)/n
+        between = 0.5*(m1 - m2)**2
+        within = np.maximum(((2*n - 1)*self.variance() - n*between)/(2*n - 2), 0.0)
+        pooled = (n - 1.0)/n*within + between
+        with np.errstate(divide='ignore', invalid='ignore'):
+            r = np.where(within > 0, np.sqrt(pooled/within), 1.0)
+        return r
+
+    # Stores the statistics to a result container as images of the given size.
+    def store(self, res, size):
+        res.mean = np.reshape(np.copy(self.mean), (size, size))
+        res.var = np.reshape(self.variance(), (size, size))
+        res.quantilelevels = np.copy(self.levels)
+        res.quantiles = np.reshape(self.quantiles(), (-1, size, size))
+        res.ess = np.reshape(self.ess(), (size, size))
+        res.statsamples = self.n
+
+# Stopping criterion of the samplers, from the online statistics of the samples after the burn-in (posteriorstats). The
+# chain is stopped when all the given targets are met: the quantile (default 1%) of the ESS over the pixels is at least
+# miness and the 1-quantile of the split R-hats is at most maxrhat. A low quantile instead of the minimum keeps a few stuck
+# pixels (e.g. at sharp edges) from blocking the stop, and quantile=0 gives the minimum ESS and maximum R-hat. Mask (a
+# boolean array or indices of pixels) limits the targets to those pixels. The targets are checked every `every` iterations,
+# and not before the batches of the statistics are at least as long as half their maximum number (the batch means are
+# unreliable with shorter batches). Regardless of them, the chain is stopped after every iteration at which maxtime seconds
+# have passed. After the run, iterations is the number of iterations done and reason is 'converged', 'time' or None.
+class stoppingrule:
+    def __init__(self, miness=None, maxrhat=None, maxtime=None, every=100, quantile=0.01, mask=None):
+        if (miness is None and maxrhat is None and maxtime is None):
+            raise Exception('No stopping criterion given.')
+        if (every < 1):
+            raise Exception('Stopping criterion must be checked at least every iteration.')
+        if not (0.0 <= quantile < 1.0):
+            raise Exception('Quantile of the stopping criterion must be in [0, 1).')
+        self.miness = miness
+        self.maxrhat = maxrhat
+        self.maxtime = maxtime
+        self.every = every
+        self.quantile = quantile
+        self.mask = None
+        if mask is not None:
+            self.mask = np.asarray(mask)
+            if (self.mask.dtype == bool):
+                self.mask = np.ravel(self.mask)
+            else:
+                self.mask = np.ravel(self.mask).astype(np.intp)
+        self.begin()
+
+    def begin(self):
+        self.start = time.time()
+        self.iterations = 0
+        self.reason = None
+
+    def pixels(self, values):
+        if self.mask is None:
+            return values
+        return values[self.mask]
+
+    # Called after iteration i. Returns True if the chain should be stopped.
+    def check(self, stats, i):
+        self.iterations = i
+        if (self.maxtime is not None and time.time() - self.start >= self.maxtime):
+            self.reason = 'time'
+            return True
+        if (i % self.every != 0):
+            return False
+        if (self.miness is None and self.maxrhat is None):
+            return False
+        if (stats is None or stats.nbatches < stats.maxbatches//2 or stats.batchsize < stats.maxbatches//2):
+            return False
+        if (self.miness is not None and np.quantile(self.pixels(stats.ess()), self.quantile) < self.miness):
+            return False
+        if (self.maxrhat is not None and np.quantile(self.pixels(stats.rhat()), 1.0 - self.quantile) > self.maxrhat):
+            return False
+        self.reason = 'converged'
+        return True
+
+# Destination of the thinned samples of a sampler (see chainio). If chainfile is given, the chain is streamed to it and
+# only a block of samples is kept in memory. Otherwise the chain is kept in memory, unless cmonly is set, and if istep > 1,
+# the new samples are appended to the intermediate file every istep iterations. The intermediate file gets a suffix -1, -2, ...
+# if its name is taken, since parallel chains get the same timestamp. Returns None if no samples are collected.
+def samplesink(dim, nsamples, cmonly, chainfile, istep, intername, compression='lzf'):
+    from chainio import chainsink, uniquename
+    if chainfile is not None:
+        return chainsink(dim, nsamples, filename=chainfile, streaming=True, compression=compression)
+    if cmonly:
+        return None
+    filename = None
+    if (istep > 1 and callable(intername)):
+        filename = uniquename(intername(), ".hdf5")
+    return chainsink(dim, nsamples, filename=filename, compression=compression)
+
+# Column access for the MwG samplers. A sparse matrix is read directly from its CSC arrays, while the columns of a
+# linearoperator (for example the matrix-free Radon projector) are calculated into per-thread buffers.
+cdef class columnreader:
+    cdef linearoperator op
+    cdef bint direct
+    cdef int[::1] indptr
+    cdef int[::1] indices
+    cdef double[::1] data
+    cdef int[:, ::1] rowbuf
+    cdef double[:, ::1] valbuf
+
+    def __init__(self, A, Nthreads=1):
+        cdef int size
+        if isinstance(A, sparseoperator):
+            A = A.csc
+        if isinstance(A, linearoperator):
+            self.op = A
+            self.direct = False
+            size = self.op.maxcolumn()
+            self.rowbuf = np.zeros((Nthreads, size), dtype=np.intc)
+            self.valbuf = np.zeros((Nthreads, size))
+        else:
+            if not directcsc(A):
+                A = csc_matrix(A, dtype=np.float64)
+                A.indptr = A.indptr.astype(np.intc)
+                A.indices = A.indices.astype(np.intc)
+            self.direct = True
+            self.indptr = A.indptr
+            self.indices = A.indices
+            self.data = A.data
+
+    # Sets rows and vals to point to the nonzeros of column j and returns their number.
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef inline int fetch(self, int j, int th, int** rows, double** vals) noexcept nogil:
+        if self.direct:
+            rows[0] = &self.indices[0] + self.indptr[j]
+            vals[0] = &self.data[0] + self.indptr[j]
+            return self.indptr[j+1] - self.indptr[j]
+        rows[0] = &self.rowbuf[th, 0]
+        vals[0] = &self.valbuf[th, 0]
+        return self.op.column(j, rows[0], vals[0])
 
 # Logarithm of overall posterior with Cauchy difference prior and  traditional Gaussian likelihood. S2 is the variance of the likelihood. Alpha is the constant term in the Cauchy difference prior denominator.
 @cython.cdivision(True)
@@ -67,75 +369,13 @@ def tfun_isocauchy( x,Q):
     B = Q.boun.dot(x)
     alpha = Q.a
     alphab = Q.boundarya
-    return   -0.5/Q.s2*Mxy.T.dot( Mxy) - 3/2*np.sum(np.log(alpha + np.multiply(Lxx,Lxx) + np.multiply(Lyx,Lyx))) - np.sum(    np.log(alphab + np.multiply(B,B)))
+    return   -0.5/Q.s2*Mxy.T.dot( Mxy) - 1.5*np.sum(np.log(alpha + np.multiply(Lxx,Lxx) + np.multiply(Lyx,Lyx))) - np.sum(    np.log(alphab + np.multiply(B,B)))
 
 @cython.cdivision(True)
 @cython.boundscheck(False) 
 @cython.wraparound(False)  
 def isocauchy_grad(x,Q):
-    M = Q.M
-    Lx = Q.Lx
-    Ly = Q.Ly
-    a = Q.a
-    s2 = Q.s2
-    y = Q.y
-    B=Q.boun
-    
-    cdef double [:] Lxdata =  Lx.data
-    cdef int [:] Lxindices = Lx.indices
-    cdef int [:] Lxptr = Lx.indptr
-    cdef double [:] Lydata = Ly.data
-    cdef int [:]Lyindices = Ly.indices
-    cdef int [:]Lyptr = Ly.indptr
-    cdef double [:] Bdata = B.data
-    cdef int [:]Bindices = B.indices
-    cdef int [:]Bptr = B.indptr
-    (ro,co) = Ly.shape
-    cdef int row = ro
-    cdef int col = co
-    cdef double alfa = a
-    cdef double alfab = Q.boundarya
-
-    Mxy = M.dot(x) - y
-   
-    cdef double [:,:] Lxx = Lx.dot(x)
-
-    cdef double [:,:] Lyx = Ly.dot(x)
-    
-    cdef double [:,:] Bx  = B.dot(x)
-    
-    # Likelihood part.
-    gr = -1.0/s2  * (M.T).dot(Mxy)
-    cdef double [:,:] grv = gr
-    cdef int i,j
-    cdef double s
-
-
-    # Prior part.
-    for i in prange(col,nogil=True):
-        s = 0
-        for j in range(Lxptr[i],Lxptr[i+1]):
-            s = s - 6/2*Lxx[Lxindices[j],0]/(alfa+Lxx[Lxindices[j],0]*Lxx[Lxindices[j],0] + Lyx[Lxindices[j],0]*Lyx[Lxindices[j],0])*Lxdata[j]
-
-        grv[i,0] = grv[i,0] + s
-
-    for i in prange(col,nogil=True):
-        s = 0
-        for j in range(Lyptr[i], Lyptr[i + 1]):
-            s = s - 6/2 * Lyx[Lyindices[j],0] / (alfa+Lxx[Lxindices[j],0]*Lxx[Lxindices[j],0] + Lyx[Lyindices[j],0]*Lyx[Lyindices[j],0])*Lydata[j]
-
-        grv[i, 0] = grv[i, 0] +   s
-    
-    for i in prange(col,nogil=True):
-        s = 0
-        for j in range(Bptr[i], Bptr[i + 1]):
-            s = s - 2 * Bx[Bindices[j],0] / (alfab+Bx[Bindices[j],0]*Bx[Bindices[j],0])*Bdata[j]
-
-        grv[i, 0] = grv[i, 0] +   s
-    return gr
-
-              
-      
+    return np.reshape(isocauchy_valgrad(x, Q)[1], (-1, 1))
 
 # Logarithm of overall posterior with Total Variation prior and  traditional Gaussian likelihood. S2 is the variance of the likelihood. Alpha is the regularization parameter.
 @cython.cdivision(True)
@@ -174,127 +414,280 @@ def tfun_tikhonov(x,Q):
 @cython.boundscheck(False) 
 @cython.wraparound(False)
 def tikhonov_grad(x,Q):
-    M = Q.M
-    Lx = Q.Lx
-    Ly = Q.Ly
-    a = Q.a
-    s2 = Q.s2
-    y = Q.y
-    Mxy = M.dot(x) - y
-    Lxx = Lx.dot(x) 
-    Lyx = Ly.dot(x)
-    return -1.0/s2  * (M.T).dot(Mxy)  - 2.0*a*(Lx.T).dot(Lxx) - 2.0*a*(Ly.T).dot(Lyx)
+    return np.reshape(tikhonov_valgrad(x, Q)[1], (-1, 1))
 
 # Gradient of the log-TV.
 @cython.cdivision(True)
 @cython.boundscheck(False) 
 @cython.wraparound(False)
 def tv_grad(x,Q):
-    M = Q.M
-    Lx = Q.Lx
-    Ly = Q.Ly
-    a = Q.a
-    s2 = Q.s2
-    y = Q.y
-    b = Q.b
-    cdef double [:] Lxdata =  Lx.data
-    cdef int [:] Lxindices = Lx.indices
-    cdef int [:] Lxptr = Lx.indptr
-    cdef double [:] Lydata = Ly.data
-    cdef int [:]Lyindices = Ly.indices
-    cdef int [:]Lyptr = Ly.indptr
-    (ro,co) = Ly.shape
-    cdef int row = ro
-    cdef int col = co
-    cdef double alfa = a
-    cdef double beta = b 
-
-    Mxy = M.dot(x) - y
-    cdef double [:,:] Lxx = Lx.dot(x)
-    cdef double [:,:] Lyx = Ly.dot(x)
-    
-    # Likelihood part.
-    gr = -1.0/s2  * (M.T).dot(Mxy) 
-    cdef double [:,:] grv = gr
-    cdef int i,j
-    cdef double s
-    
-    # Calculation of the prior part.
-    for i in prange(col,nogil=True):
-        s = 0
-        for j in range(Lxptr[i],Lxptr[i+1]):
-            s = s - Lxdata[j]*Lxx[Lxindices[j],0]/sqrt(Lxx[Lxindices[j],0]*Lxx[Lxindices[j],0] + beta)
-
-        grv[i,0] = grv[i,0] + alfa*s
-
-    for i in prange(col,nogil=True):
-        s = 0
-        for j in range(Lyptr[i], Lyptr[i + 1]):
-            s = s - Lydata[j] * Lyx[Lyindices[j],0] / sqrt(Lyx[Lyindices[j],0] *Lyx[Lyindices[j],0] + beta)
-
-        grv[i, 0] = grv[i, 0] + alfa * s 
-    return gr
-
+    return np.reshape(tv_valgrad(x, Q)[1], (-1, 1))
 
 # Gradient of the log-Cauchy.
 @cython.cdivision(True)
 @cython.boundscheck(False) 
 @cython.wraparound(False)
 def cauchy_grad(x,Q):
+    return np.reshape(cauchy_valgrad(x, Q)[1], (-1, 1))
+
+# Fused log-posterior and gradient for the MAP estimates. Every sparse product is done only once per evaluation:
+# the forward products M*x, Lx*x, Ly*x (and B*x) are followed by one pass over the rows, which sums the log-density and
+# stores the derivative of each term, and one parallel pass over the columns (pixels), which applies the transposes of
+# all the matrices at once. The temporaries are kept in Q.work between the calls.
+# The gradient functions above return the gradient part of the same kernel. The matrices are read through columnreader,
+# so they can be sparse matrices or linearoperators (e.g. the stencils of differenceoperator or waveletoperator).
+# If out is given, the gradient is written to it instead of a new array.
+cdef enum:
+    PTIKHONOV = 0
+    PTV = 1
+    PCAUCHY = 2
+    PISOCAUCHY = 3
+    PWAVELET = 4
+
+# Returns a preallocated work vector of length n from Q.work.
+def workbuffer(Q, name, n):
+    b = Q.work.get(name)
+    if (b is None or b.shape[0] != n):
+        b = np.zeros((n,))
+        Q.work[name] = b
+    return b
+
+# Number of threads of the kernels of Q.
+def kernelthreads(Q):
+    if Q.Nthreads is not None:
+        return Q.Nthreads
+    return getattr(Q.M, 'Nthreads', openmp.omp_get_max_threads())
+
+# True if the matrix can be read directly from its CSC arrays.
+def directcsc(A):
+    return sp.isspmatrix_csc(A) and A.data.dtype == np.float64 and A.indices.dtype == np.int32 and A.indptr.dtype == np.int32
+
+@cython.cdivision(True)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef valgrad(x, Q, int prior, out=None):
+    x = np.ravel(x)
     M = Q.M
     Lx = Q.Lx
     Ly = Q.Ly
-    a = Q.a
-    s2 = Q.s2
-    y = Q.y
-    cdef double [:] Lxdata =  Lx.data
-    cdef int [:] Lxindices = Lx.indices
-    cdef int [:] Lxptr = Lx.indptr
-    cdef double [:] Lydata = Ly.data
-    cdef int [:]Lyindices = Ly.indices
-    cdef int [:]Lyptr = Ly.indptr
-    (ro,co) = Ly.shape
-    cdef int row = ro
-    cdef int col = co
-    cdef double alfa = a
-
-    Mxy = M.dot(x) - y
-   
-    cdef double [:,:] Lxx = Lx.dot(x)
-
-    cdef double [:,:] Lyx = Ly.dot(x)
-    
-    # Likelihood part.
-    gr = -1.0/s2  * (M.T).dot(Mxy)
-    cdef double [:,:] grv = gr
-    cdef int i,j
-    cdef double s
-
+    B = Q.boun
+    cdef bint useB = (prior == PISOCAUCHY)
+    cdef double alfa = Q.a
+    cdef double beta = Q.b
+    cdef double alfab = Q.boundarya
+    cdef double s2 = Q.s2
+    cdef int D = x.shape[0]
+    cdef int Nth = kernelthreads(Q)
+    cdef int i, j, k
+
+    # Forward products and residual.
+    cdef double [::1] Mxy = workbuffer(Q, 'Mxy', M.shape[0])
+    np.subtract(np.ravel(M.dot(x)), np.ravel(Q.y), out=np.asarray(Mxy))
+    cdef double [::1] Lxx = workbuffer(Q, 'Lxx', Lx.shape[0])
+    np.copyto(np.asarray(Lxx), np.ravel(Lx.dot(x)))
+    cdef double [::1] dLx = workbuffer(Q, 'dLx', Lx.shape[0])
+    cdef double [::1] Lyx = workbuffer(Q, 'Lyx', Ly.shape[0])
+    np.copyto(np.asarray(Lyx), np.ravel(Ly.dot(x)))
+    cdef double [::1] dLy = workbuffer(Q, 'dLy', Ly.shape[0])
+    cdef double [::1] Bx = Lxx
+    cdef double [::1] dB = dLx
+    if useB:
+        Bx = workbuffer(Q, 'Bx', B.shape[0])
+        np.copyto(np.asarray(Bx), np.ravel(B.dot(x)))
+        dB = workbuffer(Q, 'dB', B.shape[0])
+    cdef int nM = Mxy.shape[0]
+    cdef int nLx = Lxx.shape[0]
+    cdef int nLy = Lyx.shape[0]
+    cdef int nB = Bx.shape[0]
+    if (prior == PISOCAUCHY and nLx != nLy):
+        raise Exception('Isotropic Cauchy prior needs difference matrices of the same size.')
+
+    # Log-density and the derivative of each term with respect to its row of the product.
+    cdef double lh = 0.0
+    cdef double pr = 0.0
+    cdef double v, w, q, e
+    for k in prange(nM, nogil=True, num_threads=Nth):
+        lh += Mxy[k]*Mxy[k]
+    for k in prange(nLx, nogil=True, num_threads=Nth):
+        v = Lxx[k]
+        if (prior == PTIKHONOV):
+            e = -alfa*v*v
+            dLx[k] = -2.0*alfa*v
+        elif (prior == PTV or prior == PWAVELET):
+            q = sqrt(v*v + beta)
+            e = -alfa*q
+            dLx[k] = -alfa*v/q
+        elif (prior == PCAUCHY):
+            q = alfa + v*v
+            e = -log(q)
+            dLx[k] = -2.0*v/q
+        else:
+            w = Lyx[k]
+            q = alfa + v*v + w*w
+            e = -1.5*log(q)
+            dLx[k] = -3.0*v/q
+            dLy[k] = -3.0*w/q
+        pr += e
+    if (prior != PISOCAUCHY):
+        for k in prange(nLy, nogil=True, num_threads=Nth):
+            v = Lyx[k]
+            if (prior == PTIKHONOV):
+                e = -alfa*v*v
+                dLy[k] = -2.0*alfa*v
+            elif (prior == PTV or prior == PWAVELET):
+                q = sqrt(v*v + beta)
+                e = -alfa*q
+                dLy[k] = -alfa*v/q
+            else:
+                q = alfa + v*v
+                e = -log(q)
+                dLy[k] = -2.0*v/q
+            pr += e
+    if useB:
+        for k in prange(nB, nogil=True, num_threads=Nth):
+            v = Bx[k]
+            q = alfab + v*v
+            pr += -log(q)
+            dB[k] = -2.0*v/q
+
+    # Gradient. The transposes of the matrices are applied column by column. The wavelet transform has a fast adjoint
+    # of its own, so it is applied separately and the column pass skips it.
+    if out is None:
+        gr = np.zeros((D,))
+    else:
+        gr = out
+        gr.fill(0.0)
+    cdef double [::1] grv = gr
+    cdef columnreader Mc = columnreader(M, Nth)
+    if isinstance(Lx, waveletoperator):
+        np.copyto(gr, np.ravel(Lx.rdot(np.asarray(dLx))))
+        Lx = csc_matrix((1, D))
+    cdef columnreader Lxc = columnreader(Lx, Nth)
+    cdef columnreader Lyc = columnreader(Ly, Nth)
+    cdef columnreader Bc = Lxc
+    if useB:
+        Bc = columnreader(B, Nth)
+    cdef int* rows
+    cdef double* vals
+    cdef int n, th
+    cdef double s, t
+    for i in prange(D, nogil=True, num_threads=Nth):
+        th = thid()
+        rows = NULL
+        vals = NULL
+        s = 0.0
+        n = Mc.fetch(i, th, &rows, &vals)
+        for j in range(n):
+            s = s + vals[j]*Mxy[rows[j]]
+        t = 0.0
+        n = Lxc.fetch(i, th, &rows, &vals)
+        for j in range(n):
+            t = t + vals[j]*dLx[rows[j]]
+        n = Lyc.fetch(i, th, &rows, &vals)
+        for j in range(n):
+            t = t + vals[j]*dLy[rows[j]]
+        if useB:
+            n = Bc.fetch(i, th, &rows, &vals)
+            for j in range(n):
+                t = t + vals[j]*dB[rows[j]]
+        grv[i] = grv[i] - s/s2 + t
+    return (-0.5/s2*lh + pr, gr)
+
+# Log-posterior and its gradient for Tikhonov prior (see tfun_tikhonov and tikhonov_grad).
+def tikhonov_valgrad(x, Q):
+    return valgrad(x, Q, PTIKHONOV)
+
+# Log-posterior and its gradient for TV prior (see tfun_tv and tv_grad).
+def tv_valgrad(x, Q):
+    return valgrad(x, Q, PTV)
+
+# Log-posterior and its gradient for anisotropic Cauchy prior (see tfun_cauchy and cauchy_grad).
+def cauchy_valgrad(x, Q):
+    return valgrad(x, Q, PCAUCHY)
+
+# Log-posterior and its gradient for isotropic Cauchy prior (see tfun_isocauchy and isocauchy_grad).
+def isocauchy_valgrad(x, Q):
+    return valgrad(x, Q, PISOCAUCHY)
+
+# Log-posterior and its gradient for Besov prior. Lx is the wavelet transform and the terms of Ly are those of TV, so with
+# the empty Ly of map_wavelet the value includes the same constant -a*sqrt(b) as the earlier tfun_tv based estimate.
+def wavelet_valgrad(x, Q):
+    return valgrad(x, Q, PWAVELET)
+
+# Priors of the gradient functions, with which the samplers call the fused kernel directly.
+fusedpriors = {tikhonov_grad: PTIKHONOV, tv_grad: PTV, cauchy_grad: PCAUCHY, isocauchy_grad: PISOCAUCHY}
+
+# Log-posteriors and their gradients of K images at once, for reconstructing many sinograms of the same geometry. The images
+# are the columns of X (D x K) and the sinograms the columns of Q.y. Every matrix is applied to the whole block (a sparse
+# matrix times a dense matrix), so it is read from memory once for all the images instead of once per image. S2 may be a
+# vector of the likelihood variances of the images. Returns the log-posteriors (K,) and the gradients (D x K), which are
+# the same as those of the fused kernel above for each column.
+def blockvalgrad(X, Q, prior, s2=None):
+    X = np.ascontiguousarray(X, dtype=np.float64)
+    if s2 is None:
+        s2 = Q.s2
+    s2 = np.ravel(np.asarray(s2, dtype=np.float64))
+    cdef double alfa = Q.a
+    cdef double beta = Q.b
+    R = Q.M.dot(X) - Q.y
+    value = -0.5*np.sum(R*R, axis=0)/s2
+    gr = -np.asarray(Q.M.T.dot(R))/s2
+    Lxx = np.asarray(Q.Lx.dot(X))
+    if (prior == PISOCAUCHY):
+        Lyx = np.asarray(Q.Ly.dot(X))
+        if (Lxx.shape[0] != Lyx.shape[0]):
+            raise Exception('Isotropic Cauchy prior needs difference matrices of the same size.')
+        q = alfa + Lxx*Lxx + Lyx*Lyx
+        value = value - 1.5*np.sum(np.log(q), axis=0)
+        gr = gr + np.asarray(Q.Lx.T.dot(-3.0*Lxx/q)) + np.asarray(Q.Ly.T.dot(-3.0*Lyx/q))
+        Bx = np.asarray(Q.boun.dot(X))
+        q = Q.boundarya + Bx*Bx
+        value = value - np.sum(np.log(q), axis=0)
+        return (value, gr + np.asarray(Q.boun.T.dot(-2.0*Bx/q)))
+    operators = [(Q.Lx, Lxx), (Q.Ly, np.asarray(Q.Ly.dot(X)))]
+    for (L, Lx) in operators:
+        if (prior == PTIKHONOV):
+            value = value - alfa*np.sum(Lx*Lx, axis=0)
+            d = -2.0*alfa*Lx
+        elif (prior == PTV or prior == PWAVELET):
+            q = np.sqrt(Lx*Lx + beta)
+            value = value - alfa*np.sum(q, axis=0)
+            d = -alfa*Lx/q
+        else:
+            q = alfa + Lx*Lx
+            value = value - np.sum(np.log(q), axis=0)
+            d = -2.0*Lx/q
+        gr = gr + np.asarray(L.T.dot(d))
+    return (value, gr)
 
-    # Prior part.
-    for i in prange(col,nogil=True):
-        s = 0
-        for j in range(Lxptr[i],Lxptr[i+1]):
-            s = s - 2*Lxx[Lxindices[j],0]/(alfa+Lxx[Lxindices[j],0]*Lxx[Lxindices[j],0])*Lxdata[j]
+# Priors of blockvalgrad by name.
+blockpriors = {'tikhonov': PTIKHONOV, 'tv': PTV, 'cauchy': PCAUCHY, 'isocauchy': PISOCAUCHY, 'wavelet': PWAVELET}
 
-        grv[i,0] = grv[i,0] + s
 
-    for i in prange(col,nogil=True):
-        s = 0
-        for j in range(Lyptr[i], Lyptr[i + 1]):
-            s = s - 2 * Lyx[Lyindices[j],0] / (alfa + Lyx[Lyindices[j],0] *Lyx[Lyindices[j],0])*Lydata[j]
+# Momentum, kinetic energy and position step of the HMC samplers. Without an inverse metric (see metric.py) the metric is
+# the scalar mass (1 in hmc and nonuts_hmc).
+def drawmomentum(dim, metric=None, mass=1):
+    if metric is None:
+        return np.sqrt(mass)*np.random.randn(dim, 1)
+    return metric.momentum(np.random.randn(dim, 1))
 
-        grv[i, 0] = grv[i, 0] +   s
-    return gr
+def kinetic(p, metric=None, mass=1):
+    if metric is None:
+        return 0.5/mass*np.dot(p.T, p)
+    return metric.kinetic(p)
 
+def positionstep(p, epsilon, metric=None, mass=1):
+    if metric is None:
+        return epsilon/mass*p
+    return epsilon*metric.velocity(p)
 
 # Leapfrog function for HMC.
 @cython.boundscheck(False) 
 @cython.wraparound(False)
 @cython.cdivision(True)
-def leapfrog(theta,r,epsilon,Q,currgrad):
+def leapfrog(theta,r,epsilon,Q,currgrad,metric=None):
     r = r + epsilon*0.5*currgrad
-    theta = theta + epsilon*r
+    theta = theta + positionstep(r, epsilon, metric)
     currdensity = Q.logdensity(theta,Q)
     currgrad = Q.gradi(theta, Q)
     r = r + epsilon*0.5*currgrad
@@ -302,58 +695,217 @@ def leapfrog(theta,r,epsilon,Q,currgrad):
 
 
 # Function, which finds initial step size for HMC.
-def initialeps(theta,Q,currdensity,currgrad):
+def initialeps(theta,Q,currdensity,currgrad,metric=None):
     def totalenergy( r, cd):
-        energy = (cd - 0.5 * np.dot(r.T, r))
+        energy = (cd - kinetic(r, metric))
         return energy
     eps = 1.0
-    r = np.random.randn(theta.shape[0],1)
-    (theta2,r2,currdensity2,currgrad2) = leapfrog(theta,r,eps,Q,currgrad)
+    r = drawmomentum(theta.shape[0], metric)
+    (theta2,r2,currdensity2,currgrad2) = leapfrog(theta,r,eps,Q,currgrad,metric)
     a = 2.0*(np.exp(totalenergy(r2,currdensity2) - totalenergy(r,currdensity)) > 0.5) -1.0
 
     while  a * (totalenergy(r2,currdensity2) - totalenergy(r,currdensity)) > -a * np.log(2):
         eps = 2.0**(a)*eps
-        (theta2,r2,currdensity2,currgrad2) = leapfrog(theta,r,eps,Q,currgrad)
+        (theta2,r2,currdensity2,currgrad2) = leapfrog(theta,r,eps,Q,currgrad,metric)
     return eps
 
 
-# Buildtree-function is the core of HMC-NUTS method.
-# This function is a modified version of Morgan Fouesneau's one (MIT license):
+# Trajectory of the NUTS sampler of hmc.
+# The tree building is a modified version of Morgan Fouesneau's recursive buildtree (MIT license):
 # https://github.com/mfouesneau/NUTS/blob/master/nuts/nuts.py
-# Passing the present step's gradient as an input (currgrad) argument saves calls to gradient function. 
-# That also requires using extra output arguments for different branches.  
-# Using logu as an function input argument instead of u helps to prevent overflows. 
-@cython.boundscheck(False) 
-@cython.wraparound(False)
-@cython.cdivision(True)  
-def buildtree(theta,r,logu,v,j,epsilon,theta0,r0,Q,initialdr,currgrad):
-    if (j==0):
-        thetatilde, rtilde, currdensitytilde,currgradtilde = leapfrog(theta,r,v*epsilon,Q,currgrad)
-        diff = np.min(np.array([np.exp(currdensitytilde - 0.5*np.dot(rtilde.T,rtilde) -initialdr),1]))
-        ntilde = int(logu <= (currdensitytilde - 0.5*np.dot(rtilde.T,rtilde) )  )
-        stilde = int(logu < (1000.0+currdensitytilde - 0.5*np.dot(rtilde.T,rtilde) )  )
-        return thetatilde,rtilde,thetatilde,rtilde,thetatilde,ntilde,stilde,diff,1,currdensitytilde,currgradtilde,currgradtilde,currgradtilde
-
-    else:
-        thetaminus,rminus,thetaplus,rplus,thetatilde,ntilde,stilde,alfatilde,nalfatilde,currdensitytilde,currgradtilde,gradplus,gradminus = buildtree(theta,r,logu,v,j-1,epsilon,theta0,r0,Q,initialdr,currgrad)
-
-        if(stilde == 1):
-            if(v == -1):
-                thetaminus, rminus, _, _, thetatildetilde, ntildetilde, stildetilde, alfatildetilde, nalfatildetilde,currdensitytildetilde,currgradtildetilde,_,gradminus = buildtree(
-                    thetaminus, rminus, logu, v, j - 1, epsilon, theta0, r0,Q,initialdr,gradminus)
+# Here the tree is built iteratively. The leaves are added one at a time to the end of the trajectory in direction v, and
+# every subtree which waits for its second half is kept in a slot of its level, so the merges (and the random numbers they
+# draw) happen in the same order as in the recursion. The ends of the trajectory, the slots and the gradients are
+# preallocated arrays, which are updated in place, so building a tree allocates no vectors.
+# The vector updates are done with in-place NumPy operations and the dot products with np.dot, so that the arithmetic is the
+# same as in the recursive version: with fused=False (log-density from Q.logdensity, gradient from Q.gradi) the chain is
+# identical to the earlier implementation for a fixed seed. With fused=True the log-density and the gradient come from one
+# call of the fused kernel (valgrad), if Q.gradi is one of its gradient functions. If metric (an inversemetric) is set, the
+# positions move along M^-1 r and the energies and U-turn checks use the same metric.
+# Using logu instead of u helps to prevent overflows.
+cdef class nutstree:
+    cdef object Q
+    cdef int prior
+    cdef int dim
+    cdef int depth
+    # Ends of the trajectory, row 0 is the minus end and row 1 the plus end.
+    cdef public object theta
+    cdef public object r
+    cdef public object grad
+    # Subtrees waiting for their second halves: first leaf (starttheta, startr), candidate sample and its gradient.
+    cdef object starttheta
+    cdef object startr
+    cdef object tildetheta
+    cdef object tildegrad
+    cdef double[::1] tildedens
+    cdef double[::1] alfas
+    cdef double[::1] nalfas
+    cdef long[::1] ns
+    cdef int[::1] pending
+    cdef object tmp
+    cdef object expbuf
+    cdef public object metric
+    # Result of the last build. Tilde is -1 if the candidate is the end of the trajectory, otherwise its slot.
+    cdef int tilde
+    cdef int end
+    cdef public double tildedensity
+    cdef public double alfa
+    cdef public double nalfa
+    cdef public long n
+    cdef public int s
+
+    def __init__(self, Q, dim, fused=True):
+        self.Q = Q
+        self.dim = dim
+        self.prior = -1
+        if fused:
+            self.prior = fusedpriors.get(Q.gradi, -1)
+        self.theta = np.zeros((2, dim))
+        self.r = np.zeros((2, dim))
+        self.grad = np.zeros((2, dim))
+        self.tmp = np.zeros((dim,))
+        self.expbuf = np.zeros((1,))
+        self.metric = None
+        self.depth = 0
+        self.allocate(10)
+
+    def allocate(self, depth):
+        self.depth = depth
+        self.starttheta = np.zeros((depth, self.dim))
+        self.startr = np.zeros((depth, self.dim))
+        self.tildetheta = np.zeros((depth, self.dim))
+        self.tildegrad = np.zeros((depth, self.dim))
+        self.tildedens = np.zeros((depth,))
+        self.alfas = np.zeros((depth,))
+        self.nalfas = np.zeros((depth,))
+        self.ns = np.zeros((depth,), dtype=np.int_)
+        self.pending = np.zeros((depth,), dtype=np.intc)
+
+    # Log-density at x. The gradient is written to g.
+    def evaluate(self, x, g):
+        if (self.prior >= 0):
+            return valgrad(x, self.Q, self.prior, g)[0]
+        density = self.Q.logdensity(np.reshape(x, (-1, 1)), self.Q)
+        np.copyto(g, np.ravel(self.Q.gradi(np.reshape(x, (-1, 1)), self.Q)))
+        return float(np.ravel(density)[0])
+
+    # Starts a trajectory from theta0 with momentum r0.
+    def begin(self, theta0, r0, grad0):
+        self.theta[:, :] = np.ravel(theta0)
+        self.r[:, :] = np.ravel(r0)
+        self.grad[:, :] = np.ravel(grad0)
+
+    # Leapfrog step of length h of end e.
+    cdef double leapfrog(self, int e, double h):
+        cdef double h2 = h*0.5
+        theta = self.theta[e]
+        r = self.r[e]
+        grad = self.grad[e]
+        tmp = self.tmp
+        np.multiply(grad, h2, out=tmp)
+        np.add(r, tmp, out=r)
+        if self.metric is None:
+            np.multiply(r, h, out=tmp)
+        else:
+            np.multiply(self.metric.velocity(r), h, out=tmp)
+        np.add(theta, tmp, out=theta)
+        density = self.evaluate(theta, grad)
+        np.multiply(grad, h2, out=tmp)
+        np.add(r, tmp, out=r)
+        return density
+
+    # 1 if the trajectory from (thetaminus, rminus) to (thetaplus, rplus) has not made a U-turn.
+    cdef int noturn(self, thetaminus, rminus, thetaplus, rplus):
+        tmp = self.tmp
+        np.subtract(thetaplus, thetaminus, out=tmp)
+        if self.metric is not None:
+            rminus = self.metric.velocity(rminus)
+            rplus = self.metric.velocity(rplus)
+        return int(np.dot(tmp, rminus) >= 0)*int(np.dot(tmp, rplus) >= 0)
+
+    # No U-turn over the whole trajectory.
+    def uturnfree(self):
+        return self.noturn(self.theta[0], self.r[0], self.theta[1], self.r[1])
+
+    # Builds a tree of 2^j leaves in direction v. The result is in n, s, alfa, nalfa and the candidate (see accept).
+    @cython.cdivision(True)
+    def build(self, int v, int j, double epsilon, double logu, double initialdr):
+        cdef int e = 0 if v == -1 else 1
+        cdef double h = v*epsilon
+        cdef int l, cs, ctilde, cstart
+        cdef long cn
+        cdef double density, dd, energy, cdens, calfa, cnalfa
+        if (j + 1 > self.depth):
+            self.allocate(2*(j + 1))
+        self.end = e
+        theta = self.theta[e]
+        r = self.r[e]
+        while True:
+            # New leaf at the end of the trajectory.
+            density = self.leapfrog(e, h)
+            if self.metric is None:
+                dd = np.dot(r, r)
             else:
-                _, _, thetaplus, rplus, thetatildetilde, ntildetilde, stildetilde, alfatildetilde, nalfatildetilde,currdensitytildetilde,currgradtildetilde,gradplus,_ = buildtree(
-                    thetaplus, rplus, logu, v, j - 1, epsilon, theta0, r0,Q,initialdr,gradplus)
-            if(np.random.rand() <= ntildetilde/np.max(np.array([ntilde + ntildetilde,1]))):
-                thetatilde = thetatildetilde
-                currdensitytilde = currdensitytildetilde
-                currgradtilde = currgradtildetilde
-
-            alfatilde = alfatilde + alfatildetilde
-            nalfatilde = nalfatilde + nalfatildetilde
-            stilde = stildetilde*(float(np.dot((thetaplus -thetaminus).T,rminus) >= 0)*(np.dot((thetaplus -thetaminus).T,rplus)>=0))
-            ntilde = ntilde + ntildetilde
-        return thetaminus,rminus,thetaplus,rplus,thetatilde,ntilde,stilde,alfatilde,nalfatilde,currdensitytilde,currgradtilde,gradplus,gradminus
+                dd = np.dot(r, self.metric.velocity(r))
+            energy = density - 0.5*dd
+            cn = 1 if logu <= energy else 0
+            cs = 1 if logu < (1000.0 + density) - 0.5*dd else 0
+            self.expbuf[0] = energy - initialdr
+            np.exp(self.expbuf, out=self.expbuf)
+            calfa = min(self.expbuf[0], 1.0)
+            cnalfa = 1.0
+            cdens = density
+            ctilde = -1
+            cstart = -1
+            l = 0
+            while True:
+                if (l == j):
+                    self.tilde = ctilde
+                    self.tildedensity = cdens
+                    self.n = cn
+                    self.s = cs
+                    self.alfa = calfa
+                    self.nalfa = cnalfa
+                    return
+                if (self.pending[l] == 0):
+                    if (cs == 1):
+                        # First half of a subtree of level l + 1. Its second half is built next.
+                        self.starttheta[l] = theta if cstart < 0 else self.starttheta[cstart]
+                        self.startr[l] = r if cstart < 0 else self.startr[cstart]
+                        self.tildetheta[l] = theta if ctilde < 0 else self.tildetheta[ctilde]
+                        self.tildegrad[l] = self.grad[e] if ctilde < 0 else self.tildegrad[ctilde]
+                        self.tildedens[l] = cdens
+                        self.ns[l] = cn
+                        self.alfas[l] = calfa
+                        self.nalfas[l] = cnalfa
+                        self.pending[l] = 1
+                        break
+                    # The second half is not built, the subtree is the first half as it is.
+                    l = l + 1
+                    continue
+                # Merges the second half with the first half in slot l.
+                self.pending[l] = 0
+                if not (np.random.rand() <= cn/float(max(self.ns[l] + cn, 1))):
+                    ctilde = l
+                    cdens = self.tildedens[l]
+                calfa = self.alfas[l] + calfa
+                cnalfa = self.nalfas[l] + cnalfa
+                if (v == -1):
+                    cs = cs*self.noturn(theta, r, self.starttheta[l], self.startr[l])
+                else:
+                    cs = cs*self.noturn(self.starttheta[l], self.startr[l], theta, r)
+                cn = self.ns[l] + cn
+                cstart = l
+                l = l + 1
+
+    # Copies the candidate of the last build to theta0 and its gradient to grad0.
+    def accept(self, theta0, grad0):
+        if (self.tilde < 0):
+            np.copyto(theta0, self.theta[self.end])
+            np.copyto(grad0, self.grad[self.end])
+        else:
+            np.copyto(theta0, self.tildetheta[self.tilde])
+            np.copyto(grad0, self.tildegrad[self.tilde])
 
 
 # The main HMC method. 
@@ -364,24 +916,34 @@ def buildtree(theta,r,logu,v,j,epsilon,theta0,r0,Q,initialdr,currgrad):
 @cython.boundscheck(False) 
 @cython.wraparound(False)
 @cython.cdivision(True)
-def hmc(M,theta0,Q,Madapt,de=0.6,gamma=0.05,t0=10.0,kappa=0.75,epsilonwanted=None,cmonly=False,thinning=1,istep=100,intername=time.time()):
+def hmc(M,theta0,Q,Madapt,de=0.6,gamma=0.05,t0=10.0,kappa=0.75,epsilonwanted=None,cmonly=False,thinning=1,istep=100,intername=time.time(),chainfile=None,compression='lzf',stats=None,statburnin=None,stopping=None,fused=True,metric=None,adaptation=None):
     bar = tqdm(total=M,file=sys.stdout)
-    theta0 = np.reshape(theta0,(-1,1))
+    theta0 = np.array(np.reshape(theta0,(-1,1)), dtype=np.float64)
     dim = theta0.shape[0]
-    if (cmonly == False):
-        theta = np.zeros((dim, M//thinning + 1))
-        theta[:, 0] = np.ravel(theta0)
+    sburn = Madapt if statburnin is None else statburnin
+    if (stopping is not None):
+        stopping.begin()
+        if stats is None:
+            stats = posteriorstats(dim, quantiles=())
+    sink = samplesink(dim, M//thinning + 1, cmonly, chainfile, istep, intername, compression)
+    if sink is not None:
+        sink.store(0, theta0)
     delta = de
-    currdensity = float(Q.logdensity(theta0, Q))
-    currgrad = Q.gradi(theta0, Q)
+    if (adaptation is not None and metric is None):
+        metric = adaptation.metric
+    tree = nutstree(Q, dim, fused)
+    tree.metric = metric
+    currgrad = np.zeros((dim,1))
+    currdensity = tree.evaluate(np.ravel(theta0), np.ravel(currgrad))
     if (epsilonwanted is None):
-        epsilon = initialeps(theta0,Q,currdensity,currgrad)
+        epsilon = initialeps(theta0,Q,currdensity,currgrad,metric)
         epsilonhat = 1.0
     else:
         epsilon = epsilonwanted
         epsilonhat = epsilonwanted
     myy = np.log(10*epsilon)
     Hhat = 0.0
+    restart = 0
     cmestimate = np.zeros((dim,1))
     if (Madapt >= M):
         raise Exception('Madapt <= M.')
@@ -390,57 +952,65 @@ def hmc(M,theta0,Q,Madapt,de=0.6,gamma=0.05,t0=10.0,kappa=0.75,epsilonwanted=Non
 
     for i in range(1,M+1):
         bar.update(1)
-        r0 = np.random.randn(dim, 1)
-        logu = float(currdensity - 0.5*np.dot(r0.T,r0))+np.log(np.random.rand())
-        initialdr = float(currdensity - 0.5 * np.dot(r0.T, r0))
-        thetaminus = np.reshape(theta0,(-1,1))
-        thetaplus = np.reshape(theta0,(-1,1))
-        rminus = r0
-        rplus = r0
-        gradminus = currgrad
-        gradplus = currgrad
+        r0 = drawmomentum(dim, metric)
+        logu = float(currdensity - kinetic(r0, metric))+np.log(np.random.rand())
+        initialdr = float(currdensity - kinetic(r0, metric))
+        tree.begin(theta0, r0, currgrad)
         j = 0
         n = 1.0
         s = 1.0
-        if(cmonly == False and (i%thinning == 0)):
-            theta[:, i//thinning] = np.ravel(theta0)
-  
+
         while (s==1):
             vj = np.random.choice(np.array([-1,1]))
-            if (vj ==-1):
-                thetaminus,rminus,_,_,thetatilde,ntilde,stilde,alfa,nalfa,currdensitytilde,currgradtilde,_,gradminus = buildtree(thetaminus,rminus,logu,vj,j,epsilon,theta0,r0,Q,initialdr,gradminus)
+            tree.build(vj, j, epsilon, logu, initialdr)
 
-            else:
-                _,_,thetaplus,rplus,thetatilde,ntilde,stilde,alfa,nalfa,currdensitytilde,currgradtilde,gradplus,_ = buildtree(thetaplus, rplus, logu,vj,j,epsilon,theta0,r0,Q,initialdr,gradplus)
-
-            if (stilde ==1):
-                if(np.random.rand() < ntilde/n):
-                    if(cmonly == False and (i%thinning == 0)):
-                        theta[:, i//thinning] = np.ravel(thetatilde)
-                    theta0 = thetatilde
-                    currdensity= currdensitytilde
-                    currgrad = currgradtilde
-
-            n = n+ntilde
-            s = stilde*(float(np.dot((thetaplus -thetaminus).T,rminus) >= 0)*(np.dot((thetaplus -thetaminus).T,rplus) >= 0))
+            if (tree.s ==1):
+                if(np.random.rand() < tree.n/n):
+                    tree.accept(np.ravel(theta0), np.ravel(currgrad))
+                    currdensity = tree.tildedensity
+
+            n = n+tree.n
+            s = tree.s*tree.uturnfree()
             j = j +1
+        alfa = tree.alfa
+        nalfa = tree.nalfa
         
        
         if(i <=Madapt):
             if (epsilonwanted is None):
-                Hhat = (1.0-1.0/(i+t0))*Hhat + 1.0/(i+t0)*(delta - alfa/nalfa)
-                epsilon = np.exp(myy -np.sqrt(i)/gamma*Hhat)
-                epsilonhat = np.exp(i**(-kappa)*np.log(epsilon)+(1.0-i**(-kappa))*np.log(epsilonhat))
+                ia = i - restart
+                Hhat = (1.0-1.0/(ia+t0))*Hhat + 1.0/(ia+t0)*(delta - alfa/nalfa)
+                epsilon = np.exp(myy -np.sqrt(ia)/gamma*Hhat)
+                epsilonhat = np.exp(ia**(-kappa)*np.log(epsilon)+(1.0-ia**(-kappa))*np.log(epsilonhat))
+            # At the end of a slow window of the warmup the metric is updated and the step size adaptation is restarted.
+            if (adaptation is not None and adaptation.add(theta0)):
+                metric = adaptation.metric
+                tree.metric = metric
+                if (epsilonwanted is None):
+                    epsilon = initialeps(theta0,Q,currdensity,currgrad,metric)
+                    myy = np.log(10*epsilon)
+                    Hhat = 0.0
+                    epsilonhat = 1.0
+                    restart = i
 
         else:
             epsilon = epsilonhat
             cmestimate = 1.0 / ((i-Madapt)) * ((i-Madapt-1) * cmestimate + theta0)
             
-        if ((istep>1) and (i%istep == 0)):
-            savechain(theta[:,0:i//thinning],intername)    
+        if (stats is not None and i > sburn):
+            stats.update(theta0)
+        if(sink is not None and (i%thinning == 0)):
+            sink.store(i//thinning, theta0)
+        if (sink is not None and (istep>1) and (i%istep == 0)):
+            sink.flush()
+        if (stopping is not None and stopping.check(stats, i)):
+            break
     
     bar.close()
     print ("Final epsilon: " +  str(np.ravel(epsilon)))
+    theta = None
+    if sink is not None:
+        theta = sink.close(truncate=stopping is not None)
     if(cmonly == False):
         return cmestimate,theta
     else:
@@ -450,7 +1020,7 @@ def hmc(M,theta0,Q,Madapt,de=0.6,gamma=0.05,t0=10.0,kappa=0.75,epsilonwanted=Non
 @cython.boundscheck(False) 
 @cython.wraparound(False)
 @cython.cdivision(True)
-def nonuts_hmc(M,theta0,Q,aburn=10,L=50,aexp=50,adaptcoeff=0.6,delta=0.65,cmonly=False,thinning=1,istep=100,intername=time.time()):
+def nonuts_hmc(M,theta0,Q,aburn=10,L=50,aexp=50,adaptcoeff=0.6,delta=0.65,cmonly=False,thinning=1,istep=100,intername=time.time(),chainfile=None,compression='lzf',stats=None,statburnin=None,stopping=None,metric=None,adaptation=None):
     bar = tqdm(total=M,file=sys.stdout)
     theta0 = np.reshape(theta0,(-1,1))
     dim = theta0.shape[0]
@@ -458,28 +1028,36 @@ def nonuts_hmc(M,theta0,Q,aburn=10,L=50,aexp=50,adaptcoeff=0.6,delta=0.65,cmonly
     x = theta0
     acc = 0;
     ratio = 0;
+    restart = 0
     E = float(Q.logdensity(x, Q))
     currgrad = Q.gradi(x, Q)
    
-    epsilon = initialeps(x,Q,E,currgrad)
+    if (adaptation is not None and metric is None):
+        metric = adaptation.metric
+    epsilon = initialeps(x,Q,E,currgrad,metric)
     
     if (aburn >= M):
         raise Exception('Madapt <= M.')
         
-    if (cmonly == False):
-        theta = np.zeros((dim, M//thinning + 1))
-        theta[:, 0] = np.ravel(x)  
+    sburn = aburn if statburnin is None else statburnin
+    if (stopping is not None):
+        stopping.begin()
+        if stats is None:
+            stats = posteriorstats(dim, quantiles=())
+    sink = samplesink(dim, M//thinning + 1, cmonly, chainfile, istep, intername, compression)
+    if sink is not None:
+        sink.store(0, x)
 
     for k in range(M):
         bar.update(1)
-        p = np.random.randn(dim, 1)
+        p = drawmomentum(dim, metric)
 
         x_old = np.copy(x);
         p_old = np.copy(p);
 
         # Recalculate Hamiltonian
         E_old = E;
-        H_old = float(E_old - 0.5 * np.dot(p.T,p));
+        H_old = float(E_old - kinetic(p, metric));
 
         # First half-step of leapfrog.
         grad = Q.gradi(x, Q);
@@ -487,7 +1065,7 @@ def nonuts_hmc(M,theta0,Q,aburn=10,L=50,aexp=50,adaptcoeff=0.6,delta=0.65,cmonly
 
         # Full leapfrog steps.
         for n in range(L):
-            x = x + epsilon*p;
+            x = x + positionstep(p, epsilon, metric);
 
             if n < L-1:
                 grad = Q.gradi(x, Q);
@@ -500,7 +1078,7 @@ def nonuts_hmc(M,theta0,Q,aburn=10,L=50,aexp=50,adaptcoeff=0.6,delta=0.65,cmonly
 
         # Energy and Hamiltonian
         E = float(Q.logdensity(x, Q))
-        H =  float(E - 0.5 * np.dot(p.T,p));
+        H =  float(E - kinetic(p, metric));
 
         a = (H  -H_old);
         print(k,epsilon,acc/(k+1))
@@ -520,20 +1098,29 @@ def nonuts_hmc(M,theta0,Q,aburn=10,L=50,aexp=50,adaptcoeff=0.6,delta=0.65,cmonly
             ratio = adaptcoeff * ratio + (1 - adaptcoeff) * curr_acc;
             # Adapt epsilon 
 
-            cntl = 0.5 * np.exp(-(k+1) / aexp); # Diminishing adaptation
+            cntl = 0.5 * np.exp(-(k-restart+1) / aexp); # Diminishing adaptation
             epsilon = np.exp(np.log(epsilon) + cntl * (ratio - delta));
             
             cmestimate = 1.0 / ((k-aburn)) * ((k-aburn-1) * cmestimate + x)
 
         else:
             ratio = acc / (k+1);
+            # A new metric restarts the step size adaptation.
+            if (adaptation is not None and adaptation.add(x)):
+                metric = adaptation.metric
+                epsilon = initialeps(x,Q,E,Q.gradi(x, Q),metric)
+                restart = k
             
             
-        if(cmonly == False and (k%thinning == 0)):
-            theta[:, k//thinning] = np.ravel(x)
+        if (stats is not None and k > sburn):
+            stats.update(x)
+        if(sink is not None and (k%thinning == 0)):
+            sink.store(k//thinning, x)
             
-        if ((istep>1) and (k%istep == 0)):
-            savechain(theta[:,0:k//thinning],intername)    
+        if (sink is not None and (istep>1) and (k%istep == 0)):
+            sink.flush()
+        if (stopping is not None and stopping.check(stats, k+1)):
+            break
             
 
     
@@ -541,6 +1128,9 @@ def nonuts_hmc(M,theta0,Q,aburn=10,L=50,aexp=50,adaptcoeff=0.6,delta=0.65,cmonly
 
     print ("Final epsilon: " +  str(np.ravel(epsilon)))
 
+    theta = None
+    if sink is not None:
+        theta = sink.close(truncate=stopping is not None)
     if(cmonly == False):
         return cmestimate,theta
     else:
@@ -549,13 +1139,13 @@ def nonuts_hmc(M,theta0,Q,aburn=10,L=50,aexp=50,adaptcoeff=0.6,delta=0.65,cmonly
 @cython.boundscheck(False) 
 @cython.wraparound(False)
 @cython.cdivision(True)
-def leapfrogL(theta,r,epsilon,L,Q,mass):
+def leapfrogL(theta,r,epsilon,L,Q,mass,metric=None):
     grad = Q.gradi(theta, Q);
     r = r + 0.5 * epsilon*grad;
 
     # Full leapfrog steps.
     for n in range(L):
-        theta = theta + epsilon/mass*r;
+        theta = theta + positionstep(r, epsilon, metric, mass);
 
         if n < L-1:
             grad = Q.gradi(theta, Q);
@@ -572,15 +1162,15 @@ def leapfrogL(theta,r,epsilon,L,Q,mass):
 @cython.boundscheck(False) 
 @cython.wraparound(False)
 @cython.cdivision(True)
-def longestbatch(theta,r,epsilon,L,Q,mass):
+def longestbatch(theta,r,epsilon,L,Q,mass,metric=None):
     l = 0
     thetaplus = (theta)
     rplus = (r)
     thetatilde = np.copy(theta)
     rtilde = np.copy(r)
-    while (np.dot((thetaplus - theta).T,rplus)) >=0:
+    while (np.dot((thetaplus - theta).T,rplus if metric is None else metric.velocity(rplus))) >=0:
         l = l +1
-        thetaplus,rplus = leapfrogL(thetaplus,rplus,epsilon,1,Q,mass)
+        thetaplus,rplus = leapfrogL(thetaplus,rplus,epsilon,1,Q,mass,metric)
         if l == L:
             thetatilde = np.copy(thetaplus)
             rtilde = np.copy(rplus)
@@ -590,7 +1180,7 @@ def longestbatch(theta,r,epsilon,L,Q,mass):
 @cython.boundscheck(False) 
 @cython.wraparound(False)
 @cython.cdivision(True)
-def ehmc(M,theta0,Q,Madapt,L=50,delta=0.65,gamma=0.05,t0=10.0,kappa=0.75,cmonly=False,thinning=1,mass=1,stepsize=None,istep=100,intername=time.time()):
+def ehmc(M,theta0,Q,Madapt,L=50,delta=0.65,gamma=0.05,t0=10.0,kappa=0.75,cmonly=False,thinning=1,mass=1,stepsize=None,istep=100,intername=time.time(),chainfile=None,compression='lzf',stats=None,statburnin=None,stopping=None,metric=None,adaptation=None):
     Ltrials = np.int(np.floor(Madapt/2))
     epstrials = np.int(np.ceil(Madapt/2))
     bar = tqdm(total=M+Ltrials+epstrials,file=sys.stdout)
@@ -607,31 +1197,39 @@ def ehmc(M,theta0,Q,Madapt,L=50,delta=0.65,gamma=0.05,t0=10.0,kappa=0.75,cmonly=
     currgrad = Q.gradi(theta0, Q)
     L_list = np.zeros((Ltrials,))
     
+    if (adaptation is not None and metric is None):
+        metric = adaptation.metric
     if stepsize is  None:
-        epsilon = initialeps(theta0,Q,E,currgrad)
+        epsilon = initialeps(theta0,Q,E,currgrad,metric)
     else:
         epsilon = stepsize
     myy = np.log(10*epsilon)
     Hhat = 0.0
+    restart = 0
     #lambdhat = 1.0
     #lambd = L*epsilon
         
-    if (cmonly == False):
-        theta = np.zeros((dim, M//thinning + 1))
-        theta[:, 0] = np.ravel(theta0)  
+    sburn = 0 if statburnin is None else statburnin
+    if (stopping is not None):
+        stopping.begin()
+        if stats is None:
+            stats = posteriorstats(dim, quantiles=())
+    sink = samplesink(dim, M//thinning + 1, cmonly, chainfile, istep, intername, compression)
+    if sink is not None:
+        sink.store(0, theta0)
     if (stepsize is None): 
         for i in range(1,epstrials):
             bar.update(1)
-            p = np.sqrt(mass)*np.random.randn(dim, 1)
+            p = drawmomentum(dim, metric, mass)
             x_old = np.copy(x);
             E_old = float(E);
-            H_old = float(E - 0.5/mass * np.dot(p.T,p));
-            thetatilde, rtilde, Li = longestbatch(x,p,epsilon,L,Q,mass)
+            H_old = float(E - kinetic(p, metric, mass));
+            thetatilde, rtilde, Li = longestbatch(x,p,epsilon,L,Q,mass,metric)
             if (Li < L):
-                thetatilde, rtilde = leapfrogL(thetatilde,rtilde,epsilon,L-Li,Q,mass)
+                thetatilde, rtilde = leapfrogL(thetatilde,rtilde,epsilon,L-Li,Q,mass,metric)
 
             E = float(Q.logdensity(thetatilde, Q))
-            H = float(E - 0.5/mass * np.dot(rtilde.T,rtilde))
+            H = float(E - kinetic(rtilde, metric, mass))
 
             curr_acc = 0
             #test_ratio = np.min(np.array([1,np.exp(H-H_old)]))
@@ -647,8 +1245,13 @@ def ehmc(M,theta0,Q,Madapt,L=50,delta=0.65,gamma=0.05,t0=10.0,kappa=0.75,cmonly=
 
             # Adapt epsilon 
             ratio = adaptcoeff * ratio + (1 - adaptcoeff) * curr_acc;
-            cntl = 0.5 * np.exp(-(i+1) / aexp); # Diminishing adaptation
+            cntl = 0.5 * np.exp(-(i-restart+1) / aexp); # Diminishing adaptation
             epsilon = np.exp(np.log(epsilon) + cntl * (ratio - delta));
+            # A new metric restarts the step size adaptation.
+            if (adaptation is not None and adaptation.add(x)):
+                metric = adaptation.metric
+                epsilon = initialeps(x,Q,float(Q.logdensity(x, Q)),Q.gradi(x, Q),metric)
+                restart = i
 
 
             #Hhat = (1.0-1.0/(i+t0))*Hhat + 1.0/(i+t0)*(delta - test_ratio)
@@ -668,17 +1271,17 @@ def ehmc(M,theta0,Q,Madapt,L=50,delta=0.65,gamma=0.05,t0=10.0,kappa=0.75,cmonly=
     for i in range(Ltrials):
         bar.update(1)
         
-        p = np.sqrt(mass)*np.random.randn(dim, 1)
+        p = drawmomentum(dim, metric, mass)
         #x_old = np.copy(x);
         E_old = float(E);
-        H_old = float(E - 0.5/mass * np.dot(p.T,p));
+        H_old = float(E - kinetic(p, metric, mass));
         
-        thetatilde, rtilde, Li = longestbatch(x,p,epsilon,L,Q,mass)
+        thetatilde, rtilde, Li = longestbatch(x,p,epsilon,L,Q,mass,metric)
         if (Li < L):
-            thetatilde, rtilde = leapfrogL(thetatilde,rtilde,epsilon,L-Li,Q,mass)
+            thetatilde, rtilde = leapfrogL(thetatilde,rtilde,epsilon,L-Li,Q,mass,metric)
         
         E = float(Q.logdensity(thetatilde, Q))
-        H = float(E - 0.5/mass * np.dot(rtilde.T,rtilde))
+        H = float(E - kinetic(rtilde, metric, mass))
         
         curr_acc = 0
         #test_ratio = np.min(np.array([1,np.exp(H-H_old)]))
@@ -697,13 +1300,13 @@ def ehmc(M,theta0,Q,Madapt,L=50,delta=0.65,gamma=0.05,t0=10.0,kappa=0.75,cmonly=
     E = Q.logdensity(x, Q)
     for k in range(1,M+1):
         bar.update(1)
-        p = np.sqrt(mass)*np.random.randn(dim, 1)
+        p = drawmomentum(dim, metric, mass)
 
         x_old = x;
 
         # Recalculate Hamiltonian
         E_old = float(E);
-        H_old = float(E - 0.5/mass * np.dot(p.T,p));
+        H_old = float(E - kinetic(p, metric, mass));
 
         # First half-step of leapfrog.
         grad = Q.gradi(x, Q);
@@ -713,7 +1316,7 @@ def ehmc(M,theta0,Q,Madapt,L=50,delta=0.65,gamma=0.05,t0=10.0,kappa=0.75,cmonly=
         step = np.int(L_list[step])
         # Full leapfrog steps.
         for n in range(step):
-            x = x + epsilon/mass*p;
+            x = x + positionstep(p, epsilon, metric, mass);
 
             if n < step-1:
                 grad = Q.gradi(x, Q);
@@ -726,7 +1329,7 @@ def ehmc(M,theta0,Q,Madapt,L=50,delta=0.65,gamma=0.05,t0=10.0,kappa=0.75,cmonly=
 
         # Energy and Hamiltonian
         E =  float(Q.logdensity(x, Q))
-        H =  float(E - 0.5/mass * np.dot(p.T,p))
+        H =  float(E - kinetic(p, metric, mass))
 
         a = (H  -H_old);
         #print(k,step)
@@ -744,17 +1347,24 @@ def ehmc(M,theta0,Q,Madapt,L=50,delta=0.65,gamma=0.05,t0=10.0,kappa=0.75,cmonly=
        
         cmestimate = 1.0 / ((k)) * ((k-1) * cmestimate + x)     
             
-        if(cmonly == False and (k%thinning == 0)):
-            theta[:, k//thinning] = np.ravel(x)
+        if (stats is not None and k > sburn):
+            stats.update(x)
+        if(sink is not None and (k%thinning == 0)):
+            sink.store(k//thinning, x)
             
-        if ((istep>1) and (k%istep == 0)):
-            savechain(theta[:,0:k//thinning],intername)    
+        if (sink is not None and (istep>1) and (k%istep == 0)):
+            sink.flush()
+        if (stopping is not None and stopping.check(stats, k)):
+            break
 
     
     bar.close()
 
     print ("Final epsilon: " +  str(np.ravel(epsilon)))
 
+    theta = None
+    if sink is not None:
+        theta = sink.close(truncate=stopping is not None)
     if(cmonly == False):
         return cmestimate,theta
     else:
@@ -763,6 +1373,157 @@ def ehmc(M,theta0,Q,Madapt,L=50,delta=0.65,gamma=0.05,t0=10.0,kappa=0.75,cmonly=
 
 
 
+# Counter-based random numbers (Philox4x32-10) for the MwG samplers. The output is a function of the key and the counter
+# only, so the draws of pixel j on sweep i are the same whichever thread updates the pixel, and no generator state is shared
+# between threads. The 64-bit seed is the key. The counter is (pixel, sweep, 0, stream), so different streams of the
+# same seed are independent, e.g. for chains run side by side.
+cdef inline void philox(unsigned int* ctr, unsigned long long seed, unsigned int* out) noexcept nogil:
+    cdef unsigned int k0 = <unsigned int>(seed & 0xFFFFFFFFULL)
+    cdef unsigned int k1 = <unsigned int>(seed >> 32)
+    cdef unsigned int c0 = ctr[0]
+    cdef unsigned int c1 = ctr[1]
+    cdef unsigned int c2 = ctr[2]
+    cdef unsigned int c3 = ctr[3]
+    cdef unsigned long long p0, p1
+    cdef int r
+    for r in range(10):
+        p0 = <unsigned long long>0xD2511F53U*c0
+        p1 = <unsigned long long>0xCD9E8D57U*c2
+        c0 = <unsigned int>(p1 >> 32) ^ c1 ^ k0
+        c1 = <unsigned int>p1
+        c2 = <unsigned int>(p0 >> 32) ^ c3 ^ k1
+        c3 = <unsigned int>p0
+        k0 = k0 + 0x9E3779B9U
+        k1 = k1 + 0xBB67AE85U
+    out[0] = c0
+    out[1] = c1
+    out[2] = c2
+    out[3] = c3
+
+# Proposal (standard normal, Box-Muller) and acceptance (uniform) draws of pixel j on sweep i.
+@cython.cdivision(True)
+cdef inline void mwgdraws(unsigned long long seed, unsigned int stream, unsigned int j, unsigned int i, double* normal, double* uniform) noexcept nogil:
+    cdef unsigned int ctr[4]
+    cdef unsigned int out[4]
+    cdef double u1, u2
+    ctr[0] = j
+    ctr[1] = i
+    ctr[2] = 0
+    ctr[3] = stream
+    philox(ctr, seed, out)
+    u1 = ((out[0] >> 5)*67108864.0 + (out[1] >> 6) + 1.0)/9007199254740992.0
+    u2 = out[2]/4294967296.0
+    normal[0] = sqrt(-2.0*log(u1))*cos(2.0*M_PI*u2)
+    uniform[0] = out[3]/4294967296.0
+
+# The same draws for n pixels as arrays, for checking the generator from Python.
+def philoxdraws(seed, n, sweep=0, stream=0):
+    cdef int j
+    cdef double a, b
+    normals = np.zeros((n,))
+    uniforms = np.zeros((n,))
+    for j in range(n):
+        mwgdraws(seed, stream, j, sweep, &a, &b)
+        normals[j] = a
+        uniforms[j] = b
+    return normals, uniforms
+
+# Seed for the MwG samplers. If none is given, it is drawn from NumPy's global generator, so np.random.seed still fixes the chain.
+def mwgseed(seed=None):
+    if seed is None:
+        return int(np.random.randint(0, 2**63-1, dtype=np.int64))
+    return int(seed)
+
+# Greedy coloring of the pixels for the parallel MwG sweeps. Two pixels get different colors if they have a common row in
+# any of the given matrices, so the pixels of one color are conditionally independent given the others and can be updated
+# at the same time without changing the stationary distribution. The colors used by each row are kept as a bitset.
+# Returns the start of each color class in order and the pixels sorted by their color.
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def pixelcolors(mats, int dim):
+    cdef int nmat = len(mats)
+    cdef int m, j, k, n, r, w, c
+    cdef int* rows
+    cdef double* vals
+    cdef columnreader A
+    readers = [columnreader(mat) for mat in mats]
+    offsets = np.zeros((nmat+1,), dtype=np.intc)
+    for m in range(nmat):
+        offsets[m+1] = offsets[m] + mats[m].shape[0]
+    cdef int[::1] off = offsets
+    cdef vector[vector[unsigned long long]] used
+    used.resize(offsets[nmat])
+    cdef vector[unsigned long long] forbidden
+    colors = np.zeros((dim,), dtype=np.intc)
+    cdef int[::1] colorv = colors
+    cdef int ncolors = 0
+    for j in range(dim):
+        forbidden.clear()
+        for m in range(nmat):
+            A = readers[m]
+            n = A.fetch(j, 0, &rows, &vals)
+            for k in range(n):
+                r = off[m] + rows[k]
+                if (used[r].size() > forbidden.size()):
+                    forbidden.resize(used[r].size(), 0)
+                for w in range(used[r].size()):
+                    forbidden[w] = forbidden[w] | used[r][w]
+        w = 0
+        while (w < forbidden.size() and forbidden[w] == 0xFFFFFFFFFFFFFFFFULL):
+            w = w + 1
+        c = 64*w
+        if (w < forbidden.size()):
+            while ((forbidden[w] >> (c - 64*w)) & 1ULL):
+                c = c + 1
+        colorv[j] = c
+        if (c >= ncolors):
+            ncolors = c + 1
+        w = c//64
+        for m in range(nmat):
+            A = readers[m]
+            n = A.fetch(j, 0, &rows, &vals)
+            for k in range(n):
+                r = off[m] + rows[k]
+                if (used[r].size() <= w):
+                    used[r].resize(w+1, 0)
+                used[r][w] = used[r][w] | (1ULL << (c - 64*w))
+    order = np.argsort(colors, kind='stable').astype(np.intc)
+    ptr = np.zeros((ncolors+1,), dtype=np.intc)
+    ptr[1:] = np.cumsum(np.bincount(colors, minlength=ncolors))
+    return ptr, order
+
+# Key of the sparsity structure of a matrix for the coloring cache. The stencil operators and empty matrices are built anew
+# for every run, so they are recognised by their kind and shape, and other matrices by their identity.
+def structurekey(A):
+    if isinstance(A, differenceoperator):
+        return ('difference', A.kindname, A.order, A.shape)
+    if (sp.issparse(A) and A.nnz == 0):
+        return ('empty', A.shape)
+    return id(A)
+
+# Color classes of the MwG sweep. The pixels are updated in the colored order also with one thread, so that a chain of
+# a given seed and stream is the same with any number of threads. One thread goes through that order as a single class.
+# The coloring is kept in Q.work (with the matrices, so that their ids stay valid), since the Radon matrix is the same
+# for every run of an instance and coloring it takes about as long as a sweep.
+# The classes are small: two pixels conflict when some ray crosses both, which is the case for 53% of the pixel pairs at
+# 64x64 with 30 angles and 69% at 128x128 with 90 angles, so a class holds only 5-8 pixels on average (220 classes at
+# 32x32 with 20 angles, 541 at 64x64 with 30, 2760 at 128x128 with 90 and 9510 at 256x256 with 180 angles). Coarser units
+# don't help: of spatial blocks of 4x4 pixels every pair is crossed by a common ray already at 64x64 with 30 angles. The
+# samplers therefore open one parallel region per sweep, and the threads only meet at a barrier after every class.
+# Bench.py's 'mwgscaling' part measures the sweeps per second with 1, 2, 4, ... threads.
+def sweeporder(Q, mats, int dim, int Nthreads):
+    key = (dim,) + tuple(structurekey(A) for A in mats)
+    cached = Q.work.get('colors')
+    if (cached is None or cached[0] != key):
+        (ptr, order) = pixelcolors(mats, dim)
+        cached = (key, list(mats), ptr, order)
+        Q.work['colors'] = cached
+    (ptr, order) = (cached[2], cached[3])
+    if (Nthreads == 1):
+        ptr = np.array([0, dim], dtype=np.intc)
+    return (ptr, order)
+
+
 # Metropolis within-Gibbs function for TV prior and Gaussian likelihood.
 # N is the number of samples, Nadapt is the number of SCAM steps, Q is the extra argument instance, 
 # x0 is the initial parameter vector, sampsigma is the initial proposal step size.
@@ -770,8 +1531,10 @@ def ehmc(M,theta0,Q,Madapt,L=50,delta=0.65,gamma=0.05,t0=10.0,kappa=0.75,cmonly=
 @cython.boundscheck(False)
 @cython.wraparound(False) 
 @cython.cdivision(True)
-def mwg_tv(N,Nadapt,Q, x0, sampsigma=1.0,cmonly=False,thinning=10,interstep=100000,intername=time.time()):
+def mwg_tv(N,Nadapt,Q, x0, sampsigma=1.0,cmonly=False,thinning=10,interstep=100000,intername=time.time(),Nthreads=1,seed=None,stream=0,chainfile=None,compression='lzf',stats=None,statburnin=None,stopping=None):
     bar = tqdm(total=N,file=sys.stdout)
+    # The progress bar is updated every barstep sweeps (about 100 updates in all) instead of after every sweep.
+    cdef int barstep = max(1, N//100)
     if (Nadapt >= N):
         raise Exception('Nadapt <= N.')
     
@@ -792,36 +1555,30 @@ def mwg_tv(N,Nadapt,Q, x0, sampsigma=1.0,cmonly=False,thinning=10,interstep=1000
     cdef int dim = dimnumpy
     x = x0
     
-    if not isinstance(M, sp.csc.csc_matrix):
-        M = csc_matrix(M)
-    
-    if not isinstance(Lx, sp.csc.csc_matrix):
-        Lx = csc_matrix(Lx)
-        
-    if not isinstance(Ly, sp.csc.csc_matrix):
-        Ly = csc_matrix(Ly)    
+    cdef columnreader Mc = columnreader(M, Nthreads)
+    cdef columnreader Lxc = columnreader(Lx, Nthreads)
+    cdef columnreader Lyc = columnreader(Ly, Nthreads)
 
     cdef double alpha = regalpha
     cdef double samplingsigma = sampsigma
     cdef double beta = samplebeta
     cdef double Ci = 1.0/lhvariance
     
-    cdef double[:] Mdata =  M.data
-    cdef int[:] Mindices =  M.indices
-    cdef int[:] Mptr =  M.indptr
-    
-    cdef double[:] Lxdata =  Lx.data
-    cdef int[:] Lxindices =  Lx.indices
-    cdef int[:] Lxptr =  Lx.indptr
-    
-    cdef double[:] Lydata =  Ly.data
-    cdef int[:] Lyindices =  Ly.indices
-    cdef int[:] Lyptr =  Ly.indptr
+    cdef int* Mindices
+    cdef double* Mdata
+    cdef int* Lxindices
+    cdef double* Lxdata
+    cdef int* Lyindices
+    cdef double* Lydata
+    cdef int nM, nLx, nLy
  
     
-    if (cm==False):
-        chain = np.zeros((dim, N//thin+1))
-        chain[:,0] = np.ravel(x)
+    sink = samplesink(dim, N//thin+1, cm, chainfile, istep, intername, compression)
+    cdef bint collect = sink is not None
+    cdef int col = 0
+    if collect:
+        sink.store(0, x)
+        chain = sink.buffer
     else:
         chain = np.zeros((dim,1))
     
@@ -839,11 +1596,13 @@ def mwg_tv(N,Nadapt,Q, x0, sampsigma=1.0,cmonly=False,thinning=10,interstep=1000
     cdef int j
     cdef double[:, :] xv = x
     cdef double[:, :] yv = y
-    cdef double new,change, change2, change3, old,currentvalue,currentmean,previousmean,currentvar
+    cdef double new,change, change2, change3, old,currentvalue,currentmean,previousmean,currentvar,ratio,sg
     cdef double[:, :] chainv = chain
   
     cdef int k, start, stop
-    cdef double[:] acceptv,number
+    cdef unsigned long long key = mwgseed(seed)
+    cdef unsigned int strm = stream
+    cdef double number, acceptv
     chmean = np.ravel(np.copy(x0))
     chdev = np.zeros((dim,))
     cdef double[:] chmeanv = chmean
@@ -853,101 +1612,147 @@ def mwg_tv(N,Nadapt,Q, x0, sampsigma=1.0,cmonly=False,thinning=10,interstep=1000
     cdef double[:] values = np.copy(np.ravel(x))
     cdef double[:] cmestimate = cmest
     
+    # Pixels of one color share no rows, so each class is updated in parallel within one parallel region per sweep. The random
+    # numbers are drawn by pixel and sweep (see mwgdraws), hence the chain does not depend on the number of threads.
+    cdef int Nth = Nthreads
+    (cptr, corder) = sweeporder(Q, [M, Lx, Ly], dim, Nth)
+    cdef int[::1] colorptr = cptr
+    cdef int[::1] colororder = corder
+    cdef int ncolors = colorptr.shape[0] - 1
+    cdef int c, jj, th, cstart, cstop
+    if (stopping is not None):
+        stopping.begin()
+        if stats is None:
+            stats = posteriorstats(dim, quantiles=())
+    cdef posteriorstats st = stats
+    cdef int sburn = adapt if statburnin is None else statburnin
+    cdef bint dostats = False
+
     for i in range(1,N+1):
-        randoms = np.random.randn(dim,)
-        accept = np.random.rand(dim,)
-        acceptv = accept
-        number = randoms
-        bar.update(1)
-        with nogil:
-            for j in range(0,dim):
-                old = values[j]
+        if (collect and (i%thin == 0)):
+            col = sink.slot(i//thin)
+        dostats = (st is not None) and (i > sburn)
+        if dostats:
+            st.begin()
+        with nogil, parallel(num_threads=Nth):
+            for c in range(ncolors):
+                cstart = colorptr[c]
+                cstop = colorptr[c+1]
+                for jj in prange(cstart, cstop, schedule='static'):
+                    j = colororder[jj]
+                    th = thid()
+                    Mindices = NULL
+                    Mdata = NULL
+                    Lxindices = NULL
+                    Lxdata = NULL
+                    Lyindices = NULL
+                    Lydata = NULL
+                    nM = Mc.fetch(j, th, &Mindices, &Mdata)
+                    nLx = Lxc.fetch(j, th, &Lxindices, &Lxdata)
+                    nLy = Lyc.fetch(j, th, &Lyindices, &Lydata)
+                    old = values[j]
                
-                currentvalue = old
-                if  (i> 20):
-                    samplingsigma = 2.38*chdevv[j] + 10**(-9)
+                    currentvalue = old
+                    number = 0.0
+                    acceptv = 0.0
+                    mwgdraws(key, strm, j, i, &number, &acceptv)
+                    sg = samplingsigma
+                    if  (i> 20):
+                        sg = 2.38*chdevv[j] + 10**(-9)
                     
-                new = old + samplingsigma*number[j]
+                    new = old + sg*number
 
 
-                change = 0
-                change2 = 0
-                change3 = 0
+                    change = 0
+                    change2 = 0
+                    change3 = 0
 
-                start = Mptr[j]
-                stop = Mptr[j+1]
+                    start = 0
+                    stop = nM
 
-                #for k in prange(start,stop,1,nogil=True):
-                for k in range(start,stop):    
-                    change += -(lhcompv[Mindices[k],0]- yv[Mindices[k],0])**2.0 + (Mdata[k]*(new-old) + lhcompv[Mindices[k],0] - yv[Mindices[k],0])**2.0 
+                    #for k in prange(start,stop,1,nogil=True):
+                    for k in range(start,stop):    
+                        change = change + -(lhcompv[Mindices[k],0]- yv[Mindices[k],0])**2.0 + (Mdata[k]*(new-old) + lhcompv[Mindices[k],0] - yv[Mindices[k],0])**2.0 
  
 
-                start = Lxptr[j]
-                stop = Lxptr[j+1]    
+                    start = 0
+                    stop = nLx
 
-                #for k in prange(start,stop,1,nogil=True):
-                for k in range(start,stop):    
-                    change2 += -fabs(prcompv[Lxindices[k],0] ) + fabs(Lxdata[k]*(new-old) + prcompv[Lxindices[k],0])
+                    #for k in prange(start,stop,1,nogil=True):
+                    for k in range(start,stop):    
+                        change2 = change2 + -fabs(prcompv[Lxindices[k],0] ) + fabs(Lxdata[k]*(new-old) + prcompv[Lxindices[k],0])
 
-                start = Lyptr[j]
-                stop = Lyptr[j+1]    
+                    start = 0
+                    stop = nLy
 
-                #for k in prange(start,stop,1,nogil=True):
-                for k in range(start,stop):    
-                    change3 += -fabs(prcompv2[Lyindices[k],0] ) + fabs(Lydata[k]*(new-old) + prcompv2[Lyindices[k],0])    
+                    #for k in prange(start,stop,1,nogil=True):
+                    for k in range(start,stop):    
+                        change3 = change3 + -fabs(prcompv2[Lyindices[k],0] ) + fabs(Lydata[k]*(new-old) + prcompv2[Lyindices[k],0])    
 
              
-                ratio = exp(-0.5*Ci*change -alpha*change2 - alpha*change3)
-                if(acceptv[j] <= ratio):
-                    values[j] = new
-                    currentvalue = new
-                    start = Lxptr[j]
-                    stop = Lxptr[j+1]    
+                    ratio = exp(-0.5*Ci*change -alpha*change2 - alpha*change3)
+                    if(acceptv <= ratio):
+                        values[j] = new
+                        currentvalue = new
+                        start = 0
+                        stop = nLx
 
-                    #for k in prange(start,stop,1,nogil=True):
-                    for k in range(start,stop):    
-                        prcompv[Lxindices[k],0] = prcompv[Lxindices[k],0] + Lxdata[k]*(new-old)
+                        #for k in prange(start,stop,1,nogil=True):
+                        for k in range(start,stop):    
+                            prcompv[Lxindices[k],0] = prcompv[Lxindices[k],0] + Lxdata[k]*(new-old)
 
-                    start = Lyptr[j]
-                    stop = Lyptr[j+1]    
+                        start = 0
+                        stop = nLy
 
-                    #for k in prange(start,stop,1,nogil=True):
-                    for k in range(start,stop):    
-                        prcompv2[Lyindices[k],0] = prcompv2[Lyindices[k],0] + Lydata[k]*(new-old)    
+                        #for k in prange(start,stop,1,nogil=True):
+                        for k in range(start,stop):    
+                            prcompv2[Lyindices[k],0] = prcompv2[Lyindices[k],0] + Lydata[k]*(new-old)    
 
-                    start = Mptr[j]
-                    stop = Mptr[j+1]
+                        start = 0
+                        stop = nM
 
-                    #for k in prange(start,stop,1,nogil=True):
-                    for k in range(start,stop):     
-                        lhcompv[Mindices[k],0] = lhcompv[Mindices[k],0] + Mdata[k]*(new-old)
+                        #for k in prange(start,stop,1,nogil=True):
+                        for k in range(start,stop):     
+                            lhcompv[Mindices[k],0] = lhcompv[Mindices[k],0] + Mdata[k]*(new-old)
 
-                    #x[j,0] = new
+                        #x[j,0] = new
 
-                else:
-                    values[j] = old
-                    #chainv[j,i] = old
+                    else:
+                        values[j] = old
+                        #chainv[j,i] = old
                     
-                if ((cm==0) and (i%thin == 0)):
-                    chainv[j,i//thin] = values[j]
+                    if (collect and (i%thin == 0)):
+                        chainv[j,col] = values[j]
                     
                     
-                #else:
-                if(i > adapt):
-                    #cmestimate[j]  = 1.0 / ((i+1)) * ((i) * cmestimate[j] + values[j])
-                    cmestimate[j]  = 1.0 / ((i-adapt)) * ((i-adapt-1) * cmestimate[j] + values[j])
-
-                if (i <= adapt):
-                    previousmean = chmeanv[j]
-                    currentmean = 1.0/(i+1.0)*(i*previousmean+currentvalue)
-                    chmeanv[j] = currentmean
-                    currentvar = (i-1.0)/(i)*chdevv[j]*chdevv[j] + 1.0/(i+1.0)*(currentvalue-previousmean)*(currentvalue-previousmean)
-                    chdevv[j] = sqrt(currentvar) 
+                    #else:
+                    if(i > adapt):
+                        #cmestimate[j]  = 1.0 / ((i+1)) * ((i) * cmestimate[j] + values[j])
+                        cmestimate[j]  = 1.0 / ((i-adapt)) * ((i-adapt-1) * cmestimate[j] + values[j])
+
+                    if (i <= adapt):
+                        previousmean = chmeanv[j]
+                        currentmean = 1.0/(i+1.0)*(i*previousmean+currentvalue)
+                        chmeanv[j] = currentmean
+                        currentvar = (i-1.0)/(i)*chdevv[j]*chdevv[j] + 1.0/(i+1.0)*(currentvalue-previousmean)*(currentvalue-previousmean)
+                        chdevv[j] = sqrt(currentvar) 
+                    if dostats:
+                        st.add(j, values[j])
              
-        if ((istep>1) and (i%istep == 0)):
-            savechain(chain[:,0:i//thin],intername)
+        if (collect and (i%thin == 0)):
+            sink.commit(i//thin)
+        if (collect and (istep>1) and (i%istep == 0)):
+            sink.flush()
+        if (i % barstep == 0):
+            bar.update(barstep)
+        if (stopping is not None and stopping.check(st, i)):
+            break
         
+    bar.update(i - bar.n)
     bar.close()
+    chain = None
+    if collect:
+        chain = sink.close(truncate=stopping is not None)
     if(cm):
         return np.reshape(cmest,(-1,1)),None
     else:
@@ -961,8 +1766,10 @@ def mwg_tv(N,Nadapt,Q, x0, sampsigma=1.0,cmonly=False,thinning=10,interstep=1000
 @cython.boundscheck(False)
 @cython.wraparound(False) 
 @cython.cdivision(True)
-def mwg_cauchy(N,Nadapt,Q, x0, sampsigma=1.0,cmonly=False,thinning=10,interstep=100000,intername=time.time()):
+def mwg_cauchy(N,Nadapt,Q, x0, sampsigma=1.0,cmonly=False,thinning=10,interstep=100000,intername=time.time(),Nthreads=1,seed=None,stream=0,chainfile=None,compression='lzf',stats=None,statburnin=None,stopping=None):
     bar = tqdm(total=N,file=sys.stdout)
+    # The progress bar is updated every barstep sweeps (about 100 updates in all) instead of after every sweep.
+    cdef int barstep = max(1, N//100)
     if (Nadapt >= N):
         raise Exception('Nadapt <= N.')
     
@@ -983,36 +1790,30 @@ def mwg_cauchy(N,Nadapt,Q, x0, sampsigma=1.0,cmonly=False,thinning=10,interstep=
     
     cdef int istep = interstep
     
-    if not isinstance(M, sp.csc.csc_matrix):
-        M = csc_matrix(M)
-    
-    if not isinstance(Lx, sp.csc.csc_matrix):
-        Lx = csc_matrix(Lx)
-        
-    if not isinstance(Ly, sp.csc.csc_matrix):
-        Ly = csc_matrix(Ly)    
+    cdef columnreader Mc = columnreader(M, Nthreads)
+    cdef columnreader Lxc = columnreader(Lx, Nthreads)
+    cdef columnreader Lyc = columnreader(Ly, Nthreads)
 
     cdef double alpha = regalpha
     cdef double samplingsigma = sampsigma
     cdef double beta = samplebeta
     cdef double Ci = 1.0/lhvariance
     
-    cdef double[:] Mdata =  M.data
-    cdef int[:] Mindices =  M.indices
-    cdef int[:] Mptr =  M.indptr
-    
-    cdef double[:] Lxdata =  Lx.data
-    cdef int[:] Lxindices =  Lx.indices
-    cdef int[:] Lxptr =  Lx.indptr
-    
-    cdef double[:] Lydata =  Ly.data
-    cdef int[:] Lyindices =  Ly.indices
-    cdef int[:] Lyptr =  Ly.indptr
+    cdef int* Mindices
+    cdef double* Mdata
+    cdef int* Lxindices
+    cdef double* Lxdata
+    cdef int* Lyindices
+    cdef double* Lydata
+    cdef int nM, nLx, nLy
  
    
-    if (cm==0):
-        chain = np.zeros((dim, N//thin+1))
-        chain[:,0] = np.ravel(x)
+    sink = samplesink(dim, N//thin+1, cm, chainfile, istep, intername, compression)
+    cdef bint collect = sink is not None
+    cdef int col = 0
+    if collect:
+        sink.store(0, x)
+        chain = sink.buffer
     else:
         chain = np.zeros((dim,1))
     
@@ -1029,11 +1830,13 @@ def mwg_cauchy(N,Nadapt,Q, x0, sampsigma=1.0,cmonly=False,thinning=10,interstep=
     cdef int j
     cdef double[:, :] xv = x
     cdef double[:, :] yv = y
-    cdef double new,change, change2, change3, old,currentvalue,currentmean,previousmean,currentvar
+    cdef double new,change, change2, change3, old,currentvalue,currentmean,previousmean,currentvar,ratio,sg
     cdef double[:, :] chainv = chain
   
     cdef int k, start, stop
-    cdef double[:] acceptv,number
+    cdef unsigned long long key = mwgseed(seed)
+    cdef unsigned int strm = stream
+    cdef double number, acceptv
     chmean = np.ravel(np.copy(x0))
     chdev = np.zeros((dim,))
     cdef double[:] chmeanv = chmean
@@ -1043,96 +1846,142 @@ def mwg_cauchy(N,Nadapt,Q, x0, sampsigma=1.0,cmonly=False,thinning=10,interstep=
     cdef double[:] values = np.ravel(np.copy(x))
     cdef double[:] cmestimate = cmest
 
+    # Pixels of one color share no rows, so each class is updated in parallel within one parallel region per sweep. The random
+    # numbers are drawn by pixel and sweep (see mwgdraws), hence the chain does not depend on the number of threads.
+    cdef int Nth = Nthreads
+    (cptr, corder) = sweeporder(Q, [M, Lx, Ly], dim, Nth)
+    cdef int[::1] colorptr = cptr
+    cdef int[::1] colororder = corder
+    cdef int ncolors = colorptr.shape[0] - 1
+    cdef int c, jj, th, cstart, cstop
+    if (stopping is not None):
+        stopping.begin()
+        if stats is None:
+            stats = posteriorstats(dim, quantiles=())
+    cdef posteriorstats st = stats
+    cdef int sburn = adapt if statburnin is None else statburnin
+    cdef bint dostats = False
+
     for i in range(1,N+1):
-        bar.update(1)
-        randoms = np.random.randn(dim,)
-        accept = np.random.rand(dim,)
-        acceptv = accept
-        number = randoms
         #1.542724
-        with nogil:
-            for j in range(0,dim):
-
-                old = values[j]
-                currentvalue = old
-                if  (i> 20):
-                    samplingsigma = 2.38*chdevv[j] + 10**(-9)
-                new = old + samplingsigma*number[j]
-
-
-                change = 0
-                change2 = 1
-                change3 = 1
-
-                start = Mptr[j]
-                stop = Mptr[j+1]
+        if (collect and (i%thin == 0)):
+            col = sink.slot(i//thin)
+        dostats = (st is not None) and (i > sburn)
+        if dostats:
+            st.begin()
+        with nogil, parallel(num_threads=Nth):
+            for c in range(ncolors):
+                cstart = colorptr[c]
+                cstop = colorptr[c+1]
+                for jj in prange(cstart, cstop, schedule='static'):
+                    j = colororder[jj]
+                    th = thid()
+                    Mindices = NULL
+                    Mdata = NULL
+                    Lxindices = NULL
+                    Lxdata = NULL
+                    Lyindices = NULL
+                    Lydata = NULL
+                    nM = Mc.fetch(j, th, &Mindices, &Mdata)
+                    nLx = Lxc.fetch(j, th, &Lxindices, &Lxdata)
+                    nLy = Lyc.fetch(j, th, &Lyindices, &Lydata)
+
+                    old = values[j]
+                    currentvalue = old
+                    number = 0.0
+                    acceptv = 0.0
+                    mwgdraws(key, strm, j, i, &number, &acceptv)
+                    sg = samplingsigma
+                    if  (i> 20):
+                        sg = 2.38*chdevv[j] + 10**(-9)
+                    new = old + sg*number
+
+
+                    change = 0
+                    change2 = 1
+                    change3 = 1
+
+                    start = 0
+                    stop = nM
 
-                #for k in prange(start,stop,1):
-                for k in range(start,stop):    
-                    change += -(lhcompv[Mindices[k],0]- yv[Mindices[k],0])**2.0 + (Mdata[k]*(new-old) + lhcompv[Mindices[k],0] - yv[Mindices[k],0])**2.0 
+                    #for k in prange(start,stop,1):
+                    for k in range(start,stop):    
+                        change = change + -(lhcompv[Mindices[k],0]- yv[Mindices[k],0])**2.0 + (Mdata[k]*(new-old) + lhcompv[Mindices[k],0] - yv[Mindices[k],0])**2.0 
 
-                start = Lxptr[j]
-                stop = Lxptr[j+1]    
+                    start = 0
+                    stop = nLx
 
-                #for k in prange(start,stop,1,nogil=True):
-                for k in range(start,stop):    
-                    change2 *=  (alpha+(prcompv[Lxindices[k],0])**2.0)/(alpha+(Lxdata[k]*(new-old) + prcompv[Lxindices[k],0])**2.0)
+                    #for k in prange(start,stop,1,nogil=True):
+                    for k in range(start,stop):    
+                        change2 = change2*( (alpha+(prcompv[Lxindices[k],0])**2.0)/(alpha+(Lxdata[k]*(new-old) + prcompv[Lxindices[k],0])**2.0))
 
-                start = Lyptr[j]
-                stop = Lyptr[j+1]    
+                    start = 0
+                    stop = nLy
 
-                #for k in prange(start,stop,1,nogil=True):
-                for k in range(start,stop):    
-                    change3 *= (alpha+(prcompv2[Lyindices[k],0])**2.0) /(alpha+(Lydata[k]*(new-old) + prcompv2[Lyindices[k],0])**2.0)
+                    #for k in prange(start,stop,1,nogil=True):
+                    for k in range(start,stop):    
+                        change3 = change3*((alpha+(prcompv2[Lyindices[k],0])**2.0) /(alpha+(Lydata[k]*(new-old) + prcompv2[Lyindices[k],0])**2.0))
 
 
-                ratio = exp(-0.5*Ci*change)*change2*change3
-                if(acceptv[j] <= ratio):
-                    values[j] = new
-                    currentvalue = new
-                    start = Lxptr[j]
-                    stop = Lxptr[j+1]    
+                    ratio = exp(-0.5*Ci*change)*change2*change3
+                    if(acceptv <= ratio):
+                        values[j] = new
+                        currentvalue = new
+                        start = 0
+                        stop = nLx
 
-                    #for k in prange(start,stop,1,nogil=True):
-                    for k in range(start,stop):    
-                        prcompv[Lxindices[k],0] = prcompv[Lxindices[k],0] + Lxdata[k]*(new-old)
+                        #for k in prange(start,stop,1,nogil=True):
+                        for k in range(start,stop):    
+                            prcompv[Lxindices[k],0] = prcompv[Lxindices[k],0] + Lxdata[k]*(new-old)
 
-                    start = Lyptr[j]
-                    stop = Lyptr[j+1]    
+                        start = 0
+                        stop = nLy
 
-                    #for k in prange(start,stop,1,nogil=True):
-                    for k in range(start,stop):    
-                        prcompv2[Lyindices[k],0] = prcompv2[Lyindices[k],0] + Lydata[k]*(new-old)    
+                        #for k in prange(start,stop,1,nogil=True):
+                        for k in range(start,stop):    
+                            prcompv2[Lyindices[k],0] = prcompv2[Lyindices[k],0] + Lydata[k]*(new-old)    
 
-                    start = Mptr[j]
-                    stop = Mptr[j+1]
+                        start = 0
+                        stop = nM
 
-                    #for k in prange(start,stop,1):
-                    for k in range(start,stop):     
-                        lhcompv[Mindices[k],0] = lhcompv[Mindices[k],0] + Mdata[k]*(new-old)
+                        #for k in prange(start,stop,1):
+                        for k in range(start,stop):     
+                            lhcompv[Mindices[k],0] = lhcompv[Mindices[k],0] + Mdata[k]*(new-old)
 
 
-                else:
-                    values[j] = old
+                    else:
+                        values[j] = old
                     
-                if ((cm==0) and (i%thin == 0)):
-                    chainv[j,i//thin] = values[j]
-                #else:
-                if(i > adapt):
-                    #cmestimate[j]  = 1.0 / ((i+1)) * ((i) * cmestimate[j] + values[j])
-                    cmestimate[j]  = 1.0 / ((i-adapt)) * ((i-adapt-1) * cmestimate[j] + values[j])
+                    if (collect and (i%thin == 0)):
+                        chainv[j,col] = values[j]
+                    #else:
+                    if(i > adapt):
+                        #cmestimate[j]  = 1.0 / ((i+1)) * ((i) * cmestimate[j] + values[j])
+                        cmestimate[j]  = 1.0 / ((i-adapt)) * ((i-adapt-1) * cmestimate[j] + values[j])
                 
-                if (i <= adapt):
-                    previousmean = chmeanv[j]
-                    currentmean = 1.0/(i+1.0)*(i*previousmean+currentvalue)
-                    chmeanv[j] = currentmean
-                    currentvar = (i-1.0)/(i)*chdevv[j]*chdevv[j]+ 1.0/(i+1.0)*(currentvalue-previousmean)*(currentvalue-previousmean)
-                    chdevv[j] = sqrt(currentvar)
+                    if (i <= adapt):
+                        previousmean = chmeanv[j]
+                        currentmean = 1.0/(i+1.0)*(i*previousmean+currentvalue)
+                        chmeanv[j] = currentmean
+                        currentvar = (i-1.0)/(i)*chdevv[j]*chdevv[j]+ 1.0/(i+1.0)*(currentvalue-previousmean)*(currentvalue-previousmean)
+                        chdevv[j] = sqrt(currentvar)
+                    if dostats:
+                        st.add(j, values[j])
                     
-        if ((istep>1) and (i%istep == 0)):
-            savechain(chain[:,0:i//thin],intername)            
+        if (collect and (i%thin == 0)):
+            sink.commit(i//thin)
+        if (collect and (istep>1) and (i%istep == 0)):
+            sink.flush()
+        if (i % barstep == 0):
+            bar.update(barstep)
+        if (stopping is not None and stopping.check(st, i)):
+            break
                     
-    bar.close()     
+    bar.update(i - bar.n)
+    bar.close()
+    chain = None
+    if collect:
+        chain = sink.close(truncate=stopping is not None)
     if(cm):
         return np.reshape(cmest,(-1,1)),None
     else:
@@ -1142,8 +1991,10 @@ def mwg_cauchy(N,Nadapt,Q, x0, sampsigma=1.0,cmonly=False,thinning=10,interstep=
 @cython.boundscheck(False)
 @cython.wraparound(False) 
 @cython.cdivision(True)
-def mwg_isocauchy(N,Nadapt,Q, x0, sampsigma=1.0,cmonly=False,thinning=10,interstep=100000,intername=time.time()):
+def mwg_isocauchy(N,Nadapt,Q, x0, sampsigma=1.0,cmonly=False,thinning=10,interstep=100000,intername=time.time(),Nthreads=1,seed=None,stream=0,chainfile=None,compression='lzf',stats=None,statburnin=None,stopping=None):
     bar = tqdm(total=N,file=sys.stdout)
+    # The progress bar is updated every barstep sweeps (about 100 updates in all) instead of after every sweep.
+    cdef int barstep = max(1, N//100)
     if (Nadapt >= N):
         raise Exception('Nadapt <= N.')
     
@@ -1165,14 +2016,9 @@ def mwg_isocauchy(N,Nadapt,Q, x0, sampsigma=1.0,cmonly=False,thinning=10,interst
     
     cdef int istep = interstep
     
-    if not isinstance(M, sp.csc.csc_matrix):
-        M = csc_matrix(M)
-    
-    if not isinstance(Lx, sp.csc.csc_matrix):
-        Lx = csc_matrix(Lx)
-        
-    if not isinstance(Ly, sp.csc.csc_matrix):
-        Ly = csc_matrix(Ly)    
+    cdef columnreader Mc = columnreader(M, Nthreads)
+    cdef columnreader Lxc = columnreader(Lx, Nthreads)
+    cdef columnreader Lyc = columnreader(Ly, Nthreads)
 
     cdef double alpha = regalpha
     cdef double alphab = Q.boundarya
@@ -1180,31 +2026,33 @@ def mwg_isocauchy(N,Nadapt,Q, x0, sampsigma=1.0,cmonly=False,thinning=10,interst
     cdef double beta = samplebeta
     cdef double Ci = 1.0/lhvariance
     
-    cdef double[:] Mdata =  M.data
-    cdef int[:] Mindices =  M.indices
-    cdef int[:] Mptr =  M.indptr
-    
-    cdef double[:] Bdata =  B.data
-    cdef int[:] Bindices =  B.indices
-    cdef int[:] Bptr =  B.indptr
-    
-    cdef double[:] Lxdata =  Lx.data
-    cdef int[:] Lxindices =  Lx.indices
-    cdef int[:] Lxptr =  Lx.indptr
+    cdef int* Mindices
+    cdef double* Mdata
+    cdef int* Bindices
+    cdef double* Bdata
+    cdef int* Lxindices
+    cdef double* Lxdata
+    cdef int* Lyindices
+    cdef double* Lydata
+    cdef int* Auindices
+    cdef double* Audata
+    cdef int nM, nB, nLx, nLy, nAu
+    cdef columnreader Bc = columnreader(B, Nthreads)
     
-    cdef double[:] Lydata =  Ly.data
-    cdef int[:] Lyindices =  Ly.indices
-    cdef int[:] Lyptr =  Ly.indptr
-    
-    auxm = csc_matrix(np.abs(Lx) + np.abs(Ly))
-    cdef double[:] Audata = auxm.data
-    cdef int[:] Auindices =  auxm.indices
-    cdef int[:] Auptr =  auxm.indptr
+    # The rows of Lx and Ly which depend on a pixel.
+    if isinstance(Lx, differenceoperator):
+        auxm = differenceoperator(Lx.size, 'neighbours')
+    else:
+        auxm = csc_matrix(np.abs(Lx) + np.abs(Ly))
+    cdef columnreader Auc = columnreader(auxm, Nthreads)
  
    
-    if (cm==0):
-        chain = np.zeros((dim, N//thin+1))
-        chain[:,0] = np.ravel(x)
+    sink = samplesink(dim, N//thin+1, cm, chainfile, istep, intername, compression)
+    cdef bint collect = sink is not None
+    cdef int col = 0
+    if collect:
+        sink.store(0, x)
+        chain = sink.buffer
     else:
         chain = np.zeros((dim,1))
     
@@ -1230,11 +2078,13 @@ def mwg_isocauchy(N,Nadapt,Q, x0, sampsigma=1.0,cmonly=False,thinning=10,interst
     cdef int j
     cdef double[:, :] xv = x
     cdef double[:, :] yv = y
-    cdef double new,change, change2, change3, old,currentvalue,currentmean,previousmean,currentvar
+    cdef double new,change, change2, change3, old,currentvalue,currentmean,previousmean,currentvar,ratio,sg
     cdef double[:, :] chainv = chain
   
     cdef int k, start, stop
-    cdef double[:] acceptv,number
+    cdef unsigned long long key = mwgseed(seed)
+    cdef unsigned int strm = stream
+    cdef double number, acceptv
     chmean = np.ravel(np.copy(x0))
     chdev = np.zeros((dim,))
     cdef double[:] chmeanv = chmean
@@ -1244,137 +2094,189 @@ def mwg_isocauchy(N,Nadapt,Q, x0, sampsigma=1.0,cmonly=False,thinning=10,interst
     cdef double[:] values = np.ravel(np.copy(x))
     cdef double[:] cmestimate = cmest
 
+    # Pixels of one color share no rows, so each class is updated in parallel within one parallel region per sweep. The random
+    # numbers are drawn by pixel and sweep (see mwgdraws), hence the chain does not depend on the number of threads.
+    cdef int Nth = Nthreads
+    (cptr, corder) = sweeporder(Q, [M, Lx, Ly, B, auxm], dim, Nth)
+    cdef int[::1] colorptr = cptr
+    cdef int[::1] colororder = corder
+    cdef int ncolors = colorptr.shape[0] - 1
+    cdef int c, jj, th, cstart, cstop
+    if (stopping is not None):
+        stopping.begin()
+        if stats is None:
+            stats = posteriorstats(dim, quantiles=())
+    cdef posteriorstats st = stats
+    cdef int sburn = adapt if statburnin is None else statburnin
+    cdef bint dostats = False
+
     for i in range(1,N+1):
-        bar.update(1)
-        randoms = np.random.randn(dim,) # 1.0*np.arange(dim,)+1
-        accept = np.random.rand(dim,)
-        acceptv = accept
-        number = randoms
         #1.542724
-        with nogil:
-            for j in range(0,dim):
-
-                old = values[j]
-                currentvalue = old
-                if  (i> 20):
-                    samplingsigma = 2.38*chdevv[j] + 10**(-9)
-                new = old + samplingsigma*number[j]
-
-
-                change = 0
-                change2 = 1
-                change3 = 1
+        if (collect and (i%thin == 0)):
+            col = sink.slot(i//thin)
+        dostats = (st is not None) and (i > sburn)
+        if dostats:
+            st.begin()
+        with nogil, parallel(num_threads=Nth):
+            for c in range(ncolors):
+                cstart = colorptr[c]
+                cstop = colorptr[c+1]
+                for jj in prange(cstart, cstop, schedule='static'):
+                    j = colororder[jj]
+                    th = thid()
+                    Mindices = NULL
+                    Mdata = NULL
+                    Lxindices = NULL
+                    Lxdata = NULL
+                    Lyindices = NULL
+                    Lydata = NULL
+                    Bindices = NULL
+                    Bdata = NULL
+                    Auindices = NULL
+                    Audata = NULL
+                    nM = Mc.fetch(j, th, &Mindices, &Mdata)
+                    nLx = Lxc.fetch(j, th, &Lxindices, &Lxdata)
+                    nLy = Lyc.fetch(j, th, &Lyindices, &Lydata)
+                    nB = Bc.fetch(j, th, &Bindices, &Bdata)
+                    nAu = Auc.fetch(j, th, &Auindices, &Audata)
+
+                    old = values[j]
+                    currentvalue = old
+                    number = 0.0
+                    acceptv = 0.0
+                    mwgdraws(key, strm, j, i, &number, &acceptv)
+                    sg = samplingsigma
+                    if  (i> 20):
+                        sg = 2.38*chdevv[j] + 10**(-9)
+                    new = old + sg*number
+
+
+                    change = 0
+                    change2 = 1
+                    change3 = 1
                 
-                start = Lxptr[j]
-                stop = Lxptr[j+1]
+                    start = 0
+                    stop = nLx
 
-                #for k in prange(start,stop,1):
-                for k in range(start,stop):    
-                    Axx[Lxindices[k],0] = Lxdata[k]*(new-old) + Lxx[Lxindices[k],0] 
+                    #for k in prange(start,stop,1):
+                    for k in range(start,stop):    
+                        Axx[Lxindices[k],0] = Lxdata[k]*(new-old) + Lxx[Lxindices[k],0] 
                     
-                start = Lyptr[j]
-                stop = Lyptr[j+1]
+                    start = 0
+                    stop = nLy
 
-                #for k in prange(start,stop,1):
-                for k in range(start,stop):    
-                    Ayx[Lyindices[k],0] = Lydata[k]*(new-old) + Lyx[Lyindices[k],0]     
+                    #for k in prange(start,stop,1):
+                    for k in range(start,stop):    
+                        Ayx[Lyindices[k],0] = Lydata[k]*(new-old) + Lyx[Lyindices[k],0]     
 
-                start = Mptr[j]
-                stop = Mptr[j+1]
+                    start = 0
+                    stop = nM
 
-                #for k in prange(start,stop,1):
-                for k in range(start,stop):    
-                    change += -(Mx[Mindices[k],0]- yv[Mindices[k],0])**2.0 + (Mdata[k]*(new-old) + Mx[Mindices[k],0] - yv[Mindices[k],0])**2.0 
+                    #for k in prange(start,stop,1):
+                    for k in range(start,stop):    
+                        change = change + -(Mx[Mindices[k],0]- yv[Mindices[k],0])**2.0 + (Mdata[k]*(new-old) + Mx[Mindices[k],0] - yv[Mindices[k],0])**2.0 
 
-                start = Auptr[j]
-                stop = Auptr[j+1]    
+                    start = 0
+                    stop = nAu
 
-                #for k in prange(start,stop,1,nogil=True):
-                for k in range(start,stop):    
-                    change2 *=  (alpha+(Lxx[Auindices[k],0])**2.0 + (Lyx[Auindices[k],0])**2.0)**(3.0/2.0)/(alpha+(Axx[Auindices[k],0])**2.0 + (Ayx[Auindices[k],0])**2.0)**(3.0/2.0)
+                    #for k in prange(start,stop,1,nogil=True):
+                    for k in range(start,stop):    
+                        change2 = change2*( (alpha+(Lxx[Auindices[k],0])**2.0 + (Lyx[Auindices[k],0])**2.0)**(3.0/2.0)/(alpha+(Axx[Auindices[k],0])**2.0 + (Ayx[Auindices[k],0])**2.0)**(3.0/2.0))
 
-                start = Bptr[j]
-                stop = Bptr[j+1]    
+                    start = 0
+                    stop = nB
 
-                #for k in prange(start,stop,1,nogil=True):
-                for k in range(start,stop):    
-                    change3 *= (alphab+(Bx[Bindices[k],0])**2.0) /(alphab+(Bdata[k]*(new-old) + Bx[Bindices[k],0])**2.0)
+                    #for k in prange(start,stop,1,nogil=True):
+                    for k in range(start,stop):    
+                        change3 = change3*((alphab+(Bx[Bindices[k],0])**2.0) /(alphab+(Bdata[k]*(new-old) + Bx[Bindices[k],0])**2.0))
 
 
-                ratio = exp(-0.5*Ci*change)*change2*change3
-                #print(ratio)
+                    ratio = exp(-0.5*Ci*change)*change2*change3
+                    #print(ratio)
                 
-                if(acceptv[j] <= ratio):
-                    values[j] = new
-                    currentvalue = new
+                    if(acceptv <= ratio):
+                        values[j] = new
+                        currentvalue = new
                     
-                    start = Lxptr[j]
-                    stop = Lxptr[j+1]    
+                        start = 0
+                        stop = nLx
 
-                    #for k in prange(start,stop,1,nogil=True):
-                    for k in range(start,stop):    
-                        Lxx[Lxindices[k],0] = Axx[Lxindices[k],0]# Lxx[Lxindices[k],0] + Lxdata[k]*(new-old)
+                        #for k in prange(start,stop,1,nogil=True):
+                        for k in range(start,stop):    
+                            Lxx[Lxindices[k],0] = Axx[Lxindices[k],0]# Lxx[Lxindices[k],0] + Lxdata[k]*(new-old)
 
-                    start = Lyptr[j]
-                    stop = Lyptr[j+1]    
+                        start = 0
+                        stop = nLy
 
-                    #for k in prange(start,stop,1,nogil=True):
-                    for k in range(start,stop):    
-                        Lyx[Lyindices[k],0] = Ayx[Lyindices[k],0]# Lyx[Lyindices[k],0] + Lydata[k]*(new-old)    
+                        #for k in prange(start,stop,1,nogil=True):
+                        for k in range(start,stop):    
+                            Lyx[Lyindices[k],0] = Ayx[Lyindices[k],0]# Lyx[Lyindices[k],0] + Lydata[k]*(new-old)    
 
-                    start = Mptr[j]
-                    stop = Mptr[j+1]
+                        start = 0
+                        stop = nM
 
-                    #for k in prange(start,stop,1):
-                    for k in range(start,stop):     
-                        Mx[Mindices[k],0] = Mx[Mindices[k],0] + Mdata[k]*(new-old)
+                        #for k in prange(start,stop,1):
+                        for k in range(start,stop):     
+                            Mx[Mindices[k],0] = Mx[Mindices[k],0] + Mdata[k]*(new-old)
                         
-                    start = Bptr[j]
-                    stop = Bptr[j+1]
+                        start = 0
+                        stop = nB
 
-                    #for k in prange(start,stop,1):
-                    for k in range(start,stop):     
-                        Bx[Bindices[k],0] = Bx[Bindices[k],0] + Bdata[k]*(new-old)    
+                        #for k in prange(start,stop,1):
+                        for k in range(start,stop):     
+                            Bx[Bindices[k],0] = Bx[Bindices[k],0] + Bdata[k]*(new-old)    
 
 
-                else:
-                    values[j] = old
+                    else:
+                        values[j] = old
                     
-                    start = Lxptr[j]
-                    stop = Lxptr[j+1]
+                        start = 0
+                        stop = nLx
 
-                    #for k in prange(start,stop,1):
-                    for k in range(start,stop):    
-                        Axx[Lxindices[k],0] =  Lxx[Lxindices[k],0] 
+                        #for k in prange(start,stop,1):
+                        for k in range(start,stop):    
+                            Axx[Lxindices[k],0] =  Lxx[Lxindices[k],0] 
                         
-                    start = Lyptr[j]
-                    stop = Lyptr[j+1]
+                        start = 0
+                        stop = nLy
 
-                    #for k in prange(start,stop,1):
-                    for k in range(start,stop):    
-                        Ayx[Lyindices[k],0] =  Lyx[Lyindices[k],0]  
+                        #for k in prange(start,stop,1):
+                        for k in range(start,stop):    
+                            Ayx[Lyindices[k],0] =  Lyx[Lyindices[k],0]  
                     
                     
                     
-                if ((cm==0) and (i%thin == 0)):
-                    chainv[j,i//thin] = values[j]
-                #else:
-                if(i > adapt):
-                    #cmestimate[j]  = 1.0 / ((i+1)) * ((i) * cmestimate[j] + values[j])
-                    cmestimate[j]  = 1.0 / ((i-adapt)) * ((i-adapt-1) * cmestimate[j] + values[j])
+                    if (collect and (i%thin == 0)):
+                        chainv[j,col] = values[j]
+                    #else:
+                    if(i > adapt):
+                        #cmestimate[j]  = 1.0 / ((i+1)) * ((i) * cmestimate[j] + values[j])
+                        cmestimate[j]  = 1.0 / ((i-adapt)) * ((i-adapt-1) * cmestimate[j] + values[j])
                 
-                if (i <= adapt):
-                    previousmean = chmeanv[j]
-                    currentmean = 1.0/(i+1.0)*(i*previousmean+currentvalue)
-                    chmeanv[j] = currentmean
-                    currentvar = (i-1.0)/(i)*chdevv[j]*chdevv[j]+ 1.0/(i+1.0)*(currentvalue-previousmean)*(currentvalue-previousmean)
-                    chdevv[j] = sqrt(currentvar)
+                    if (i <= adapt):
+                        previousmean = chmeanv[j]
+                        currentmean = 1.0/(i+1.0)*(i*previousmean+currentvalue)
+                        chmeanv[j] = currentmean
+                        currentvar = (i-1.0)/(i)*chdevv[j]*chdevv[j]+ 1.0/(i+1.0)*(currentvalue-previousmean)*(currentvalue-previousmean)
+                        chdevv[j] = sqrt(currentvar)
+                    if dostats:
+                        st.add(j, values[j])
         
         #exit(1)            
-        if ((istep>1) and (i%istep == 0)):
-            savechain(chain[:,0:i//thin],intername)            
+        if (collect and (i%thin == 0)):
+            sink.commit(i//thin)
+        if (collect and (istep>1) and (i%istep == 0)):
+            sink.flush()
+        if (i % barstep == 0):
+            bar.update(barstep)
+        if (stopping is not None and stopping.check(st, i)):
+            break
                     
-    bar.close()     
+    bar.update(i - bar.n)
+    bar.close()
+    chain = None
+    if collect:
+        chain = sink.close(truncate=stopping is not None)
     if(cm):
         return np.reshape(cmest,(-1,1)),None
     else:
@@ -0,0 +1,127 @@
+import concurrent.futures
+import gc
+import multiprocessing
+import os
+import sys
+import numpy as np
+import scipy.sparse as sp
+from multiprocessing import shared_memory
+from spmv import sparseoperator
+
+# Multi-chain runs of the samplers of the tomography class (see tomography.run_chains).
+# The chains are run in separate processes. The sparse arrays of the Radon operator are copied once into shared memory and
+# every worker maps the same blocks, so n chains need only one copy of the operator. Matrix-free operators (and the difference
+# and wavelet operators, which the methods construct themselves) are sent to the workers as they are, since they store no matrix.
+# The workers are started with 'spawn', because forking a process which has already started OpenMP threads is not safe.
+
+# Shared memory blocks opened by this worker by their names. They are kept referenced for as long as the operators built on
+# them are in use, and closed by detachall when a chain has finished.
+attached = {}
+
+# Copies an array into a new shared memory block. Returns (name, shape, dtype), from which attacharray reconstructs the array.
+def sharearray(a, blocks):
+    a = np.ascontiguousarray(a)
+    shm = shared_memory.SharedMemory(create=True, size=max(a.nbytes, 1))
+    b = np.ndarray(a.shape, dtype=a.dtype, buffer=shm.buf)
+    b[...] = a
+    blocks.append(shm)
+    return (shm.name, a.shape, a.dtype.str)
+
+# A block is opened once per worker and reused by the later tasks. The workers don't register the blocks with the resource
+# tracker (track=False, Python 3.13+). With older versions the registration goes to the tracker of the parent, which the
+# spawned workers share, and is the same entry as the parent's, so it must not be unregistered here: the parent unlinks the
+# blocks and unregisters them in releaseshared.
+def attacharray(handle):
+    (name, shape, dtype) = handle
+    shm = attached.get(name)
+    if shm is None:
+        try:
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            shm = shared_memory.SharedMemory(name=name)
+        attached[name] = shm
+    return np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+# Closes the blocks of this worker which are not in use any more. SharedMemory.close does not notice the NumPy arrays on a
+# block, so a block is closed only when nothing but the block refers to its mapping: NumPy sets the base of every array
+# made by attacharray, and of every view of one, to the mmap object (shm.buf.obj), which is otherwise referenced only by
+# the block and its memoryview. A block which still has arrays (e.g. of an operator that is referenced elsewhere) is
+# kept open for the next task.
+def detachall():
+    gc.collect()
+    for (name, shm) in list(attached.items()):
+        if (sys.getrefcount(shm.buf.obj) > 3):
+            continue
+        shm.close()
+        del attached[name]
+
+# Places the arrays of a sparse operator in shared memory. The returned handle is sent to the workers.
+# For a sparseoperator both the CSC and the CSR copies are shared, so that the workers need not to convert it again.
+def shareoperator(A, blocks):
+    if isinstance(A, sparseoperator):
+        csc = [sharearray(a, blocks) for a in (A.csc.data, A.csc.indices, A.csc.indptr)]
+        csr = [sharearray(a, blocks) for a in (A.csr.data, A.csr.indices, A.csr.indptr)]
+        return ('sparseoperator', A.shape, csc, csr)
+    if sp.issparse(A):
+        A = sp.csc_matrix(A)
+        csc = [sharearray(a, blocks) for a in (A.data, A.indices, A.indptr)]
+        return ('csc', A.shape, csc, None)
+    return ('object', A, None, None)
+
+# Reconstructs an operator shared by shareoperator. The arrays are views of the shared blocks, no copies are made.
+def attachoperator(handle, Nthreads=1):
+    (kind, shape, csc, csr) = handle
+    if (kind == 'object'):
+        A = shape
+        if hasattr(A, 'Nthreads'):
+            A.Nthreads = Nthreads
+        return A
+    A = sp.csc_matrix(tuple(attacharray(h) for h in csc), shape=shape, copy=False)
+    if (kind == 'csc'):
+        return A
+    B = sp.csr_matrix(tuple(attacharray(h) for h in csr), shape=shape, copy=False)
+    return sparseoperator(A, Nthreads=Nthreads, csr=B)
+
+# Closes and removes the shared blocks created by the parent process.
+def releaseshared(blocks):
+    for shm in blocks:
+        shm.close()
+        try:
+            shm.unlink()
+        except FileNotFoundError:
+            pass
+
+# Runs one chain in a worker. State holds the attributes of the tomography instance except the operator and the argument pack,
+# which are rebuilt here around the shared operator.
+def chainworker(state, operator, method, kwargs, Nthreads, npseed):
+    from main import tomography
+    from cyt import argumentspack
+    t = tomography.__new__(tomography)
+    t.__dict__.update(state)
+    t.num_threads = Nthreads
+    t.radonoperator = attachoperator(operator, Nthreads)
+    t.Q = argumentspack(M=t.radonoperator, y=t.lines, b=0.01, s2=t.lhsigmsq, Nthreads=Nthreads)
+    np.random.seed(npseed)
+    try:
+        res = getattr(t, method)(**kwargs)
+    finally:
+        t = None
+        detachall()
+    return res
+
+# Runs the given chains in a process pool and returns their containers in the order of the chains.
+def runchains(t, method, kwargslist, npseeds, n_workers=None, Nthreads=1):
+    if n_workers is None:
+        n_workers = min(len(kwargslist), os.cpu_count() or 1)
+    state = {k: v for k, v in t.__dict__.items() if k not in ('Q', 'radonoperator', 'pbar')}
+    blocks = []
+    try:
+        operator = shareoperator(t.radonoperator, blocks)
+        context = multiprocessing.get_context('spawn')
+        with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers, mp_context=context) as pool:
+            futures = [pool.submit(chainworker, state, operator, method, kwargs, Nthreads, int(seed))
+                       for (kwargs, seed) in zip(kwargslist, npseeds)]
+            results = [f.result() for f in futures]
+    finally:
+        releaseshared(blocks)
+    return results
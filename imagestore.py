@@ -0,0 +1,34 @@
+from collections import OrderedDict
+import numpy as np
+from skimage.io import imread
+from skimage.transform import resize
+from simulation import cached, filekey
+
+# In-memory store of the decoded and resized images, so that the instances of a sweep read and resize each image only
+# once. The images are keyed by the file (path, modification time and size), the size they are resized to and the
+# interpolation order, and the last maxcached ones are kept. The returned arrays are shared, so they are read-only.
+
+imagecache = OrderedDict()
+maxcached = 32
+
+# Decodes an image file: variable 'A' of a .mat file, or any image as grayscale.
+def readimage(filename):
+    if filename.endswith('.mat'):
+        import scipy.io
+        return np.array(scipy.io.loadmat(filename)['A'])
+    return imread(filename, as_gray=True)
+
+# The image resized to size x size (or as decoded, if size is None).
+def loadimage(filename, size=None, order=1):
+    key = filekey(filename) + (size, order)
+
+    def compute():
+        if size is None:
+            image = np.array(readimage(filename))
+        else:
+            image = resize(loadimage(filename), (size, size), anti_aliasing=False, preserve_range=True, order=order,
+                           mode='symmetric')
+        image.setflags(write=False)
+        return image
+
+    return cached(imagecache, key, compute, maxcached)
@@ -8,6 +8,7 @@ from scipy.optimize import minimize
 from scipy.signal import correlate
 import time
 import math
+import copy
 import sys
 import scipy.sparse as sp
 import os
@@ -15,11 +16,19 @@ import matplotlib.pyplot as plt
 import argparse
 import pathlib
 from tqdm import tqdm
+from operatorcache import cachedradonmatrix, operatorkey, readhdf5operator
+from gaussian import cachedsystem
+from simulation import noiselesssinogram, interpolationmatrix
+from imagestore import readimage, loadimage
+from proximal import operatornorm, solvers as proximalsolvers
+from spmv import sparseoperator
+from matrices import differenceoperator, waveletoperator
 from cyt import tfun_cauchy as lcauchy, tfun_tikhonov as ltikhonov, tikhonov_grad, tfun_tv as ltv, tv_grad, cauchy_grad, isocauchy_grad, argumentspack
+from cyt import tikhonov_valgrad, tv_valgrad, cauchy_valgrad, isocauchy_valgrad, wavelet_valgrad, posteriorstats, stoppingrule
 
 # Class to store results of one computation.
 class container:
-    def __init__(self,target=np.zeros((2,2)),l1=-1.0,l2=-1.0,result=np.zeros((2,2)),thinning=-1,noise=-1.0,imagefilename=None,targetsize=0,theta=np.zeros((1,)),method=None,prior=None,crimefree=False,totaliternum=0,levels=0,adaptnum=0,alpha=0.0,globalprefix=""):
+    def __init__(self,target=np.zeros((2,2)),l1=-1.0,l2=-1.0,result=np.zeros((2,2)),thinning=-1,noise=-1.0,imagefilename=None,targetsize=0,theta=np.zeros((1,)),method=None,prior=None,crimefree=False,totaliternum=0,levels=0,adaptnum=0,alpha=0.0,globalprefix="",seed=None,stream=0,chainfile=None):
         self.spent = time.time()
         self.l1 = l1
         self.l2 = l2
@@ -38,6 +47,11 @@ class container:
         self.alpha = alpha
         self.levels = levels
         self.globalprefix = globalprefix
+        # Seed and stream of the random numbers of the MwG samplers, with which the chain can be reproduced.
+        self.seed = seed
+        self.stream = stream
+        # HDF5 file to which the chain was streamed instead of keeping it in memory.
+        self.chainfile = chainfile
         self.chain = None
         self.prefix = ''
 
@@ -59,7 +73,11 @@ class container:
 
 class tomography:
 
-    def __init__(self, filename="shepp.png", targetsize=128, itheta=50, noise=0.0,  commonprefix="", dimbig = 599, N_thetabig=421, crimefree=False,lhdev=None,dataload=False):
+    def __init__(self, filename="shepp.png", targetsize=128, itheta=50, noise=0.0,  commonprefix="", dimbig = 599, N_thetabig=421, crimefree=False,lhdev=None,dataload=False,matrixfree=False,num_threads=4):
+        self.num_threads = num_threads
+        self._targetimage = None
+        self._flattened = None
+        self.simsize = None
         if dataload is False:
             self.globalprefix = str(pathlib.Path.cwd()) + commonprefix
             if not os.path.exists(self.globalprefix):
@@ -76,27 +94,17 @@ class tomography:
                 raise Exception(
                     'Dimensions of the target image are too large (' + str(targetsize) + 'x' + str(targetsize) + ')')
 
-            img = self.opendata(filename)
+            img = loadimage(filename)
             (dy, dx) = img.shape
             if (dy != dx):
                 raise Exception('Image is not rectangular.')
 
-            self.targetimage = self.opendata(filename)
-            self.targetimage = resize(self.targetimage, (self.dim, self.dim), anti_aliasing=False, preserve_range=True,
-                                order=1, mode='symmetric')
+            # The target image (dim x dim) and the simulation image (simsize x simsize) are resized from the image
+            # store when they are first used (see the properties targetimage and flattened).
             if self.crimefree:
-                image = self.opendata(filename)
-                image = resize(image, (self.dimbig, self.dimbig), anti_aliasing=False, preserve_range=True,
-                                    order=1, mode='symmetric')
-                (self.simsize, _) = image.shape
-
+                self.simsize = self.dimbig
             else:
-                image = self.opendata(filename)
-                image = resize(image, (targetsize, targetsize), anti_aliasing=False, preserve_range=True, order=1,
-                                    mode='symmetric')
-                (self.simsize, _) = image.shape
-
-            self.flattened = np.reshape(image, (-1, 1))
+                self.simsize = targetsize
 
             if isinstance(itheta, (int, np.int32, np.int64)) or (isinstance(itheta,(list,tuple)) and len(itheta) == 1):
                 if  isinstance(itheta,(list,tuple)):
@@ -105,7 +113,6 @@ class tomography:
                 self.theta = self.theta / 360 * 2 * np.pi
                 (self.N_r, self.N_theta) = (math.ceil(np.sqrt(2) * self.dim), itheta)
                 self.rhoo = np.linspace(np.sqrt(2), -np.sqrt(2), self.N_r, endpoint=True)
-                fname = 'radonmatrix/0_180-{0}x{1}.npz'.format(str(self.dim), str(self.N_theta))
 
                 if self.crimefree:
                     self.thetabig = np.linspace(0, 180, self.N_thetabig, endpoint=False)
@@ -118,7 +125,6 @@ class tomography:
                 (self.N_r, self.N_theta) = (
                     math.ceil(np.sqrt(2) * targetsize), itheta[2])
                 self.rhoo = np.linspace(np.sqrt(2), -np.sqrt(2), self.N_r, endpoint=True)
-                fname = 'radonmatrix/{0}_{1}-{2}x{3}.npz'.format(str(itheta[0]), str(itheta[1]), str(self.dim), str(self.N_theta))
 
                 if (self.crimefree):
                     self.thetabig = np.linspace(itheta[0], itheta[1], self.N_thetabig, endpoint=False)
@@ -128,37 +134,39 @@ class tomography:
             else:
                 raise Exception('Invalid angle input.')
 
-            if not os.path.isfile(fname):
-                path = os.path.dirname(os.path.abspath(fname))
-                if not os.path.exists(path):
-                    os.makedirs(path)
-
-                from matrices import radonmatrix
-                self.radonoperator = radonmatrix(self.dim, self.theta)
-                sp.save_npz(fname, self.radonoperator)
+            # The matrix-free projector calculates the same weights as radonmatrix on the fly, so that large
+            # geometries need not to be stored in memory.
+            if matrixfree:
+                from matrices import radonprojector
+                self.radonoperator = radonprojector(self.dim, self.theta, scale=1.0/self.dim, Nthreads=num_threads)
 
-            # In the case of inverse-crime free tomography,
-            # one might use the Radon tool from scikit-image
-            # or construct another Radon matrix and calculate a sinogram with that. The former is definitely faster and also preferred,
-            # since different methods are used to simulate and reconcstruct the image.
+            else:
+                # In the case of inverse-crime free tomography,
+                # one might use the Radon tool from scikit-image
+                # or construct another Radon matrix and calculate a sinogram with that. The former is definitely faster and also preferred,
+                # since different methods are used to simulate and reconcstruct the image.
 
-            self.radonoperator = sp.load_npz(fname)
-            self.radonoperator = sp.csc_matrix(self.radonoperator)
-            self.radonoperator = self.radonoperator / self.dim
+                # The operator is cached in radonmatrix/ by a hash of the geometry and loaded as a memory map, and so is
+                # the CSR copy of sparseoperator, so that both M*x and M^T*y run on num_threads threads.
+                (matrix, csr) = cachedradonmatrix(self.dim, self.theta, scale=1.0/self.dim)
+                self.radonoperator = sparseoperator(matrix, Nthreads=num_threads, csr=csr)
 
             if self.crimefree:
                 #self.radonoperatorbig = sp.load_npz(fnamebig) / self.dimbig
                 #simulated = self.radonoperatorbig@self.flattened
                 #simulated = np.reshape(simulated,(self.N_rbig,self.N_thetabig))
-                simulated = self.radonww(image,self.thetabig/ ( 2 * np.pi)*360)/self.dimbig
+                # The noiseless sinogram is simulated once per image, grid and angles (see simulation.py), and it's
+                # resampled to the reconstruction grid with a cached bilinear interpolation matrix.
+                simulated = noiselesssinogram(filename, self.dimbig, self.thetabig,
+                                              lambda: self.radonww(np.reshape(self.flattened, (self.simsize, self.simsize)),self.thetabig/ ( 2 * np.pi)*360)/self.dimbig)
                 simulated = np.reshape(simulated,(-1,1))
 
                 maxvalue = np.max(simulated)
                 simulated = simulated + maxvalue * self.noise * np.random.randn(self.N_rbig * self.N_thetabig, 1)
                 self.sgramsim = np.reshape(simulated, (self.N_rbig, self.N_thetabig))
-                interp = interpolate.RectBivariateSpline(-self.rhoobig, self.thetabig, self.sgramsim,kx=1,ky=1)
-                self.sgram = interp(-self.rhoo, self.theta)
-                self.lines = np.reshape(self.sgram, (-1, 1))
+                interp = interpolationmatrix(-self.rhoobig, self.thetabig, -self.rhoo, self.theta)
+                self.lines = interp @ simulated
+                self.sgram = np.reshape(self.lines, (self.N_r, self.N_theta))
 
             else:
                 simulated = self.radonoperator @ self.flattened
@@ -173,8 +181,14 @@ class tomography:
                 else:
                     lhdev = self.noise
             self.lhsigmsq = (maxvalue * lhdev) ** 2
-            self.Q = argumentspack(M=self.radonoperator, y=self.lines, b=0.01, s2=self.lhsigmsq)
+            self.Q = argumentspack(M=self.radonoperator, y=self.lines, b=0.01, s2=self.lhsigmsq, Nthreads=num_threads)
             self.pbar = None
+            # Order in which a sinogram is flattened to the measurement vector.
+            self.lineorder = 'C'
+            # Norm of the Radon operator for the proximal MAP solvers, estimated when it's first needed.
+            self.radonnorm = None
+            # Key of the geometry, under which the Tikhonov factorizations are shared by the instances of the same setup.
+            self.geometrykey = operatorkey(self.dim, self.theta, scale=1.0/self.dim)
             self.method =   'L-BFGS-B'
 
         else:
@@ -187,106 +201,162 @@ class tomography:
             self.theta = 360
 
     def opendata(self,fname):
-            if fname.endswith(('.mat')):
-                import scipy.io
-                image = np.array(scipy.io.loadmat(fname)['A'])
-            else:
-                image=imread(fname, as_gray=True)
-            return image
+            return readimage(fname)
+
+    @property
+    def targetimage(self):
+        if self._targetimage is None:
+            self._targetimage = np.array(loadimage(self.filename, self.dim))
+        return self._targetimage
+
+    @targetimage.setter
+    def targetimage(self, image):
+        self._targetimage = image
+
+    # Simulation image as a column vector (row-major order). Both images are copies, since the stored ones are shared.
+    @property
+    def flattened(self):
+        if (self._flattened is None and self.simsize is not None):
+            self._flattened = np.reshape(np.array(loadimage(self.filename, self.simsize)), (-1, 1))
+        return self._flattened
+
+    @flattened.setter
+    def flattened(self, image):
+        self._flattened = image
 
     def mincb(self,_):
         self.pbar.update(1)
 
-    def dataload(self,Mfile,Mname,dfile,dname,scaling=1,imsize=128):
+    # Starting point of a MAP minimization: a random image near one, or a copy of the given image (e.g. a neighbouring
+    # solution of an alpha sweep).
+    def startpoint(self, x0=None):
+        if x0 is None:
+            return 1 + 0.05 * np.random.randn(self.dim * self.dim, )
+        return np.array(np.ravel(x0), dtype=np.float64)
+
+    # Copy of the instance at a smaller image size with the same angles. The sinogram is interpolated to the rays of the
+    # smaller geometry; since the operators are scaled by the image size, the line integrals stay comparable.
+    def coarse(self, size):
+        if self.geometrykey is None:
+            raise Exception('Coarse levels need the geometry of the instance, which loaded data does not have.')
+        c = copy.copy(self)
+        c.dim = size
+        c.N_r = math.ceil(np.sqrt(2) * size)
+        c.rhoo = np.linspace(np.sqrt(2), -np.sqrt(2), c.N_r, endpoint=True)
+        if isinstance(self.radonoperator, sparseoperator):
+            (matrix, csr) = cachedradonmatrix(size, self.theta, scale=1.0/size)
+            c.radonoperator = sparseoperator(matrix, Nthreads=self.num_threads, csr=csr)
+        else:
+            from matrices import radonprojector
+            c.radonoperator = radonprojector(size, self.theta, scale=1.0/size, Nthreads=self.num_threads)
+        c.sgram = interpolate.interp1d(-self.rhoo, self.sgram, axis=0)(-c.rhoo)
+        c.lines = np.reshape(c.sgram, (-1, 1))
+        c.Q = argumentspack(M=c.radonoperator, y=c.lines, b=0.01, s2=self.lhsigmsq, Nthreads=self.num_threads)
+        c.radonnorm = None
+        c.geometrykey = operatorkey(size, self.theta, scale=1.0/size)
+        c.pbar = None
+        if isinstance(self.targetimage, np.ndarray):
+            c.targetimage = resize(self.targetimage, (size, size), anti_aliasing=True, preserve_range=True)
+            c.flattened = np.reshape(c.targetimage, (-1, 1))
+        return c
+
+    # Coarse-to-fine MAP estimate of prior ('tikhonov', 'tv', 'cauchy' or 'wavelet'). The image size is halved until it
+    # would be below mindim, the MAP estimate of the smallest level is solved first, and the estimate of each level is
+    # interpolated to the next one as its starting point. Returns the estimate of the last coarse level interpolated to the
+    # full size (a starting point for the full-size MAP estimate or sampler), or None if the image has no coarse levels.
+    # The other keyword arguments are passed to the MAP function; wavelet levels are limited to what each size allows.
+    def pyramid(self, prior, alpha, mindim=64, maxiter=100, **kwargs):
+        sizes = []
+        size = self.dim // 2
+        while (size >= mindim):
+            sizes.insert(0, size)
+            size = size // 2
+        if prior not in ('tikhonov', 'tv', 'cauchy', 'wavelet'):
+            raise Exception('Unknown prior ' + str(prior) + '.')
+        x = None
+        for size in sizes:
+            c = self.coarse(size)
+            methods = {'tikhonov': c.map_tikhonov, 'tv': c.map_tv, 'cauchy': c.map_cauchy, 'wavelet': c.map_wavelet}
+            x0 = None if x is None else resize(x, (size, size), order=1, preserve_range=True)
+            args = dict(kwargs)
+            if (prior == 'wavelet' and args.get('levels') is not None):
+                args['levels'] = min(args['levels'], int(np.floor(np.log2(size)) - 1))
+            print("Pyramid level " + str(size) + "x" + str(size) + ".")
+            x = methods[prior](alpha, maxiter=maxiter, x0=x0, **args)
+        if x is None:
+            return None
+        return resize(x, (self.dim, self.dim), order=1, preserve_range=True)
+
+    # Starting point of the MAP estimate in the samplers: with mapstart 'pyramid' the MAP estimate is started from the
+    # coarse-to-fine estimate instead of a random image.
+    def pyramidstart(self, mapstart, prior, alpha, **kwargs):
+        if (mapstart == 'pyramid'):
+            return self.pyramid(prior, alpha, **kwargs)
+        return None
+
+    # Loads measured data: the system matrix Mname of Mfile and the sinogram dname of dfile, either of which can be a
+    # MATLAB file of version 7.3 (HDF5) or older. The HDF5 matrix is read in chunks (see readhdf5operator) and with persist
+    # stored in directory in the format of the operator cache, so that loading it again only maps the files.
+    # The sinogram is shown only if show is True, since the window blocks until it's closed.
+    def dataload(self,Mfile,Mname,dfile,dname,scaling=1,imsize=128,show=False,persist=False,directory='radonmatrix'):
         import scipy.io
-        try:
-            matrix = scipy.io.loadmat(Mfile)[Mname]
-            sino = scipy.io.loadmat(dfile)[dname]
-        except:
-            import h5py
-
+        import h5py
+        if h5py.is_hdf5(dfile):
             with h5py.File(dfile, 'r') as f:
-                a = list(f.keys())
                 sino = np.double(np.array(f[dname]))
-                s = sino.shape[0]*sino.shape[1]
-
-            with h5py.File(Mfile, 'r') as f:
-                a = list(f.keys())
-                data = f[Mname]['data']
-                ir = f[Mname]['ir']
-                jc = f[Mname]['jc']
-                matrix = sp.csc_matrix((data, ir, jc),shape=(s,imsize**2))
+        else:
+            sino = scipy.io.loadmat(dfile)[dname]
+        csr = None
+        if h5py.is_hdf5(Mfile):
+            s = sino.shape[0]*sino.shape[1]
+            matrix, csr = readhdf5operator(Mfile, Mname, shape=(s,imsize**2), persist=persist, directory=directory)
+        else:
+            matrix = scipy.io.loadmat(Mfile)[Mname]
 
-        plt.imshow(sino)
-        plt.show()
-        self.radonoperator =  sp.csc_matrix(matrix)
+        if show:
+            plt.imshow(sino)
+            plt.show()
+        self.radonoperator = sparseoperator(sp.csc_matrix(matrix), Nthreads=self.num_threads, csr=csr)
         self.dim = np.int(np.sqrt(self.radonoperator.shape[1]))
         self.sgram = np.double(sino)
         self.lines = np.reshape(self.sgram,(-1,1),order='F')*scaling
+        self.lineorder = 'F'
+        self.radonnorm = None
+        self.geometrykey = None
         self.lhsigmsq = (np.max(self.lines) * 0.05) ** 2
-        self.Q = argumentspack(M=self.radonoperator, y=self.lines, b=0.001, s2=self.lhsigmsq)
+        self.Q = argumentspack(M=self.radonoperator, y=self.lines, b=0.001, s2=self.lhsigmsq, Nthreads=self.num_threads)
         self.pbar = None
         self.method = 'L-BFGS-B'
 
 
-    def map_tikhonov(self, alpha=1.0, order=1,maxiter=400,retim=True):
+    # Solver None minimizes the posterior with self.method. Since the Tikhonov posterior is Gaussian, the MAP estimate can
+    # also be solved from the normal equations with solver 'cg' (conjugate gradients with a 'jacobi' or 'diagsplu'
+    # preconditioner, or None) or 'cholesky' (a sparse factorization, which is cached and reused by the instances of the
+    # same geometry).
+    def map_tikhonov(self, alpha=1.0, order=1,maxiter=400,retim=True,x0=None,solver=None,preconditioner='jacobi',tol=1e-8):
+        if solver is None and self.method in proximalsolvers:
+            raise Exception('Method ' + self.method + ' is only for TV and wavelet priors.')
         res = None
         if not retim:
             res = container(alpha=alpha,crimefree=self.crimefree, prior='tikhonov', levels=order, method='map', noise=self.noise, imagefilename=self.filename,
                             target=self.targetimage, targetsize=self.dim,globalprefix=self.globalprefix, theta=self.theta/(2*np.pi)*360)
-        if (order == 2):
-            regN = np.diag([2] * self.dim, 0) + np.diag([-1] * (self.dim - 1), 1) + np.diag([-1] * (self.dim - 1), -1);
-            regN = regN[1:-1, :]
-            regN = sp.csc_matrix(regN);
-            # regvalues = np.array([2, -1, -1, -1, -1])
-            # offsets = np.array([0, 1, -1, self.dim - 1, -self.dim + 1])
-            # reg1d = sp.diags(regvalues, offsets, shape=(self.dim, self.dim))
-        else:
-            regN = np.diag([1] * self.dim, 0) + np.diag([-1] * (self.dim - 1), 1);
-            regN = sp.csc_matrix(regN[0:-1, :])
-            # regvalues = np.array([1, -1, 1])
-            # offsets = np.array([-self.dim + 1, 0, 1])
-            # reg1d = sp.diags(regvalues, offsets, shape=(self.dim, self.dim))
-            # reg1d = sp.csc_matrix(reg1d)
-            # reg1d[self.dim-1,self.dim-1] = 0
-            # print(np.linalg.matrix_rank(reg1d.todense()))
-        help = np.zeros((2, self.dim));
-        help[0, 0] = 1;
-        help[1, self.dim - 1] = 1
-        help2 = np.hstack([np.zeros((self.dim - 2, 1)), np.eye(self.dim - 2), np.zeros((self.dim - 2, 1))])
-        # regvalues = np.array([1, -1, 1])
-        # offsets = np.array([-self.dim + 1, 0, 1])
-        # reg1d = sp.diags(regvalues, offsets, shape=(self.dim, self.dim))
-        # reg1d = sp.csc_matrix(reg1d)
-        # reg1d[self.dim-1,self.dim-1] = 0
-        # print(np.linalg.matrix_rank(reg1d.todense()))
-        # regx = sp.kron(sp.eye(self.dim), reg1d)
-        # regy = sp.kron(reg1d, sp.eye(self.dim))
-        # regx = sp.csc_matrix(regx)
-        # regy = sp.csc_matrix(regy)
-        regx = sp.kron(sp.eye(self.dim), regN)
-        regy = sp.kron(regN, sp.eye(self.dim))
-        regx = sp.csc_matrix(regx)
-        regy = sp.csc_matrix(regy)
-        regx2 = sp.kron(sp.csc_matrix(help2), sp.csc_matrix(help))
-        regy2 = sp.kron(sp.csc_matrix(help), sp.eye(self.dim))
-        self.radonoperator = sp.csc_matrix(self.radonoperator)
-        alpha = alpha
-        # combined = sp.vstack([regy, regx], format='csc')
-        combined = sp.vstack([regy, regx, regx2, regy2], format='csc')
         empty = sp.csc_matrix((1, self.dim * self.dim))
-        self.Q.Lx = combined
+        self.Q.Lx = differenceoperator(self.dim, 'anisotropic', order=order, Nthreads=self.num_threads)
         self.Q.Ly = empty
         self.Q.a = alpha
         self.Q.s2 = self.lhsigmsq
         print("Running MAP estimate for Tikhonov prior.")
         self.pbar = tqdm(total=np.Inf,file=sys.stdout)
-        x0 = 1 + 0.05 * np.random.randn(self.dim * self.dim, )
-        solution = minimize(self.tfun_tikhonov, x0, method=self.method, jac=self.grad_tikhonov,
-                            options={'maxiter': maxiter, 'disp': False},callback=self.mincb)
+        if solver is None:
+            x0 = self.startpoint(x0)
+            solution = minimize(self.valgrad_tikhonov, x0, method=self.method, jac=True,
+                                options={'maxiter': maxiter, 'disp': False},callback=self.mincb)
+            iters = solution.nit
+            solution = solution.x
+        else:
+            system = self.tikhonovsystem(alpha, order)
+            solution, iters = system.solve(system.rhs(self.lines), solver, preconditioner, x0=x0, maxiter=maxiter, tol=tol, callback=self.mincb)
         self.pbar.close()
-        iters = solution.nit
-        solution = solution.x
         solution = np.reshape(solution, (-1, 1))
         solution = np.reshape(solution, (self.dim, self.dim))
         if not retim:
@@ -295,6 +365,14 @@ class tomography:
         else:
             return solution
 
+    # Normal equations of the Tikhonov posterior set up in self.Q. A loaded operator is keyed by its identity, which stays
+    # unique as long as the cached system holds a reference to it.
+    def tikhonovsystem(self, alpha, order):
+        key = (self.geometrykey, order)
+        if self.geometrykey is None:
+            key = (id(self.radonoperator), order)
+        return cachedsystem(self.radonoperator, self.Q.Lx, self.lhsigmsq, alpha, key)
+
     def tfun_tikhonov(self, x):
         return -ltikhonov(x, self.Q)
 
@@ -303,56 +381,38 @@ class tomography:
         ans = -tikhonov_grad(x, self.Q)
         return np.ravel(ans)
 
-    def map_tv(self, alpha=1.0, maxiter=400,retim=True):
+    # Negative log-posterior and its gradient from one fused evaluation (minimize with jac=True).
+    def valgrad_tikhonov(self, x):
+        (v, gr) = tikhonov_valgrad(x, self.Q)
+        return (-v, -gr)
+
+    def map_tv(self, alpha=1.0, maxiter=400,retim=True,x0=None,tol=1e-6):
         res = None
         if not retim:
             res = container(alpha=alpha,crimefree=self.crimefree, prior='tv', method='map', noise=self.noise, imagefilename=self.filename,
                             target=self.targetimage, targetsize=self.dim,globalprefix=self.globalprefix, theta=self.theta/(2*np.pi)*360)
-        regN = np.diag([1] * self.dim, 0) + np.diag([-1] * (self.dim - 1), 1);
-        regN = sp.csc_matrix(regN[0:-1, :])
-        help = np.zeros((2, self.dim));
-        help[0, 0] = 1;
-        help[1, self.dim - 1] = 1
-        help2 = np.hstack([np.zeros((self.dim - 2, 1)), np.eye(self.dim - 2), np.zeros((self.dim - 2, 1))])
-        # regvalues = np.array([1, -1, 1])
-        # offsets = np.array([-self.dim + 1, 0, 1])
-        # reg1d = sp.diags(regvalues, offsets, shape=(self.dim, self.dim))
-        # reg1d = sp.csc_matrix(reg1d)
-        # reg1d[self.dim-1,self.dim-1] = 0
-        # print(np.linalg.matrix_rank(reg1d.todense()))
-        # regx = sp.kron(sp.eye(self.dim), reg1d)
-        # regy = sp.kron(reg1d, sp.eye(self.dim))
-        # regx = sp.csc_matrix(regx)
-        # regy = sp.csc_matrix(regy)
-        regx = sp.kron(sp.eye(self.dim), regN)
-        regy = sp.kron(regN, sp.eye(self.dim))
-        regx = sp.csc_matrix(regx)
-        regy = sp.csc_matrix(regy)
-        regx2 = sp.kron(sp.csc_matrix(help2), sp.csc_matrix(help))
-        regy2 = sp.kron(sp.csc_matrix(help), sp.eye(self.dim))
-        self.radonoperator = sp.csc_matrix(self.radonoperator)
-        alpha = alpha
-        # combined = sp.vstack([regy, regx], format='csc')
-        combined = sp.vstack([regy, regx, regx2, regy2], format='csc')
         empty = sp.csc_matrix((1, self.dim * self.dim))
         #total = np.vstack((self.radonoperator.todense(),combined.todense()))
         #print(total)
         #print(total.shape)
         #print(np.linalg.matrix_rank(total))
         #exit(0)
-        self.Q.Lx = combined
+        self.Q.Lx = differenceoperator(self.dim, 'anisotropic', Nthreads=self.num_threads)
         self.Q.Ly = empty
         self.Q.a = alpha
         self.Q.s2 = self.lhsigmsq
         self.Q.b = 0.01
         print("Running MAP estimate for TV prior.")
         self.pbar = tqdm(total=np.Inf,file=sys.stdout)
-        x0 = 1 + 0.05 * np.random.randn(self.dim * self.dim, )
-        solution = minimize(self.tfun_tv, x0, method=self.method, jac=self.grad_tv,
-                            options={'maxiter': maxiter, 'disp': False},callback=self.mincb)
+        x0 = self.startpoint(x0)
+        if self.method in proximalsolvers:
+            (solution, iters) = self.proximalmap(x0, maxiter, tol)
+        else:
+            solution = minimize(self.valgrad_tv, x0, method=self.method, jac=True,
+                                options={'maxiter': maxiter, 'disp': False},callback=self.mincb)
+            iters = solution.nit
+            solution = solution.x
         self.pbar.close()
-        iters = solution.nit
-        solution = solution.x
         solution = np.reshape(solution, (-1, 1))
         solution = np.reshape(solution, (self.dim, self.dim))
         if not retim:
@@ -369,86 +429,50 @@ class tomography:
         q = -tv_grad(x, self.Q)
         return np.ravel(q)
 
-    def map_cauchy(self, alpha=0.05, maxiter=400,retim=True,isotropic=True):
+    def valgrad_tv(self, x):
+        (v, gr) = tv_valgrad(x, self.Q)
+        return (-v, -gr)
+
+    def valgrad_wavelet(self, x):
+        (v, gr) = wavelet_valgrad(x, self.Q)
+        return (-v, -gr)
+
+    def map_cauchy(self, alpha=0.05, maxiter=400,retim=True,isotropic=True,x0=None):
+        if self.method in proximalsolvers:
+            raise Exception('Method ' + self.method + ' is only for TV and wavelet priors.')
         res = None
         if not retim:
             res = container(alpha=alpha,crimefree=self.crimefree,prior='cauchy',method='map',noise=self.noise,imagefilename=self.filename,target=self.targetimage,targetsize=self.dim,globalprefix=self.globalprefix,theta=self.theta/(2*np.pi)*360)
 
-        self.radonoperator = sp.csc_matrix(self.radonoperator)
         alpha = alpha
         if(isotropic==False):
-            regN = np.diag([1] * self.dim, 0) + np.diag([-1] * (self.dim - 1), 1);
-            regN = sp.csc_matrix(regN[0:-1, :])
-            help = np.zeros((2, self.dim));
-            help[0, 0] = 1;
-            help[1, self.dim - 1] = 1
-            help2 = np.hstack([np.zeros((self.dim - 2, 1)), np.eye(self.dim - 2), np.zeros((self.dim - 2, 1))])
-            # regvalues = np.array([1, -1, 1])
-            # offsets = np.array([-self.dim + 1, 0, 1])
-            # reg1d = sp.diags(regvalues, offsets, shape=(self.dim, self.dim))
-            # reg1d = sp.csc_matrix(reg1d)
-            # reg1d[self.dim-1,self.dim-1] = 0
-            # print(np.linalg.matrix_rank(reg1d.todense()))
-            # regx = sp.kron(sp.eye(self.dim), reg1d)
-            # regy = sp.kron(reg1d, sp.eye(self.dim))
-            # regx = sp.csc_matrix(regx)
-            # regy = sp.csc_matrix(regy)
-            regx = sp.kron(sp.eye(self.dim), regN)
-            regy = sp.kron(regN, sp.eye(self.dim))
-            regx = sp.csc_matrix(regx)
-            regy = sp.csc_matrix(regy)
-            regx2 = sp.kron(sp.csc_matrix(help2), sp.csc_matrix(help))
-            regy2 = sp.kron(sp.csc_matrix(help), sp.eye(self.dim))
-            # combined = sp.vstack([regy, regx], format='csc')
-            combined = sp.vstack([regy, regx, regx2, regy2], format='csc')
             empty = sp.csc_matrix((1, self.dim * self.dim))
-            self.Q.Lx = combined
+            self.Q.Lx = differenceoperator(self.dim, 'anisotropic', Nthreads=self.num_threads)
             self.Q.Ly = empty
             self.Q.a = alpha
             self.Q.s2 = self.lhsigmsq
             self.Q.b = 0.01
 
         else:
-            dim = self.dim
-            regvalues = np.array([1, -1, 1])
-            offsets = np.array([-dim + 1, 0, 1])
-            reg1d = sp.diags(regvalues, offsets, shape=(dim, dim))
-            reg1d = sp.csc_matrix(reg1d)
-            reg1d[dim - 1, dim - 1] = 0
-            regx = sp.kron(sp.eye(dim), reg1d)
-            regy = sp.kron(reg1d, sp.eye(dim))
-            regx = sp.csc_matrix(regx)
-            regy = sp.csc_matrix(regy)
-
-            rmxix = np.sum(np.abs(regx), axis=1) == 1
-            rmyix = np.sum(np.abs(regy), axis=1) == 1
-            boundary = rmxix + rmyix
-            regx[np.ravel(boundary), :] = 0
-            regy[np.ravel(boundary), :] = 0
-
-            bmatrix = sp.csc_matrix((dim * dim, dim * dim))
-            q = np.where((np.ravel(boundary) == True))
-            bmatrix[q, q] = 1
-
-            self.Q.Lx = regx
-            self.Q.Ly = regy
+            self.Q.Lx = differenceoperator(self.dim, 'isotropicx', Nthreads=self.num_threads)
+            self.Q.Ly = differenceoperator(self.dim, 'isotropicy', Nthreads=self.num_threads)
             self.Q.a = alpha
             self.Q.boundarya = alpha
             self.Q.s2 = self.lhsigmsq
             self.Q.b = 0.01
-            self.Q.boun = bmatrix
+            self.Q.boun = differenceoperator(self.dim, 'boundary', Nthreads=self.num_threads)
 
 
 
-        x0 = 1 + 0.05 * np.random.randn(self.dim * self.dim, )
+        x0 = self.startpoint(x0)
         print("Running MAP estimate for Cauchy prior.")
         self.pbar = tqdm(total=np.Inf,file=sys.stdout)
 
         if(isotropic==False):
-            solution = minimize(self.tfun_cauchy, x0, method=self.method, jac=self.grad_cauchy,
+            solution = minimize(self.valgrad_cauchy, x0, method=self.method, jac=True,
                             options={'maxiter': maxiter, 'disp': False},callback=self.mincb)
         else:
-            solution = minimize(self.tfun_isocauchy, x0, method=self.method, jac=self.grad_isocauchy,
+            solution = minimize(self.valgrad_isocauchy, x0, method=self.method, jac=True,
                                 options={'maxiter': maxiter, 'disp': False}, callback=self.mincb)
         self.pbar.close()
         iters = solution.nit
@@ -470,6 +494,14 @@ class tomography:
         ans = -cauchy_grad(x, self.Q)
         return (np.ravel(ans))
 
+    def valgrad_cauchy(self, x):
+        (v, gr) = cauchy_valgrad(x, self.Q)
+        return (-v, -gr)
+
+    def valgrad_isocauchy(self, x):
+        (v, gr) = isocauchy_valgrad(x, self.Q)
+        return (-v, -gr)
+
     def tfun_isocauchy(self,x):
         x = np.reshape(x, (-1, 1))
         x = np.reshape(x, (-1, 1))
@@ -514,21 +546,18 @@ class tomography:
         # gr =  np.ravel(gr)  -3/2*np.sum(((2*sp.diags(np.ravel(Lxx),format='csc'))@Lx + (2*sp.diags(np.ravel(Lyx),format='csc'))@Ly)/(alpha+t1+t2),axis=0) - np.sum( (2*sp.diags(np.ravel(Bx),format='csc'))@B/(alphab+t3),axis=0)
         return -gr
     '''
-    def map_wavelet(self, alpha=1.0, type='haar', maxiter=400,levels=None ,retim=True):
+    def map_wavelet(self, alpha=1.0, type='haar', maxiter=400,levels=None ,retim=True,x0=None,tol=1e-6):
         res = None
         if (levels is None):
             levels = int(np.floor(np.log2(self.dim))-1)
         if not retim:
             res = container(alpha=alpha,crimefree=self.crimefree,prior=type,method='map',levels=levels,noise=self.noise,imagefilename=self.filename,target=self.targetimage,targetsize=self.dim,globalprefix=self.globalprefix,theta=self.theta/(2*np.pi)*360)
-        from matrices import totalmatrix
         wl = pywt.Wavelet(type)
         g = np.array(wl.dec_lo)
         h = np.array(wl.dec_hi)
-        regx = totalmatrix(self.dim, levels, g, h)
+        regx = waveletoperator(self.dim, levels, g, h, Nthreads=self.num_threads)
         regy = sp.csc_matrix((1, self.dim * self.dim))
-        regx = sp.csc_matrix(regx)
         regy = sp.csc_matrix(regy)
-        self.radonoperator = sp.csc_matrix(self.radonoperator)
         alpha = alpha
         self.Q.Lx = regx
         self.Q.Ly = regy
@@ -537,12 +566,15 @@ class tomography:
         self.Q.s2 = self.lhsigmsq
         print("Running MAP estimate for Besov prior (" + type + ' '  + str(levels) + ').' )
         self.pbar = tqdm(total=np.Inf,file=sys.stdout)
-        x0 = 1 + 0.05 * np.random.randn(self.dim * self.dim, )
-        solution = minimize(self.tfun_tv, x0, method=self.method, jac=self.grad_tv,
-                            options={'maxiter': maxiter, 'disp': False},callback=self.mincb)
+        x0 = self.startpoint(x0)
+        if self.method in proximalsolvers:
+            (solution, iters) = self.proximalmap(x0, maxiter, tol)
+        else:
+            solution = minimize(self.valgrad_wavelet, x0, method=self.method, jac=True,
+                                options={'maxiter': maxiter, 'disp': False},callback=self.mincb)
+            iters = solution.nit
+            solution = solution.x
         self.pbar.close()
-        iters = solution.nit
-        solution = solution.x
         solution = np.reshape(solution, (-1, 1))
         solution = np.reshape(solution, (self.dim, self.dim))
         if not retim:
@@ -551,53 +583,211 @@ class tomography:
         else:
             return solution
 
-    def hmcmc_tikhonov(self, alpha, M=100, Madapt=20, order=1,mapstart=False,thinning=1,retim=True,variant='hmc',interstep=100):
+    # MAP estimate with the exact l1 prior alpha*||Lx x||_1 of TV or wavelets (Q.Lx, without the smoothing constant b)
+    # by the solver of proximal.py named by self.method ('fista' or 'admm').
+    def proximalmap(self, x0, maxiter, tol):
+        if self.radonnorm is None:
+            self.radonnorm = operatornorm(self.radonoperator)
+        solver = proximalsolvers[self.method]
+        return solver(self.Q.M, self.Q.y, self.Q.s2, self.Q.Lx, self.Q.a, x0, self.radonnorm, operatornorm(self.Q.Lx),
+                      maxiter=maxiter, tol=tol, callback=self.mincb)
+
+    # MAP estimates of the given prior ('tikhonov', 'tv', 'cauchy' or 'wavelet') for every regularization parameter in alphas,
+    # e.g. for choosing alpha. The alphas are solved from the largest to the smallest, and each minimization is started from
+    # the solution of the previous alpha (continuation), which needs much fewer iterations than a random start. With
+    # n_workers > 1 the sorted alphas are split into contiguous blocks, which are run as continuations of their own in a
+    # process pool like in run_chains. The other keyword arguments (order, type, levels, isotropic) go to the MAP method.
+    # Returns a container with the L-curve table in the increasing order of alpha: alphas, residual (||Mx-y||), regnorm
+    # (||Lx||_2 for Tikhonov, the l1 norm of the differences or wavelet coefficients for the others), l1s and l2s (relative
+    # errors to the target) and iterations. Its result and alpha are those of the smallest L2 error, and corner is the alpha
+    # at the corner of the L-curve. With keepresults, results holds all the estimates. Seed gives the random starting points
+    # of the workers; the serial sweep uses NumPy's global generator like the MAP methods.
+    def alpha_sweep(self, prior, alphas, maxiter=400, n_workers=1, num_threads=1, seed=None, keepresults=True, **kwargs):
+        methods = {'tikhonov': self.map_tikhonov, 'tv': self.map_tv, 'cauchy': self.map_cauchy, 'wavelet': self.map_wavelet}
+        if prior not in methods:
+            raise Exception('Unknown prior ' + str(prior) + '.')
+        res = container(crimefree=self.crimefree, prior=prior, method='alphasweep', levels=kwargs.get('levels', kwargs.get('order', 0)),
+                        noise=self.noise, imagefilename=self.filename, target=self.targetimage, targetsize=self.dim,
+                        globalprefix=self.globalprefix, theta=self.theta/(2*np.pi)*360)
+        alphas = np.sort(np.ravel(np.array(alphas, dtype=np.float64)))[::-1]
+        columns = ('alphas', 'residual', 'regnorm', 'l1s', 'l2s', 'iterations')
+        if (n_workers > 1 and len(alphas) > 1):
+            from ensemble import runchains
+            from cyt import mwgseed
+            blocks = np.array_split(alphas, min(n_workers, len(alphas)))
+            npseeds = np.random.SeedSequence(mwgseed(seed)).generate_state(len(blocks))
+            kwargslist = [dict(kwargs, prior=prior, alphas=b, maxiter=maxiter, keepresults=keepresults) for b in blocks]
+            parts = runchains(self, 'alpha_sweep', kwargslist, npseeds, n_workers=n_workers, Nthreads=num_threads)
+            table = {c: np.concatenate([getattr(p, c) for p in parts]) for c in columns}
+            results = None
+            if keepresults:
+                results = np.concatenate([p.results for p in parts])
+        else:
+            table = {c: np.zeros((len(alphas),)) for c in columns}
+            results = None
+            if keepresults:
+                results = np.zeros((len(alphas), self.dim, self.dim))
+            x0 = None
+            for (k, alpha) in enumerate(alphas):
+                r = methods[prior](alpha=alpha, maxiter=maxiter, retim=False, x0=x0, **kwargs)
+                x0 = r.result
+                (residual, regnorm) = self.lcurvepoint(prior, r.result, kwargs.get('isotropic', True))
+                for (c, v) in zip(columns, (alpha, residual, regnorm, r.l1, r.l2, r.totaliternum)):
+                    table[c][k] = v
+                if keepresults:
+                    results[k] = r.result
+        order = np.argsort(table['alphas'], kind='stable')
+        for c in columns:
+            setattr(res, c, table[c][order])
+        res.iterations = res.iterations.astype(np.int64)
+        res.results = None if results is None else results[order]
+        res.corner = self.lcurvecorner(res.alphas, res.residual, res.regnorm)
+        best = int(np.argmin(res.l2s))
+        res.alpha = res.alphas[best]
+        result = None if results is None else res.results[best]
+        res.finish(result=result, error=(res.l1s[best], res.l2s[best]), iters=int(np.sum(res.iterations)))
+        return res
+
+    # Point (residual norm, regularization norm) of the L-curve of a MAP estimate x. The regularization operators are those
+    # the MAP method left in Q.
+    def lcurvepoint(self, prior, x, isotropic=True):
+        x = np.reshape(x, (-1, 1))
+        residual = np.linalg.norm(self.radonoperator.dot(x) - self.lines)
+        Lxx = self.Q.Lx.dot(x)
+        if (prior == 'tikhonov'):
+            return (residual, np.linalg.norm(Lxx))
+        if (prior == 'cauchy' and isotropic):
+            Lyx = self.Q.Ly.dot(x)
+            return (residual, np.sum(np.sqrt(Lxx*Lxx + Lyx*Lyx)))
+        return (residual, np.sum(np.abs(Lxx)))
+
+    # Alpha at the corner of the L-curve (log residual, log regnorm), where its curvature (with respect to log alpha) is
+    # largest. The one-sided differences at the ends are not reliable, so the corner is taken from the inner alphas. Needs
+    # at least three alphas in increasing order.
+    def lcurvecorner(self, alphas, residual, regnorm):
+        if (len(alphas) < 3):
+            return None
+        t = np.log(alphas)
+        rho = np.log(residual)
+        eta = np.log(np.maximum(regnorm, np.finfo(np.float64).tiny))
+        drho = np.gradient(rho, t)
+        deta = np.gradient(eta, t)
+        curvature = (drho*np.gradient(deta, t) - np.gradient(drho, t)*deta)/np.maximum(drho**2 + deta**2, np.finfo(np.float64).tiny)**1.5
+        return alphas[1 + int(np.argmax(curvature[1:-1]))]
+
+    # MAP estimates of a stack of sinograms measured with the geometry of this instance, e.g. the slices of a volume.
+    # Sinograms is an iterable of sinograms (shaped like self.sgram or flattened like self.lines), e.g. a 3D array, or a
+    # source of volumeio.readsinograms (an HDF5 or .npy file or a list of files, with the variable name), which is read
+    # one sinogram at a time. The slices are reconstructed in batches of batchsize with the block L-BFGS of blocksolver
+    # (whatever the gradient based method of the instance is): every slice has its own line search, curvature history and
+    # stopping test (maxiter iterations at most), but the log-posteriors of the slices are evaluated together, so every
+    # product with the Radon matrix is a product with a block of the unfinished slices instead of separate products. A
+    # slice's estimate therefore does not depend on the other slices of its batch. If warmstart is True, a batch starts from the last estimate of the previous batch, since
+    # neighbouring slices are similar (the batch size then changes the starting points). The likelihood variance is that of
+    # this instance, or (max(sinogram)*lhdev)^2 for each slice if lhdev is given.
+    # If outfile is given, the estimates are appended to its dataset 'volume' after every batch (see volumeio.volumewriter),
+    # and with keepvolume=False they are not kept in memory. Returns the volume (slices x dim x dim), or a container with
+    # it as the result if retim is False.
+    def map_batch(self, prior, sinograms, alpha, batchsize=8, maxiter=400, name='m', lhdev=None, warmstart=True, outfile=None, keepvolume=True, compression='lzf', retim=True, order=1, type='haar', levels=None, isotropic=True):
+        if self.method in proximalsolvers:
+            raise Exception('Batched MAP estimates need a gradient based method, not ' + self.method + '.')
+        from cyt import blockvalgrad, blockpriors
+        from volumeio import readsinograms, volumewriter, batches
+        from blocksolver import lbfgs
+        D = self.dim * self.dim
+        Q = argumentspack(M=self.radonoperator, y=None, b=0.01, s2=self.lhsigmsq, a=alpha, Nthreads=self.num_threads)
+        Q.Ly = sp.csc_matrix((1, D))
+        kernel = prior
+        if (prior == 'tikhonov'):
+            Q.Lx = differenceoperator(self.dim, 'anisotropic', order=order, Nthreads=self.num_threads)
+            levels = order
+        elif (prior == 'tv' or (prior == 'cauchy' and not isotropic)):
+            Q.Lx = differenceoperator(self.dim, 'anisotropic', Nthreads=self.num_threads)
+        elif (prior == 'cauchy'):
+            Q.Lx = differenceoperator(self.dim, 'isotropicx', Nthreads=self.num_threads)
+            Q.Ly = differenceoperator(self.dim, 'isotropicy', Nthreads=self.num_threads)
+            Q.boun = differenceoperator(self.dim, 'boundary', Nthreads=self.num_threads)
+            Q.boundarya = alpha
+            kernel = 'isocauchy'
+        elif (prior == 'wavelet'):
+            if (levels is None):
+                levels = int(np.floor(np.log2(self.dim))-1)
+            wl = pywt.Wavelet(type)
+            Q.Lx = waveletoperator(self.dim, levels, np.array(wl.dec_lo), np.array(wl.dec_hi), Nthreads=self.num_threads)
+            prior = type
+        else:
+            raise Exception('Unknown prior ' + str(prior) + '.')
+        kernel = blockpriors[kernel]
         res = None
         if not retim:
-            res = container(crimefree=self.crimefree,totaliternum=M,adaptnum=Madapt,alpha=alpha,prior='tikhonov',method=variant,levels=order,noise=self.noise,imagefilename=self.filename,target=self.targetimage,targetsize=self.dim,globalprefix=self.globalprefix,theta=self.theta/(2*np.pi)*360)
-        from cyt import hmc, ehmc
-        if (order == 2):
-            regN = np.diag([2] * self.dim, 0) + np.diag([-1] * (self.dim - 1), 1) + np.diag([-1] * (self.dim - 1), -1); regN = regN[1:-1,:]
-            regN = sp.csc_matrix(regN);
-            # regvalues = np.array([2, -1, -1, -1, -1])
-            # offsets = np.array([0, 1, -1, self.dim - 1, -self.dim + 1])
-            # reg1d = sp.diags(regvalues, offsets, shape=(self.dim, self.dim))
+            res = container(alpha=alpha, crimefree=self.crimefree, prior=prior, method='mapbatch', levels=levels if levels is not None else 0,
+                            noise=self.noise, imagefilename=self.filename, target=self.targetimage, targetsize=self.dim,
+                            globalprefix=self.globalprefix, theta=self.theta/(2*np.pi)*360)
+        if isinstance(sinograms, str) or (isinstance(sinograms, (list, tuple)) and len(sinograms) > 0 and isinstance(sinograms[0], str)):
+            sinograms = readsinograms(sinograms, name)
+        writer = None
+        if outfile is not None:
+            writer = volumewriter(outfile, self.dim, compression=compression)
+        volume = []
+        iters = []
+        last = None
+        print("Running batched MAP estimates (" + prior + ").")
+        try:
+            for batch in batches(sinograms, batchsize):
+                Y = np.asarray(np.stack([np.reshape(s, (-1,), order=self.lineorder) for s in batch], axis=1), dtype=np.float64)
+                if (Y.shape[0] != self.radonoperator.shape[0]):
+                    raise Exception('Sinogram does not match the geometry.')
+                K = Y.shape[1]
+                s2 = None
+                if lhdev is not None:
+                    s2 = (np.max(Y, axis=0) * lhdev) ** 2
+                if (warmstart and last is not None):
+                    x0 = np.repeat(np.reshape(last, (-1, 1)), K, axis=1)
+                else:
+                    x0 = 1 + 0.05 * np.random.randn(K, D).T
+
+                def valgrad(X, cols):
+                    Q.y = Y[:, cols]
+                    (v, gr) = blockvalgrad(X, Q, kernel, None if s2 is None else s2[cols])
+                    return (-v, -gr)
+
+                self.pbar = tqdm(total=np.Inf, file=sys.stdout)
+                (X, nit) = lbfgs(valgrad, x0, maxiter=maxiter, callback=self.mincb)
+                self.pbar.close()
+                iters.extend(nit)
+                last = X[:, K - 1]
+                slices = np.reshape(X.T, (K, self.dim, self.dim))
+                if writer is not None:
+                    writer.append(slices)
+                if keepvolume:
+                    volume.append(slices)
+        finally:
+            if writer is not None:
+                writer.close()
+        if keepvolume:
+            volume = np.concatenate(volume) if len(volume) > 0 else np.zeros((0, self.dim, self.dim))
         else:
-            regN = np.diag([1] * self.dim, 0) + np.diag([-1] * (self.dim - 1), 1);
-            regN = sp.csc_matrix(regN[0:-1, :])
-            # regvalues = np.array([1, -1, 1])
-            # offsets = np.array([-self.dim + 1, 0, 1])
-            # reg1d = sp.diags(regvalues, offsets, shape=(self.dim, self.dim))
-            # reg1d = sp.csc_matrix(reg1d)
-            # reg1d[self.dim-1,self.dim-1] = 0
-            # print(np.linalg.matrix_rank(reg1d.todense()))
-        help = np.zeros((2, self.dim));
-        help[0, 0] = 1;
-        help[1, self.dim - 1] = 1
-        help2 = np.hstack([np.zeros((self.dim - 2, 1)), np.eye(self.dim - 2), np.zeros((self.dim - 2, 1))])
-        # regvalues = np.array([1, -1, 1])
-        # offsets = np.array([-self.dim + 1, 0, 1])
-        # reg1d = sp.diags(regvalues, offsets, shape=(self.dim, self.dim))
-        # reg1d = sp.csc_matrix(reg1d)
-        # reg1d[self.dim-1,self.dim-1] = 0
-        # print(np.linalg.matrix_rank(reg1d.todense()))
-        # regx = sp.kron(sp.eye(self.dim), reg1d)
-        # regy = sp.kron(reg1d, sp.eye(self.dim))
-        # regx = sp.csc_matrix(regx)
-        # regy = sp.csc_matrix(regy)
-        regx = sp.kron(sp.eye(self.dim), regN)
-        regy = sp.kron(regN, sp.eye(self.dim))
-        regx = sp.csc_matrix(regx)
-        regy = sp.csc_matrix(regy)
-        regx2 = sp.kron(sp.csc_matrix(help2), sp.csc_matrix(help))
-        regy2 = sp.kron(sp.csc_matrix(help), sp.eye(self.dim))
-        self.radonoperator = sp.csc_matrix(self.radonoperator)
-        alpha = alpha
-        # combined = sp.vstack([regy, regx], format='csc')
-        combined = sp.vstack([regy, regx, regx2, regy2], format='csc')
-        #p=np.array(combined.todense())
+            volume = None
+        if not retim:
+            res.volumefile = outfile
+            res.iterations = np.array(iters)
+            res.finish(result=volume, iters=int(np.sum(iters)))
+            return res
+        else:
+            return volume
+
+    # Variant 'po' draws M independent exact samples of the Gaussian posterior by perturbation-optimization instead of
+    # running HMC. The samples are solved with solver ('cg' or 'cholesky', see map_tikhonov) and started from the MAP estimate.
+    def hmcmc_tikhonov(self, alpha, M=100, Madapt=20, order=1,mapstart=False,thinning=1,retim=True,variant='hmc',interstep=100,chainfile=None,keepchain=True,quantiles=(0.025,0.975),statburnin=None,stopping=None,metric=None,adaptmetric=None,solver='cg',preconditioner='jacobi',tol=1e-8):
+        res = None
+        stats = None
+        if not retim:
+            res = container(crimefree=self.crimefree,totaliternum=M,adaptnum=Madapt,alpha=alpha,prior='tikhonov',method=variant,levels=order,noise=self.noise,imagefilename=self.filename,target=self.targetimage,targetsize=self.dim,globalprefix=self.globalprefix,theta=self.theta/(2*np.pi)*360,chainfile=chainfile)
+            stats = posteriorstats(self.dim * self.dim, quantiles)
+        from cyt import hmc, ehmc
+        metric, adaptation = self.metricsetup(metric, adaptmetric, Madapt, variant)
         empty = sp.csc_matrix((1, self.dim * self.dim))
-        self.Q.Lx = combined
+        self.Q.Lx = differenceoperator(self.dim, 'anisotropic', order=order, Nthreads=self.num_threads)
         self.Q.Ly = empty
         self.Q.a = alpha
         self.Q.s2 = self.lhsigmsq
@@ -605,58 +795,43 @@ class tomography:
         self.Q.logdensity = ltikhonov
         self.Q.gradi = tikhonov_grad
         self.Q.y = self.lines
-        if (mapstart):
-            x0 = np.reshape(self.map_tikhonov(alpha,maxiter=150),(-1,1))
+        if (variant == 'po'):
+            from gaussian import posampler
+            system = self.tikhonovsystem(alpha, order)
+            x0, _ = system.solve(system.rhs(self.lines), solver, preconditioner, tol=tol)
+        elif (mapstart):
+            x0 = np.reshape(self.map_tikhonov(alpha,maxiter=150,x0=self.pyramidstart(mapstart,'tikhonov',alpha)),(-1,1))
             x0 = x0 + 0.000001*np.random.rand(self.dim*self.dim,1)
         else:
             x0 = 0.0 + 0.00*np.random.randn(self.dim * self.dim, 1)
         print("Running  " + variant.upper() + " for Tikhonov prior.")
-        if (variant == 'hmc'):
-            solution, chain = hmc(M, x0, self.Q, Madapt, de=0.65, gamma=0.05, t0=10.0, epsilonwanted=None, kappa=0.75,cmonly=retim, thinning=thinning,istep=interstep,intername=res.intermedfilename)
+        if (variant == 'po'):
+            solution, chain = posampler(system, self.lines, M, x0, solver, preconditioner, cmonly=retim or not keepchain, thinning=thinning,istep=interstep,intername=getattr(res, 'intermedfilename', None),chainfile=chainfile,stats=stats,statburnin=statburnin,stopping=stopping,tol=tol)
+        elif (variant == 'hmc'):
+            solution, chain = hmc(M, x0, self.Q, Madapt, de=0.65, gamma=0.05, t0=10.0, epsilonwanted=None, kappa=0.75,cmonly=retim or not keepchain, thinning=thinning,istep=interstep,intername=getattr(res, 'intermedfilename', None),chainfile=chainfile,stats=stats,statburnin=statburnin,stopping=stopping,metric=metric,adaptation=adaptation)
         else:
-            solution, chain = ehmc(M, x0, self.Q, Madapt, kappa=0.75, cmonly=retim,thinning=thinning,stepsize=0.002,istep=interstep,intername=res.intermedfilename)
+            solution, chain = ehmc(M, x0, self.Q, Madapt, kappa=0.75, cmonly=retim or not keepchain,thinning=thinning,stepsize=0.002,istep=interstep,intername=getattr(res, 'intermedfilename', None),chainfile=chainfile,stats=stats,statburnin=statburnin,stopping=stopping,metric=metric,adaptation=adaptation)
         #solution,chain = hmc(M, x0, self.Q, Madapt, de=0.65, gamma=0.05, t0=10.0, kappa=0.75, cmonly=retim,thinning=thinning)
         solution = np.reshape(solution, (-1, 1))
         solution = np.reshape(solution, (self.dim, self.dim))
         if not retim:
-            res.finish(result=solution, error=self.difference(solution),chain=chain,thinning=thinning)
+            stats.store(res, self.dim)
+            self.storemetric(res, metric, adaptation)
+            res.finish(result=solution, error=self.difference(solution),chain=chain,thinning=thinning,iters=getattr(stopping, 'iterations', None))
             return res
         else:
             return solution
 
-    def hmcmc_tv(self, alpha, M=100, Madapt=20,mapstart=False,thinning=1,retim=True,variant='hmc',interstep=100):
+    def hmcmc_tv(self, alpha, M=100, Madapt=20,mapstart=False,thinning=1,retim=True,variant='hmc',interstep=100,chainfile=None,keepchain=True,quantiles=(0.025,0.975),statburnin=None,stopping=None,metric=None,adaptmetric=None):
         res = None
+        stats = None
         if not retim:
-            res = container(crimefree=self.crimefree,totaliternum=M,adaptnum=Madapt,alpha=alpha,prior='tv',method=variant,noise=self.noise,imagefilename=self.filename,target=self.targetimage,targetsize=self.dim,globalprefix=self.globalprefix,theta=self.theta/(2*np.pi)*360)
+            res = container(crimefree=self.crimefree,totaliternum=M,adaptnum=Madapt,alpha=alpha,prior='tv',method=variant,noise=self.noise,imagefilename=self.filename,target=self.targetimage,targetsize=self.dim,globalprefix=self.globalprefix,theta=self.theta/(2*np.pi)*360,chainfile=chainfile)
+            stats = posteriorstats(self.dim * self.dim, quantiles)
         from cyt import hmc, ehmc
-        regN = np.diag([1] * self.dim, 0) + np.diag([-1] * (self.dim - 1), 1);
-        regN = sp.csc_matrix(regN[0:-1, :])
-        help = np.zeros((2, self.dim));
-        help[0, 0] = 1;
-        help[1, self.dim - 1] = 1
-        help2 = np.hstack([np.zeros((self.dim - 2, 1)), np.eye(self.dim - 2), np.zeros((self.dim - 2, 1))])
-        # regvalues = np.array([1, -1, 1])
-        # offsets = np.array([-self.dim + 1, 0, 1])
-        # reg1d = sp.diags(regvalues, offsets, shape=(self.dim, self.dim))
-        # reg1d = sp.csc_matrix(reg1d)
-        # reg1d[self.dim-1,self.dim-1] = 0
-        # print(np.linalg.matrix_rank(reg1d.todense()))
-        # regx = sp.kron(sp.eye(self.dim), reg1d)
-        # regy = sp.kron(reg1d, sp.eye(self.dim))
-        # regx = sp.csc_matrix(regx)
-        # regy = sp.csc_matrix(regy)
-        regx = sp.kron(sp.eye(self.dim), regN)
-        regy = sp.kron(regN, sp.eye(self.dim))
-        regx = sp.csc_matrix(regx)
-        regy = sp.csc_matrix(regy)
-        regx2 = sp.kron(sp.csc_matrix(help2), sp.csc_matrix(help))
-        regy2 = sp.kron(sp.csc_matrix(help), sp.eye(self.dim))
-        self.radonoperator = sp.csc_matrix(self.radonoperator)
-        alpha = alpha
-        # combined = sp.vstack([regy, regx], format='csc')
-        combined = sp.vstack([regy, regx, regx2, regy2], format='csc')
+        metric, adaptation = self.metricsetup(metric, adaptmetric, Madapt, variant)
         empty = sp.csc_matrix((1, self.dim * self.dim))
-        self.Q.Lx = combined
+        self.Q.Lx = differenceoperator(self.dim, 'anisotropic', Nthreads=self.num_threads)
         self.Q.Ly = empty
         self.Q.a = alpha
         self.Q.s2 = self.lhsigmsq
@@ -664,57 +839,36 @@ class tomography:
         self.Q.logdensity = ltv
         self.Q.gradi = tv_grad
         if mapstart:
-            x0 = np.reshape(self.map_tv(alpha, maxiter=150), (-1, 1))
+            x0 = np.reshape(self.map_tv(alpha, maxiter=150, x0=self.pyramidstart(mapstart, 'tv', alpha)), (-1, 1))
             x0 = x0 + 0.00001 * np.random.rand(self.dim * self.dim, 1)
         else:
             x0 = 0.0 + 0.01*np.random.randn(self.dim * self.dim, 1)
         print("Running " + variant.upper() + " for TV prior.")
         if (variant == 'hmc'):
-            solution, chain = hmc(M, x0, self.Q, Madapt, de=0.65, gamma=0.05, t0=10.0, epsilonwanted=None, kappa=0.75,cmonly=retim, thinning=thinning,istep=interstep,intername=res.intermedfilename)
+            solution, chain = hmc(M, x0, self.Q, Madapt, de=0.65, gamma=0.05, t0=10.0, epsilonwanted=None, kappa=0.75,cmonly=retim or not keepchain, thinning=thinning,istep=interstep,intername=getattr(res, 'intermedfilename', None),chainfile=chainfile,stats=stats,statburnin=statburnin,stopping=stopping,metric=metric,adaptation=adaptation)
         else:
-            solution, chain = ehmc(M, x0, self.Q, L=50, Madapt=Madapt,  cmonly=retim,thinning=thinning,stepsize=0.002,istep=interstep,intername=res.intermedfilename)
+            solution, chain = ehmc(M, x0, self.Q, L=50, Madapt=Madapt,  cmonly=retim or not keepchain,thinning=thinning,stepsize=0.002,istep=interstep,intername=getattr(res, 'intermedfilename', None),chainfile=chainfile,stats=stats,statburnin=statburnin,stopping=stopping,metric=metric,adaptation=adaptation)
         #solution,chain = hmc(M, x0, self.Q, Madapt, de=0.65, gamma=0.05, t0=10.0, kappa=0.75, cmonly=retim,thinning=thinning)
         solution = np.reshape(solution, (-1, 1))
         solution = np.reshape(solution, (self.dim, self.dim))
         if not retim:
-            res.finish(result=solution, error=self.difference(solution),chain=chain,thinning=thinning)
+            stats.store(res, self.dim)
+            self.storemetric(res, metric, adaptation)
+            res.finish(result=solution, error=self.difference(solution),chain=chain,thinning=thinning,iters=getattr(stopping, 'iterations', None))
             return res
         else:
             return solution
 
-    def hmcmc_cauchy(self, alpha, M=100, Madapt=20,thinning=1,mapstart=False,retim=True,variant='hmc',interstep=100):
+    def hmcmc_cauchy(self, alpha, M=100, Madapt=20,thinning=1,mapstart=False,retim=True,variant='hmc',interstep=100,chainfile=None,keepchain=True,quantiles=(0.025,0.975),statburnin=None,stopping=None,metric=None,adaptmetric=None):
         res = None
+        stats = None
         if not retim:
-            res = container(crimefree=self.crimefree,totaliternum=M,adaptnum=Madapt,alpha=alpha,prior='cauchy',method=variant,noise=self.noise,imagefilename=self.filename,target=self.targetimage,targetsize=self.dim,globalprefix=self.globalprefix,theta=self.theta/(2*np.pi)*360)
+            res = container(crimefree=self.crimefree,totaliternum=M,adaptnum=Madapt,alpha=alpha,prior='cauchy',method=variant,noise=self.noise,imagefilename=self.filename,target=self.targetimage,targetsize=self.dim,globalprefix=self.globalprefix,theta=self.theta/(2*np.pi)*360,chainfile=chainfile)
+            stats = posteriorstats(self.dim * self.dim, quantiles)
         from cyt import hmc, ehmc
-        regN = np.diag([1] * self.dim, 0) + np.diag([-1] * (self.dim - 1), 1);
-        regN = sp.csc_matrix(regN[0:-1, :])
-        help = np.zeros((2, self.dim));
-        help[0, 0] = 1;
-        help[1, self.dim - 1] = 1
-        help2 = np.hstack([np.zeros((self.dim - 2, 1)), np.eye(self.dim - 2), np.zeros((self.dim - 2, 1))])
-        # regvalues = np.array([1, -1, 1])
-        # offsets = np.array([-self.dim + 1, 0, 1])
-        # reg1d = sp.diags(regvalues, offsets, shape=(self.dim, self.dim))
-        # reg1d = sp.csc_matrix(reg1d)
-        # reg1d[self.dim-1,self.dim-1] = 0
-        # print(np.linalg.matrix_rank(reg1d.todense()))
-        # regx = sp.kron(sp.eye(self.dim), reg1d)
-        # regy = sp.kron(reg1d, sp.eye(self.dim))
-        # regx = sp.csc_matrix(regx)
-        # regy = sp.csc_matrix(regy)
-        regx = sp.kron(sp.eye(self.dim), regN)
-        regy = sp.kron(regN, sp.eye(self.dim))
-        regx = sp.csc_matrix(regx)
-        regy = sp.csc_matrix(regy)
-        regx2 = sp.kron(sp.csc_matrix(help2), sp.csc_matrix(help))
-        regy2 = sp.kron(sp.csc_matrix(help), sp.eye(self.dim))
-        self.radonoperator = sp.csc_matrix(self.radonoperator)
-        alpha = alpha
-        # combined = sp.vstack([regy, regx], format='csc')
-        combined = sp.vstack([regy, regx, regx2, regy2], format='csc')
+        metric, adaptation = self.metricsetup(metric, adaptmetric, Madapt, variant)
         empty = sp.csc_matrix((1, self.dim * self.dim))
-        self.Q.Lx = combined
+        self.Q.Lx = differenceoperator(self.dim, 'anisotropic', Nthreads=self.num_threads)
         self.Q.Ly = empty
         self.Q.a = alpha
         self.Q.s2 = self.lhsigmsq
@@ -722,7 +876,7 @@ class tomography:
         self.Q.logdensity = lcauchy
         self.Q.gradi = cauchy_grad
         if mapstart:
-            x0 = np.reshape(self.map_cauchy(alpha, maxiter=150), (-1, 1))
+            x0 = np.reshape(self.map_cauchy(alpha, maxiter=150, x0=self.pyramidstart(mapstart, 'cauchy', alpha)), (-1, 1))
             x0 = x0 + 0.00001 * np.random.rand(self.dim * self.dim, 1)
         else:
             x0 = 0.0 + 0.00*np.random.randn(self.dim * self.dim, 1)
@@ -731,33 +885,35 @@ class tomography:
         #solution,chain = ehmc(M, x0, self.Q, epstrials=25,Ltrials=25, L=50, delta=0.65,cmonly=False, thinning=thinning)
         #solution = np.median(chain,axis=1)
         if(variant=='hmc'):
-            solution,chain = hmc(M, x0, self.Q, Madapt, de=0.65, gamma=0.05, t0=10.0, epsilonwanted=None, kappa=0.75, cmonly=retim, thinning=thinning,istep=interstep,intername=res.intermedfilename)
+            solution,chain = hmc(M, x0, self.Q, Madapt, de=0.65, gamma=0.05, t0=10.0, epsilonwanted=None, kappa=0.75, cmonly=retim or not keepchain, thinning=thinning,istep=interstep,intername=getattr(res, 'intermedfilename', None),chainfile=chainfile,stats=stats,statburnin=statburnin,stopping=stopping,metric=metric,adaptation=adaptation)
         else:
-            solution,chain = ehmc(M, x0, self.Q, Madapt, cmonly=retim, thinning=thinning,istep=interstep,intername=res.intermedfilename)
+            solution,chain = ehmc(M, x0, self.Q, Madapt, cmonly=retim or not keepchain, thinning=thinning,istep=interstep,intername=getattr(res, 'intermedfilename', None),chainfile=chainfile,stats=stats,statburnin=statburnin,stopping=stopping,metric=metric,adaptation=adaptation)
         solution = np.reshape(solution, (-1, 1))
         solution = np.reshape(solution, (self.dim, self.dim))
         if not retim:
-            res.finish(result=solution, error=self.difference(solution),chain=chain,thinning=thinning)
+            stats.store(res, self.dim)
+            self.storemetric(res, metric, adaptation)
+            res.finish(result=solution, error=self.difference(solution),chain=chain,thinning=thinning,iters=getattr(stopping, 'iterations', None))
             return res
         else:
             return solution
 
-    def hmcmc_wavelet(self, alpha, M=100, Madapt=20, type='haar',levels=None,mapstart=False,thinning=1,retim=True,variant='hmc',interstep=100):
+    def hmcmc_wavelet(self, alpha, M=100, Madapt=20, type='haar',levels=None,mapstart=False,thinning=1,retim=True,variant='hmc',interstep=100,chainfile=None,keepchain=True,quantiles=(0.025,0.975),statburnin=None,stopping=None,metric=None,adaptmetric=None):
         res = None
+        stats = None
         if (levels is None):
             levels = int(np.floor(np.log2(self.dim))-1)
         if not retim:
-            res = container(crimefree=self.crimefree,totaliternum=M,adaptnum=Madapt,levels=levels,alpha=alpha,prior=type,method=variant,noise=self.noise,imagefilename=self.filename,target=self.targetimage,targetsize=self.dim,globalprefix=self.globalprefix,theta=self.theta/(2*np.pi)*360)
-        from matrices import totalmatrix
+            res = container(crimefree=self.crimefree,totaliternum=M,adaptnum=Madapt,levels=levels,alpha=alpha,prior=type,method=variant,noise=self.noise,imagefilename=self.filename,target=self.targetimage,targetsize=self.dim,globalprefix=self.globalprefix,theta=self.theta/(2*np.pi)*360,chainfile=chainfile)
+            stats = posteriorstats(self.dim * self.dim, quantiles)
         from cyt import hmc, ehmc
+        metric, adaptation = self.metricsetup(metric, adaptmetric, Madapt, variant)
         wl = pywt.Wavelet(type)
         g = np.array(wl.dec_lo)
         h = np.array(wl.dec_hi)
-        regx = totalmatrix(self.dim, levels, g, h)
+        regx = waveletoperator(self.dim, levels, g, h, Nthreads=self.num_threads)
         regy = sp.csc_matrix((1, self.dim * self.dim))
-        regx = sp.csc_matrix(regx)
         regy = sp.csc_matrix(regy)
-        self.radonoperator = sp.csc_matrix(self.radonoperator)
         alpha = alpha
         self.Q.Lx = regx
         self.Q.b = 0.01
@@ -767,109 +923,88 @@ class tomography:
         self.Q.logdensity = ltv
         self.Q.gradi = tv_grad
         if mapstart:
-            x0 = np.reshape(self.map_wavelet(alpha, type=type, levels=levels, maxiter=150), (-1, 1))
+            x0 = np.reshape(self.map_wavelet(alpha, type=type, levels=levels, maxiter=150, x0=self.pyramidstart(mapstart, 'wavelet', alpha, type=type, levels=levels)), (-1, 1))
             x0 = x0 + 0.000001 * np.random.rand(self.dim * self.dim, 1)
         else:
             x0 = 0.2 + 0.01*np.random.randn(self.dim * self.dim, 1)
         print("Running " + variant.upper() + " for Besov prior (" + type + ' '  + str(levels) + ').' )
         if (variant == 'hmc'):
-            solution, chain = hmc(M, x0, self.Q, Madapt, de=0.65, gamma=0.05, t0=10.0, epsilonwanted=None, kappa=0.75,cmonly=retim, thinning=thinning,istep=interstep,intername=res.intermedfilename)
+            solution, chain = hmc(M, x0, self.Q, Madapt, de=0.65, gamma=0.05, t0=10.0, epsilonwanted=None, kappa=0.75,cmonly=retim or not keepchain, thinning=thinning,istep=interstep,intername=getattr(res, 'intermedfilename', None),chainfile=chainfile,stats=stats,statburnin=statburnin,stopping=stopping,metric=metric,adaptation=adaptation)
         else:
-            solution, chain = ehmc(M, x0, self.Q, Madapt,  cmonly=retim,thinning=thinning,istep=interstep,intername=res.intermedfilename)
+            solution, chain = ehmc(M, x0, self.Q, Madapt,  cmonly=retim or not keepchain,thinning=thinning,istep=interstep,intername=getattr(res, 'intermedfilename', None),chainfile=chainfile,stats=stats,statburnin=statburnin,stopping=stopping,metric=metric,adaptation=adaptation)
         #solution,chain = hmc(M, x0, self.Q, Madapt, de=0.65, gamma=0.05, t0=10.0, epsilonwanted=None, kappa=0.75, cmonly=retim,thinning=thinning)
         solution = np.reshape(solution, (-1, 1))
         solution = np.reshape(solution, (self.dim, self.dim))
         if not retim:
-            res.finish(result=solution, error=self.difference(solution),chain=chain,thinning=thinning)
+            stats.store(res, self.dim)
+            self.storemetric(res, metric, adaptation)
+            res.finish(result=solution, error=self.difference(solution),chain=chain,thinning=thinning,iters=getattr(stopping, 'iterations', None))
             return res
         else:
             return solution
 
-    def mwg_tv(self, alpha, M=10000, Madapt=1000,mapstart=False,thinning=10,retim=True,interstep=100000):
+    # Inverse metric and its adaptation in the warmup for the HMC methods (see metric.py). Metric is an inversemetric or a
+    # result container of an earlier run, adaptmetric is None, 'diag' or 'lowrank'. The warmup of ehmc is its step size
+    # adaptation, the first half of Madapt.
+    def metricsetup(self, metric, adaptmetric, Madapt, variant):
+        from metric import asmetric, metricadaptation
+        metric = asmetric(metric)
+        adaptation = None
+        if adaptmetric is not None:
+            warmup = Madapt if variant == 'hmc' else int(np.ceil(Madapt/2)) - 1
+            adaptation = metricadaptation(self.dim*self.dim, warmup, kind=adaptmetric, metric=metric)
+        return metric, adaptation
+
+    def storemetric(self, res, metric, adaptation):
+        if adaptation is not None:
+            metric = adaptation.metric
+        if metric is not None:
+            metric.store(res)
+
+    def mwg_tv(self, alpha, M=10000, Madapt=1000,mapstart=False,thinning=10,retim=True,interstep=100000,seed=None,stream=0,chainfile=None,keepchain=True,quantiles=(0.025,0.975),statburnin=None,stopping=None):
         res = None
+        stats = None
         if not retim:
-            res = container(crimefree=self.crimefree,totaliternum=M,adaptnum=Madapt,alpha=alpha,prior='tv',method='mwg',noise=self.noise,imagefilename=self.filename,target=self.targetimage,targetsize=self.dim,globalprefix=self.globalprefix,theta=self.theta/(2*np.pi)*360)
-        from cyt import mwg_tv as mwgt
-        regN = np.diag([1] * self.dim, 0) + np.diag([-1] * (self.dim - 1), 1);
-        regN = sp.csc_matrix(regN[0:-1, :])
-        help = np.zeros((2, self.dim));
-        help[0, 0] = 1;
-        help[1, self.dim - 1] = 1
-        help2 = np.hstack([np.zeros((self.dim - 2, 1)), np.eye(self.dim - 2), np.zeros((self.dim - 2, 1))])
-        # regvalues = np.array([1, -1, 1])
-        # offsets = np.array([-self.dim + 1, 0, 1])
-        # reg1d = sp.diags(regvalues, offsets, shape=(self.dim, self.dim))
-        # reg1d = sp.csc_matrix(reg1d)
-        # reg1d[self.dim-1,self.dim-1] = 0
-        # print(np.linalg.matrix_rank(reg1d.todense()))
-        # regx = sp.kron(sp.eye(self.dim), reg1d)
-        # regy = sp.kron(reg1d, sp.eye(self.dim))
-        # regx = sp.csc_matrix(regx)
-        # regy = sp.csc_matrix(regy)
-        regx = sp.kron(sp.eye(self.dim), regN)
-        regy = sp.kron(regN, sp.eye(self.dim))
-        regx = sp.csc_matrix(regx)
-        regy = sp.csc_matrix(regy)
-        regx2 = sp.kron(sp.csc_matrix(help2), sp.csc_matrix(help))
-        regy2 = sp.kron(sp.csc_matrix(help), sp.eye(self.dim))
-        self.radonoperator = sp.csc_matrix(self.radonoperator)
-        alpha = alpha
-        # combined = sp.vstack([regy, regx], format='csc')
-        combined = sp.vstack([regy, regx, regx2, regy2], format='csc')
+            res = container(crimefree=self.crimefree,totaliternum=M,adaptnum=Madapt,alpha=alpha,prior='tv',method='mwg',noise=self.noise,imagefilename=self.filename,target=self.targetimage,targetsize=self.dim,globalprefix=self.globalprefix,theta=self.theta/(2*np.pi)*360,chainfile=chainfile)
+            stats = posteriorstats(self.dim * self.dim, quantiles)
+        from cyt import mwg_tv as mwgt, mwgseed
         empty = sp.csc_matrix((1, self.dim * self.dim))
-        self.Q.Lx = combined
+        self.Q.Lx = differenceoperator(self.dim, 'anisotropic', Nthreads=self.num_threads)
         self.Q.Ly = empty
         self.Q.a = alpha
         self.Q.s2 = self.lhsigmsq
         self.Q.b = 0.00
         self.Q.y = self.lines
         if (mapstart):
-            x0 = np.reshape(self.map_tv(alpha, maxiter=150), (-1, 1))
+            x0 = np.reshape(self.map_tv(alpha, maxiter=150, x0=self.pyramidstart(mapstart, 'tv', alpha)), (-1, 1))
             x0 = x0 + 0.000001 * np.random.rand(self.dim * self.dim, 1)
         else:
             x0 = 0.0 + 0.01*np.random.randn(self.dim * self.dim, 1)
         print("Running MwG MCMC for TV prior.")
-        solution,chain= mwgt(M, Madapt, self.Q, x0, sampsigma=1.0, cmonly=retim,thinning=thinning,interstep=interstep,intername=res.intermedfilename)
+        seed = mwgseed(seed)
+        if not retim:
+            res.seed = seed
+            res.stream = stream
+        solution,chain= mwgt(M, Madapt, self.Q, x0, sampsigma=1.0, cmonly=retim or not keepchain,thinning=thinning,interstep=interstep,intername=getattr(res, 'intermedfilename', None),Nthreads=self.num_threads,seed=seed,stream=stream,chainfile=chainfile,stats=stats,statburnin=statburnin,stopping=stopping)
         solution = np.reshape(solution, (-1, 1))
         solution = np.reshape(solution, (self.dim, self.dim))
         if not retim:
-            res.finish(result=solution, error=self.difference(solution),chain=chain,thinning=thinning)
+            stats.store(res, self.dim)
+            res.finish(result=solution, error=self.difference(solution),chain=chain,thinning=thinning,iters=getattr(stopping, 'iterations', None))
             return res
         else:
             return solution
 
-    def mwg_cauchy(self, alpha, M=10000, Madapt=1000,mapstart=False,thinning=10,retim=True,interstep=100000,isotropic=True):
+    def mwg_cauchy(self, alpha, M=10000, Madapt=1000,mapstart=False,thinning=10,retim=True,interstep=100000,isotropic=True,seed=None,stream=0,chainfile=None,keepchain=True,quantiles=(0.025,0.975),statburnin=None,stopping=None):
         res = None
+        stats = None
         if not retim:
-            res = container(crimefree=self.crimefree,totaliternum=M,adaptnum=Madapt,alpha=alpha,prior='cauchy',method='mwg',noise=self.noise,imagefilename=self.filename,target=self.targetimage,targetsize=self.dim,globalprefix=self.globalprefix,theta=self.theta/(2*np.pi)*360)
-        from cyt import mwg_cauchy as mwgc, mwg_isocauchy as mwgciso
+            res = container(crimefree=self.crimefree,totaliternum=M,adaptnum=Madapt,alpha=alpha,prior='cauchy',method='mwg',noise=self.noise,imagefilename=self.filename,target=self.targetimage,targetsize=self.dim,globalprefix=self.globalprefix,theta=self.theta/(2*np.pi)*360,chainfile=chainfile)
+            stats = posteriorstats(self.dim * self.dim, quantiles)
+        from cyt import mwg_cauchy as mwgc, mwg_isocauchy as mwgciso, mwgseed
         if(isotropic==False):
-            regN = np.diag([1]*self.dim,0) + np.diag([-1]*(self.dim-1),1);
-            regN = sp.csc_matrix(regN[0:-1,:])
-            help = np.zeros((2,self.dim)); help[0,0] = 1; help[1,self.dim-1] = 1
-            help2 = np.hstack([np.zeros((self.dim-2,1)),np.eye(self.dim-2),np.zeros((self.dim-2,1))])
-            #regvalues = np.array([1, -1, 1])
-            #offsets = np.array([-self.dim + 1, 0, 1])
-            # reg1d = sp.diags(regvalues, offsets, shape=(self.dim, self.dim))
-            # reg1d = sp.csc_matrix(reg1d)
-            # reg1d[self.dim-1,self.dim-1] = 0
-            # print(np.linalg.matrix_rank(reg1d.todense()))
-            # regx = sp.kron(sp.eye(self.dim), reg1d)
-            # regy = sp.kron(reg1d, sp.eye(self.dim))
-            # regx = sp.csc_matrix(regx)
-            # regy = sp.csc_matrix(regy)
-            regx = sp.kron(sp.eye(self.dim), regN)
-            regy = sp.kron(regN, sp.eye(self.dim))
-            regx = sp.csc_matrix(regx)
-            regy = sp.csc_matrix(regy)
-            regx2 = sp.kron( sp.csc_matrix(help2), sp.csc_matrix(help))
-            regy2 = sp.kron( sp.csc_matrix(help), sp.eye(self.dim))
-            self.radonoperator = sp.csc_matrix(self.radonoperator)
-            alpha = alpha
-            #combined = sp.vstack([regy, regx], format='csc')
-            combined = sp.vstack([regy, regx,regx2,regy2], format='csc')
             empty = sp.csc_matrix((1, self.dim * self.dim))
-            self.Q.Lx = combined
+            self.Q.Lx = differenceoperator(self.dim, 'anisotropic', Nthreads=self.num_threads)
             self.Q.Ly = empty
             self.Q.a = alpha
             self.Q.s2 = self.lhsigmsq
@@ -877,69 +1012,52 @@ class tomography:
             self.Q.y = self.lines
 
         else:
-            dim = self.dim
-            regvalues = np.array([1, -1, 1])
-            offsets = np.array([-dim + 1, 0, 1])
-            reg1d = sp.diags(regvalues, offsets, shape=(dim, dim))
-            reg1d = sp.csc_matrix(reg1d)
-            reg1d[dim - 1, dim - 1] = 0
-            regx = sp.kron(sp.eye(dim), reg1d)
-            regy = sp.kron(reg1d, sp.eye(dim))
-            regx = sp.csc_matrix(regx)
-            regy = sp.csc_matrix(regy)
-
-            rmxix = np.sum(np.abs(regx), axis=1) == 1
-            rmyix = np.sum(np.abs(regy), axis=1) == 1
-            boundary = rmxix + rmyix
-            regx[np.ravel(boundary), :] = 0
-            regy[np.ravel(boundary), :] = 0
-
-            bmatrix = sp.csc_matrix((dim * dim, dim * dim))
-            q = np.where((np.ravel(boundary) == True))
-            bmatrix[q, q] = 1
-
-            self.Q.Lx = regx
-            self.Q.Ly = regy
+            self.Q.Lx = differenceoperator(self.dim, 'isotropicx', Nthreads=self.num_threads)
+            self.Q.Ly = differenceoperator(self.dim, 'isotropicy', Nthreads=self.num_threads)
             self.Q.a = alpha
             self.Q.boundarya = alpha
             self.Q.s2 = self.lhsigmsq
             self.Q.b = 0.01
-            self.Q.boun = bmatrix
+            self.Q.boun = differenceoperator(self.dim, 'boundary', Nthreads=self.num_threads)
 
         if mapstart:
-            x0 = np.reshape(self.map_cauchy(alpha, maxiter=400), (-1, 1))
+            x0 = np.reshape(self.map_cauchy(alpha, maxiter=400, x0=self.pyramidstart(mapstart, 'cauchy', alpha)), (-1, 1))
             x0 = x0 + 0.000001 * np.random.rand(self.dim * self.dim, 1)
         else:
             x0 = 0.0 + 0.00*np.random.randn(self.dim * self.dim, 1)
         print("Running MwG MCMC for Cauchy prior.")
+        seed = mwgseed(seed)
+        if not retim:
+            res.seed = seed
+            res.stream = stream
         if(isotropic):
-            solution, chain = mwgciso(M, Madapt, self.Q, x0, sampsigma=1.0, cmonly=retim, thinning=thinning,interstep=interstep, intername=res.intermedfilename)
+            solution, chain = mwgciso(M, Madapt, self.Q, x0, sampsigma=1.0, cmonly=retim or not keepchain, thinning=thinning,interstep=interstep, intername=getattr(res, 'intermedfilename', None),Nthreads=self.num_threads,seed=seed,stream=stream,chainfile=chainfile,stats=stats,statburnin=statburnin,stopping=stopping)
         else:
-            solution, chain = mwgc(M, Madapt, self.Q, x0, sampsigma=1.0, cmonly=retim, thinning=thinning,interstep=interstep,intername=res.intermedfilename)
+            solution, chain = mwgc(M, Madapt, self.Q, x0, sampsigma=1.0, cmonly=retim or not keepchain, thinning=thinning,interstep=interstep,intername=getattr(res, 'intermedfilename', None),Nthreads=self.num_threads,seed=seed,stream=stream,chainfile=chainfile,stats=stats,statburnin=statburnin,stopping=stopping)
         solution = np.reshape(solution, (-1, 1))
         solution = np.reshape(solution, (self.dim, self.dim))
         if not retim:
-            res.finish(result=solution, error=self.difference(solution),chain=chain,thinning=thinning)
+            stats.store(res, self.dim)
+            res.finish(result=solution, error=self.difference(solution),chain=chain,thinning=thinning,iters=getattr(stopping, 'iterations', None))
             return res
         else:
             return solution
 
-    def mwg_wavelet(self, alpha, M=10000, Madapt=1000,type='haar',levels=None,mapstart=False,thinning=10,retim=True,interstep=100000):
+    def mwg_wavelet(self, alpha, M=10000, Madapt=1000,type='haar',levels=None,mapstart=False,thinning=10,retim=True,interstep=100000,seed=None,stream=0,chainfile=None,keepchain=True,quantiles=(0.025,0.975),statburnin=None,stopping=None):
         res = None
+        stats = None
         if (levels is None):
             levels = int(np.floor(np.log2(self.dim))-1)
         if not retim:
-            res = container(crimefree=self.crimefree,totaliternum=M,levels=levels,adaptnum=Madapt,alpha=alpha,prior=type,method='mwg',noise=self.noise,imagefilename=self.filename,target=self.targetimage,targetsize=self.dim,globalprefix=self.globalprefix,theta=self.theta/(2*np.pi)*360)
-        from matrices import totalmatrix
-        from cyt import mwg_tv as mwgt
+            res = container(crimefree=self.crimefree,totaliternum=M,levels=levels,adaptnum=Madapt,alpha=alpha,prior=type,method='mwg',noise=self.noise,imagefilename=self.filename,target=self.targetimage,targetsize=self.dim,globalprefix=self.globalprefix,theta=self.theta/(2*np.pi)*360,chainfile=chainfile)
+            stats = posteriorstats(self.dim * self.dim, quantiles)
+        from cyt import mwg_tv as mwgt, mwgseed
         wl = pywt.Wavelet(type)
         g = np.array(wl.dec_lo)
         h = np.array(wl.dec_hi)
-        regx = totalmatrix(self.dim, levels, g, h)
+        regx = waveletoperator(self.dim, levels, g, h, Nthreads=self.num_threads)
         regy = sp.csc_matrix((1, self.dim * self.dim))
-        regx = sp.csc_matrix(regx)
         regy = sp.csc_matrix(regy)
-        self.radonoperator = sp.csc_matrix(self.radonoperator)
         alpha = alpha
         self.Q.Lx = regx
         self.Q.b = 0.0000
@@ -947,20 +1065,62 @@ class tomography:
         self.Q.a = alpha
         self.Q.s2 = self.lhsigmsq
         if (mapstart):
-            x0 = np.reshape(self.map_wavelet(alpha, type=type,levels=levels, maxiter=150), (-1, 1))
+            x0 = np.reshape(self.map_wavelet(alpha, type=type,levels=levels, maxiter=150, x0=self.pyramidstart(mapstart, 'wavelet', alpha, type=type, levels=levels)), (-1, 1))
             x0 = x0 + 0.000001 * np.random.rand(self.dim * self.dim, 1)
         else:
             x0 = 0.0 + 0.01*np.random.randn(self.dim * self.dim, 1)
         print("Running MwG MCMC for Besov prior (" + type + ' '  + str(levels) + ').' )
-        solution,chain= mwgt(M, Madapt, self.Q, x0, sampsigma=1.0, cmonly=retim,thinning=thinning,interstep=interstep,intername=res.intermedfilename)
+        seed = mwgseed(seed)
+        if not retim:
+            res.seed = seed
+            res.stream = stream
+        solution,chain= mwgt(M, Madapt, self.Q, x0, sampsigma=1.0, cmonly=retim or not keepchain,thinning=thinning,interstep=interstep,intername=getattr(res, 'intermedfilename', None),Nthreads=self.num_threads,seed=seed,stream=stream,chainfile=chainfile,stats=stats,statburnin=statburnin,stopping=stopping)
         solution = np.reshape(solution, (-1, 1))
         solution = np.reshape(solution, (self.dim, self.dim))
         if not retim:
-            res.finish(result=solution, error=self.difference(solution),chain=chain,thinning=thinning)
+            stats.store(res, self.dim)
+            res.finish(result=solution, error=self.difference(solution),chain=chain,thinning=thinning,iters=getattr(stopping, 'iterations', None))
             return res
         else:
             return solution
 
+    # Runs n_chains independent chains of the given sampler method (e.g. 'mwg_tv' or 'hmcmc_cauchy') in a process pool.
+    # The Radon operator is placed once in shared memory, and each chain runs on num_threads threads. The other keyword arguments
+    # are passed to the method. The MwG chains use the same seed with streams 0, ..., n_chains-1, while the other methods get
+    # their own seeds for NumPy's generator. Returns a container whose result is the pooled CM estimate, cms holds the CM of
+    # every chain and chain the chains stacked along the first axis.
+    def run_chains(self, method, n_chains, n_workers=None, num_threads=1, seed=None, **kwargs):
+        from ensemble import runchains
+        from cyt import mwgseed
+        if not (method.startswith('mwg_') or method.startswith('hmcmc_')):
+            raise Exception('Unknown sampler ' + method + '.')
+        start = time.time()
+        seed = mwgseed(seed)
+        npseeds = np.random.SeedSequence(seed).generate_state(n_chains)
+        kwargs['retim'] = False
+        kwargslist = []
+        for k in range(n_chains):
+            kw = dict(kwargs)
+            if method.startswith('mwg_'):
+                kw['seed'] = seed
+                kw['stream'] = k
+            kwargslist.append(kw)
+        results = runchains(self, method, kwargslist, npseeds, n_workers=n_workers, Nthreads=num_threads)
+        first = results[0]
+        res = container(crimefree=first.crimefree, totaliternum=first.totaliternum, adaptnum=first.adaptnum, alpha=first.alpha,
+                        prior=first.prior, method=first.method, levels=first.levels, noise=first.noise, imagefilename=first.imagefilename,
+                        target=first.target, targetsize=first.targetsize, globalprefix=first.globalprefix, theta=first.theta, seed=seed)
+        res.spent = start
+        res.stream = np.array([r.stream for r in results])
+        res.chainseeds = np.array(npseeds)
+        res.cms = np.stack([r.result for r in results])
+        chain = None
+        if all(r.chain is not None for r in results):
+            chain = np.stack([r.chain for r in results])
+        result = np.mean(res.cms, axis=0)
+        res.finish(result=result, error=self.difference(result), chain=chain, thinning=first.thinning)
+        return res
+
     def target(self):
         return self.targetimage
 
@@ -1024,7 +1184,7 @@ if __name__ == "__main__":
     parser.add_argument('--itheta', default=180,nargs="+", type=int, help='Range and/or number of radon measurement '
     'angles in degrees. One must enter either 3 values (start angle, end angle, number of angles) or just the number of angles, in case the range 0-180 is assumed. Default=50')
     parser.add_argument('--globalprefix', default="/results/", type=str, help='Relative prefix to the script itself, if one wants to save the results. Default= /results/')
-    parser.add_argument('--sampler', default="map", type=str, help='Method to use: hmc, mwg or map. Default= map')
+    parser.add_argument('--sampler', default="map", type=str, help='Method to use: hmc, mwg, map or po (exact samples, only Tikhonov). Default= map')
     parser.add_argument('--levels', default=None, type=int, help='Number of DWT levels to be used. Default=None means automatic.')
     parser.add_argument('--prior', default="tikhonov", type=str,
                         help='Prior to use: tikhonov, cauchy, tv or wavelet. Default= cauchy')
@@ -1054,6 +1214,9 @@ if __name__ == "__main__":
                 r = t.hmcmc_wavelet(alpha=args.alpha, M=args.samples_num, Madapt=args.adapt_num,type=args.wave,levels=args.levels,thinning=args.thinning)
             elif args.prior == "tikhonov":
                 r = t.hmcmc_tikhonov(alpha=args.alpha, M=args.samples_num, Madapt=args.adapt_num,thinning=args.thinning)
+        elif args.sampler == "po":
+            if args.prior == "tikhonov":
+                r = t.hmcmc_tikhonov(alpha=args.alpha, M=args.samples_num, thinning=args.thinning, variant='po')
         elif args.sampler == "mwg":
             if args.prior == "cauchy":
                 r = t.mwg_cauchy(alpha=args.alpha, M=args.samples_num, Madapt=args.adapt_num,thinning=args.thinning)
@@ -1143,17 +1306,11 @@ if __name__ == "__main__":
         for size in sizes:
             for angletype,angle in angles.items():
                     for noise in noises:
-                        bestl2 = np.Inf
-                        best = 0
                         t = tomography("slices/299.mat", size, angle, noise, crimefree=True, commonprefix='/results/')
                         t2 = tomography("slices/299.mat", size, angle, noise, crimefree=True, commonprefix='/results/')
-                        for alpha in alphas:
-                            res = t.map_tikhonov(alpha, retim=False,maxiter=500)
-                            res2 = t2.map_tikhonov(alpha, retim=False, maxiter=500)
-                            if ((res.l2 + res2.l2)/2.0 < bestl2):
-                                best = alpha
-                                bestl2 = (res.l2 + res2.l2)/2.0
-                        tikhoalpha[angletype][size][noise] = best
+                        res = t.alpha_sweep('tikhonov', alphas, maxiter=500, n_workers=4)
+                        res2 = t2.alpha_sweep('tikhonov', alphas, maxiter=500, n_workers=4)
+                        tikhoalpha[angletype][size][noise] = res.alphas[np.argmin(res.l2s + res2.l2s)]
 
         jsontik = json.dumps(tikhoalpha)
         f = open("tikhonov.json", "w")
@@ -1166,17 +1323,11 @@ if __name__ == "__main__":
         for size in sizes:
             for angletype, angle in angles.items():
                 for noise in noises:
-                    bestl2 = np.Inf
-                    best = 0
                     t = tomography("slices/299.mat", size, angle, noise, crimefree=True, commonprefix='/results/')
                     t2 = tomography("slices/299.mat", size, angle, noise, crimefree=True, commonprefix='/results/')
-                    for alpha in alphas:
-                        res = t.map_tv(alpha, retim=False, maxiter=500)
-                        res2 = t2.map_tv(alpha, retim=False, maxiter=500)
-                        if ((res.l2 + res2.l2) / 2.0 < bestl2):
-                            best = alpha
-                            bestl2 = (res.l2 + res2.l2) / 2.0
-                    tvalpha[angletype][size][noise] = best
+                    res = t.alpha_sweep('tv', alphas, maxiter=500, n_workers=4)
+                    res2 = t2.alpha_sweep('tv', alphas, maxiter=500, n_workers=4)
+                    tvalpha[angletype][size][noise] = res.alphas[np.argmin(res.l2s + res2.l2s)]
 
         jsontv = json.dumps(tvalpha)
         f = open("tv.json", "w")
@@ -1189,17 +1340,11 @@ if __name__ == "__main__":
         for size in sizes:
             for angletype, angle in angles.items():
                 for noise in noises:
-                    bestl2 = np.Inf
-                    best = 0
                     t = tomography("slices/299.mat", size, angle, noise, crimefree=True, commonprefix='/results/')
                     t2 = tomography("slices/299.mat", size, angle, noise, crimefree=True, commonprefix='/results/')
-                    for alpha in alphas:
-                        res = t.map_cauchy(alpha, retim=False, maxiter=500)
-                        res2 = t2.map_cauchy(alpha, retim=False, maxiter=500)
-                        if ((res.l2 + res2.l2) / 2.0 < bestl2):
-                            best = alpha
-                            bestl2 = (res.l2 + res2.l2) / 2.0
-                    cauchyalpha[angletype][size][noise] = best
+                    res = t.alpha_sweep('cauchy', alphas, maxiter=500, n_workers=4)
+                    res2 = t2.alpha_sweep('cauchy', alphas, maxiter=500, n_workers=4)
+                    cauchyalpha[angletype][size][noise] = res.alphas[np.argmin(res.l2s + res2.l2s)]
 
         jsoncau= json.dumps(cauchyalpha)
         f = open("cauchy.json", "w")
@@ -1212,17 +1357,11 @@ if __name__ == "__main__":
         for size in sizes:
             for angletype, angle in angles.items():
                 for noise in noises:
-                    bestl2 = np.Inf
-                    best = 0
                     t = tomography("slices/299.mat", size, angle, noise, crimefree=True, commonprefix='/results/')
                     t2 = tomography("slices/299.mat", size, angle, noise, crimefree=True, commonprefix='/results/')
-                    for alpha in alphas:
-                        res = t.map_wavelet(alpha, type='haar', retim=False, maxiter=500)
-                        res2 = t2.map_wavelet(alpha, type='haar', retim=False, maxiter=500)
-                        if ((res.l2 + res2.l2) / 2.0 < bestl2):
-                            best = alpha
-                            bestl2 = (res.l2 + res2.l2) / 2.0
-                    haaralpha[angletype][size][noise] = best
+                    res = t.alpha_sweep('wavelet', alphas, type='haar', maxiter=500, n_workers=4)
+                    res2 = t2.alpha_sweep('wavelet', alphas, type='haar', maxiter=500, n_workers=4)
+                    haaralpha[angletype][size][noise] = res.alphas[np.argmin(res.l2s + res2.l2s)]
 
         jsonhaar = json.dumps(haaralpha)
         f = open("haar.json", "w")
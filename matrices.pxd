@@ -0,0 +1,26 @@
+# Common base class for operators which are applied without storing a sparse matrix.
+# Column j lists the nonzero rows and values of the operator's column j. It is written to the given buffers,
+# which must be at least maxcolumn() long. The function returns the number of nonzeros in the column.
+cdef class linearoperator:
+    cdef public int Nthreads
+    cdef public tuple shape
+    cdef int maxcolumn(self)
+    cdef int column(self, int j, int* rows, double* vals) noexcept nogil
+
+
+cdef class radonprojector(linearoperator):
+    cdef int N
+    cdef int R
+    cdef int T
+    cdef double dx
+    cdef double xmin
+    cdef double ymin
+    cdef double dp
+    cdef double pmin
+    cdef double scale
+    cdef double[::1] tts
+    cdef double[::1] cs
+    cdef double[::1] ss
+    cdef double[::1] gct
+    cdef double[::1] gst
+    cdef double[::1] gtn
@@ -5,10 +5,12 @@ import scipy.sparse as sp
 from cython.parallel import prange
 from scipy.sparse import csr_matrix,csc_matrix,coo_matrix
 import math
-from libc.math cimport sqrt,fabs,exp, cos, tan,sin,M_SQRT2,M_PI,abs
+from libc.math cimport sqrt,fabs,exp, cos, tan,sin,M_SQRT2,M_PI,abs,floor,ceil,fmin,fmax
 from libcpp.list cimport list as cpplist
 from libcpp.deque cimport deque
 from libcpp.vector cimport vector
+from libcpp.utility cimport pair
+from libcpp.algorithm cimport sort
 import time
 from cython.parallel import threadid as thid
 from libc.stdlib cimport malloc 
@@ -140,141 +142,127 @@ def waveletonce(g,h,n):
 # Construct a discrete Radon transform matrix.
 # The method is from Peter Thoft's PhD thesis The Radon Transform - Theory and Implementation: https://orbit.dtu.dk/files/5529668/Binder1.pdf
 # The result is a matrix of ceil(sqrt(2)xN)xT x NxN. Four points are used in first order pixel oriented interpolation within each pixel's neighbourhood.
-ctypedef vector[int]* diptr
-ctypedef vector[double]* dfptr
+# Only the pixels within sqrt(2)/2 from each ray can have a nonzero weight, so only those are visited (see radonprojector.column).
+# The weights are the same as those of the original construction, which visited every pixel of every ray, up to rounding. Rays
+# which pass exactly through a pixel corner or the edge of the footprint are ties of gs, where rounding decides whether the
+# weight is kept (see tests/test_radonmatrix.py).
+# The CSC matrix is assembled directly in two passes over the pixels (columns). The first pass counts the nonzeros of each column
+# and the second one fills the preallocated indptr, indices and data arrays in sorted order. Hence there is no COO copy of the operator.
+# dtype is the type of the weights (np.float64 or np.float32). The indices are 64-bit if index64 is True, or if the number of
+# nonzeros does not fit 32 bits (e.g. 1024x1024 images with 360 angles). These two options are only for storing the matrix or
+# using it outside this library: sparseoperator (and hence tomography) needs 64-bit weights, at most 2^31-1 nonzeros and
+# indices which fit 32 bits, and it raises an exception otherwise. Larger geometries run with tomography(matrixfree=True).
 cdef double MP2 = M_PI/2.0
 cdef double MP4 = M_PI/4.0
 @cython.boundscheck(False) 
 @cython.wraparound(False)
 @cython.cdivision(True) 
-def  radonmatrix(size,theta,Nthreads=4):
-  
+def  radonmatrix(size,theta,Nthreads=4,dtype=np.float64,index64=False):
     cdef int Nth = Nthreads
-    cdef int i
-    
-    mrows = new vector[diptr](Nth)
-    mcols = new vector[diptr](Nth)
-    mdata = new vector[dfptr](Nth)
-    row = mrows[0]
-    col = mcols[0]
-    data = mdata[0]
-    
-    for i in range(Nth):
-        row[i] = new vector[int]()
-        col[i] = new vector[int]()
-        data[i] = new vector[double]()
-    
-    cdef int T = theta.shape[0]
-    cdef int N = size
-    cdef double dx = 1
-    cdef double dy = 1 
-    cdef int M = N
-    cdef int R = math.ceil(M_SQRT2*N)
-    cdef double xmin = -(N-1.0)/2.0
-    cdef double dp = 2.0*M_SQRT2*abs(xmin)/(R-1.0)
-    cdef double pmin = -(R-1.0)/2.0*dp
-    cdef double tmin = theta[0]
-    cdef double ymin = xmin
-    cdef double pmax = (R-1.0)/2.0*dp
-    cdef double tmax = theta[theta.shape[0]-1]
-    cdef double tt,ray,dt
-    cdef int t,m,n,r,th
-    if (T == 1):
-        dt = 0
-    else:
-        dt = (theta[1]-theta[0])
-         
-    # There are three options how a Radon operator is made. One might comment in the first ray row, the five rows after it  or alternatively 
-    # the last three ones. Averaging four line integral values
-    # might lead to more realistic sinogram with large dimensions and angles and it would make the operator denser.
-    # However, the averaging might make the sinogram perhaps worse with sparse angles (at least the angle averaging should be skipped and one should use rhoo
-    # averaging only, i.e. comment in the last three ray rows).
-    # See Peter Thoft's PhD thesis above
-    # (First order pixel oriented interpolation).
-    start = time.time() 
-    with nogil:                     
-        for r in prange (0,R,num_threads=Nth):
-            for t in range (0,T):               
-                tt = -(tmin + t*dt)
-                for n in range (0,N):
-                    for m in range( 0,M):
-                        ray = dx/2.0 * gs(2.0*(pmin+r*dp -(xmin+m*dx)*cos(tt)-(ymin+n*dy)*sin(tt) )/dx,tt)
-                        
-                        #ray = dx/2.0 * gs(2.0*(pmin+r*dp+dp/4.0 -(xmin+m*dx)*cos(tt+dt/4.0)-(ymin+n*dy)*sin(tt+dt/4.0) )/dx,tt+dt/4.0)
-                        #ray = ray + dx/2.0 * gs(2.0*(pmin+r*dp+dp/4.0 -(xmin+m*dx)*cos(tt-dt/4.0)-(ymin+n*dy)*sin(tt-dt/4.0) )/dx,tt-dt/4.0)
-                        #ray = ray + dx/2.0 * gs(2.0*(pmin+r*dp-dp/4.0 -(xmin+m*dx)*cos(tt+dt/4.0)-(ymin+n*dy)*sin(tt+dt/4.0) )/dx,tt+dt/4.0)
-                        #ray = ray + dx/2.0 * gs(2.0*(pmin+r*dp-dp/4.0 -(xmin+m*dx)*cos(tt-dt/4.0)-(ymin+n*dy)*sin(tt-dt/4.0) )/dx,tt-dt/4.0)
-                        #ray = ray/4.0
-                        
-                        #ray = dx/2.0 * gs(2.0*(pmin+r*dp+dp/4.0 -(xmin+m*dx)*cos(tt)-(ymin+n*dy)*sin(tt) )/dx,tt)
-                        #ray = ray + dx/2.0 * gs(2.0*(pmin+r*dp-dp/4.0 -(xmin+m*dx)*cos(tt)-(ymin+n*dy)*sin(tt) )/dx,tt)
-                        #ray = ray/2.0
-                        
-                        if(ray > 0.0):
-                            th = thid()
-                            row[th].push_back(r*T+t)
-                            col[th].push_back(n*M+m)
-                            data[th].push_back(ray) 
+    cdef radonprojector P = radonprojector(size, theta, 1.0, Nthreads)
+    cdef int N = P.N
+    cdef int R = P.R
+    cdef int T = P.T
+    cdef int D = N*N
+    cdef int size_ = P.maxcolumn()
+    rowbuf = np.zeros((Nth, size_), dtype=np.intc)
+    valbuf = np.zeros((Nth, size_))
+    cdef int [:, ::1] rowbufv = rowbuf
+    cdef double [:, ::1] valbufv = valbuf
+    counts = np.zeros((D+1,), dtype=np.int64)
+    cdef long long [::1] countsv = counts
+    cdef int j, th
 
-            
-    print("Radon transform matrix operator was constructed in " + str(time.time()-start) + " seconds.")     
-     
-    cdef int Nel = 0
-    for i in range(0,Nth):
-        Nel = Nel + row[i].size()
-
-    coo_row  = np.zeros((Nel,),dtype=np.int32)
-    cdef int [:] coo_rowv  = coo_row
-    coo_col  = np.zeros((Nel,),dtype=np.int32)
-    cdef int [:] coo_colv  = coo_col
-    coo_data = np.zeros((Nel,))
-    cdef double [:] coo_datav  = coo_data
-
-    i = 0
-    with nogil:
-        for j in range(0,Nth):
-            for k in range(row[j].size()):
-                coo_rowv[i] = row[j].back()
-                row[j].pop_back()
+    start = time.time()
+    for j in prange(D, nogil=True, num_threads=Nth):
+        th = thid()
+        countsv[j+1] = P.column(j, &rowbufv[th, 0], &valbufv[th, 0])
+    indptr = np.cumsum(counts)
+    Nel = int(indptr[D])
+    if (index64 or Nel > 2147483647):
+        indptr = indptr.astype(np.int64)
+        indices = np.zeros((Nel,), dtype=np.int64)
+    else:
+        indptr = indptr.astype(np.int32)
+        indices = np.zeros((Nel,), dtype=np.int32)
+    data = np.zeros((Nel,), dtype=dtype)
+    fillcolumns(P, indptr, indices, data, rowbuf, valbuf)
+    print("Radon transform matrix operator was constructed in " + str(time.time()-start) + " seconds.")
 
-                coo_colv[i] = col[j].back()
-                col[j].pop_back()
+    radonM = csc_matrix((data, indices, indptr), shape=(R*T,D), copy=False)
+    # Scipy would downcast the indices to 32 bits if they fit.
+    radonM.indices = indices
+    radonM.indptr = indptr
+    return radonM
 
-                coo_datav[i] = data[j].back()
-                data[j].pop_back()
-                i = i + 1
+ctypedef fused csrindex:
+    int
+    long long
 
+ctypedef fused csrdata:
+    float
+    double
 
-    
-    radonM = coo_matrix((coo_data, (coo_row, coo_col)), shape=(R*T,N*N))
-    radonM = csc_matrix(radonM)
-    
-    return radonM 
+# Second pass of radonmatrix. The nonzeros of each column are sorted by row and written to their place given by indptr.
+@cython.boundscheck(False) 
+@cython.wraparound(False)
+def fillcolumns(radonprojector P, csrindex[::1] indptr, csrindex[::1] indices, csrdata[::1] data, int[:, ::1] rowbuf, double[:, ::1] valbuf):
+    cdef int Nth = rowbuf.shape[0]
+    cdef int D = P.N*P.N
+    cdef int j, k, nnz, th
+    cdef long long i
+    cdef vector[vector[pair[int, double]]] pairs = vector[vector[pair[int, double]]](Nth)
+    for th in range(Nth):
+        pairs[th].resize(rowbuf.shape[1])
+    for j in prange(D, nogil=True, num_threads=Nth):
+        th = thid()
+        nnz = P.column(j, &rowbuf[th, 0], &valbuf[th, 0])
+        for k in range(nnz):
+            pairs[th][k].first = rowbuf[th, k]
+            pairs[th][k].second = valbuf[th, k]
+        sort(pairs[th].begin(), pairs[th].begin()+nnz)
+        i = indptr[j]
+        for k in range(nnz):
+            indices[i+k] = pairs[th][k].first
+            data[i+k] = <csrdata>pairs[th][k].second
  
 # Function which is called, when Radon operator matrix is constucted.
 @cython.boundscheck(False) 
 @cython.wraparound(False)
 @cython.cdivision(True) 
 cdef inline double gs(double p,double t) nogil:
+    cdef double ct, st, tnt
+    gsangle(t, &ct, &st, &tnt)
+    return gsc(p, ct, st, tnt)
+
+# The footprint of a pixel depends only on the angle modulo 90 degrees and it's symmetric with respect to 45 degrees.
+# This function folds the angle and returns its cosine, sine and tangent, so that they can be calculated once per angle.
+@cython.cdivision(True) 
+cdef inline void gsangle(double t, double* ct, double* st, double* tnt) nogil:
+    #t = (t%(M_PI/2.0))
+    t = (t % (MP2) + (MP2)) % MP2
+    if(t >= MP4):
+        t = MP2-t
+    ct[0] = cos(t)
+    st[0] = sin(t)
+    tnt[0] = tan(t)
+
+# The same as gs, but with the folded angle's cosine, sine and tangent given.
+@cython.cdivision(True) 
+cdef inline double gsc(double p, double ct, double st, double tnt) nogil:
     cdef double x1m
     cdef double x1
     cdef double y1
     if (p<0):
         p = -p
-   
-    #t = (t%(M_PI/2.0))
-    t = (t % (MP2) + (MP2)) % MP2
-    if(t >= MP4):
-        t = MP2-t
- 
     
     if( p > M_SQRT2):
         return 0.0
         #return a
     else:
-        x1m = p/cos(t) + tan(t)
-        x1 = p/cos(t) - tan(t)
-        y1 = p/sin(t) - 1.0/tan(t)
+        x1m = p/ct + tnt
+        x1 = p/ct - tnt
+        y1 = p/st - 1.0/tnt
         
    
         if (x1 < 1.0 and x1m  < 1.0):
@@ -290,4 +278,736 @@ cdef inline double gs(double p,double t) nogil:
             #return a
             
         else:
-            return -9.0
\ No newline at end of file
+            return -9.0
+
+
+# Base class for operators, which are not stored as sparse matrices. The class mimics the parts of the Scipy sparse
+# matrix interface that are used in the library: dot, @, T.dot and getcol. Subclasses implement matvec and rmatvec, which
+# take C-contiguous 2D arrays (one vector per column), and the column function, which is used by the MwG samplers.
+cdef class linearoperator:
+
+    def matvec(self, x):
+        raise NotImplementedError
+
+    def rmatvec(self, y):
+        raise NotImplementedError
+
+    def dot(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        if (x.ndim == 1):
+            return np.ravel(self.matvec(np.ascontiguousarray(np.reshape(x, (-1, 1)))))
+        return self.matvec(np.ascontiguousarray(x))
+
+    def rdot(self, y):
+        y = np.asarray(y, dtype=np.float64)
+        if (y.ndim == 1):
+            return np.ravel(self.rmatvec(np.ascontiguousarray(np.reshape(y, (-1, 1)))))
+        return self.rmatvec(np.ascontiguousarray(y))
+
+    def __matmul__(self, x):
+        return self.dot(x)
+
+    @property
+    def T(self):
+        return transposedoperator(self)
+
+    # Returns column j as a sparse matrix of one column, like getcol of Scipy.
+    def getcol(self, j):
+        cdef int n = self.maxcolumn()
+        rows = np.zeros((n,), dtype=np.intc)
+        vals = np.zeros((n,))
+        cdef int [::1] rowsv = rows
+        cdef double [::1] valsv = vals
+        cdef int nnz = self.column(j, &rowsv[0], &valsv[0])
+        return csc_matrix((vals[0:nnz], (rows[0:nnz], np.zeros((nnz,), dtype=np.intc))), shape=(self.shape[0], 1))
+
+    # Returns the whole operator as a CSC matrix, which is assembled column by column.
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def tocsc(self):
+        cdef int n = self.maxcolumn()
+        cdef int D = self.shape[1]
+        cdef int i, j, nnz
+        cdef vector[int] rows
+        cdef vector[double] vals
+        cdef int[::1] rowbuf = np.zeros((n,), dtype=np.intc)
+        cdef double[::1] valbuf = np.zeros((n,))
+        indptr = np.zeros((D + 1,), dtype=np.intc)
+        cdef int[::1] indptrv = indptr
+        with nogil:
+            for j in range(D):
+                nnz = self.column(j, &rowbuf[0], &valbuf[0])
+                for i in range(nnz):
+                    rows.push_back(rowbuf[i])
+                    vals.push_back(valbuf[i])
+                indptrv[j + 1] = rows.size()
+        indices = np.array(<int[:rows.size()]> rows.data(), dtype=np.intc) if rows.size() > 0 else np.zeros((0,), dtype=np.intc)
+        data = np.array(<double[:vals.size()]> vals.data()) if vals.size() > 0 else np.zeros((0,))
+        A = csc_matrix((data, indices, indptr), shape=self.shape)
+        A.sum_duplicates()
+        return A
+
+    cdef int maxcolumn(self):
+        return 1
+
+    cdef int column(self, int j, int* rows, double* vals) noexcept nogil:
+        return 0
+
+
+# Transpose of an linearoperator. Only dot is needed.
+class transposedoperator:
+    def __init__(self, op):
+        self.op = op
+        self.shape = (op.shape[1], op.shape[0])
+
+    def dot(self, y):
+        return self.op.rdot(y)
+
+    def __matmul__(self, y):
+        return self.dot(y)
+
+    @property
+    def T(self):
+        return self.op
+
+
+# Matrix-free version of radonmatrix. The weights are exactly the same as in radonmatrix, but they are calculated on the fly
+# and only for the pixels, which are within the footprint of a ray (distance to the ray at most sqrt(2)/2 pixels).
+# Scale multiplies all weights (tomography divides the operator by the image size).
+cdef double RAYHALF = M_SQRT2/2.0
+cdef class radonprojector(linearoperator):
+
+    def __init__(self, size, theta, scale=1.0, Nthreads=4):
+        cdef int t
+        self.N = size
+        self.T = theta.shape[0]
+        self.R = math.ceil(M_SQRT2*self.N)
+        self.dx = 1
+        self.xmin = -(self.N-1.0)/2.0
+        self.ymin = self.xmin
+        self.dp = 2.0*M_SQRT2*abs(self.xmin)/(self.R-1.0)
+        self.pmin = -(self.R-1.0)/2.0*self.dp
+        self.scale = scale
+        self.Nthreads = Nthreads
+        self.shape = (self.R*self.T, self.N*self.N)
+        if (self.N < 2):
+            raise Exception('Image size must be at least 2.')
+        if (self.T == 1):
+            dt = 0
+        else:
+            dt = (theta[1]-theta[0])
+        self.tts = np.zeros((self.T,))
+        self.cs = np.zeros((self.T,))
+        self.ss = np.zeros((self.T,))
+        self.gct = np.zeros((self.T,))
+        self.gst = np.zeros((self.T,))
+        self.gtn = np.zeros((self.T,))
+        for t in range(self.T):
+            self.tts[t] = -(theta[0] + t*dt)
+            self.cs[t] = cos(self.tts[t])
+            self.ss[t] = sin(self.tts[t])
+            gsangle(self.tts[t], &self.gct[t], &self.gst[t], &self.gtn[t])
+
+    def __reduce__(self):
+        theta = -np.asarray(self.tts)
+        return (radonprojector, (self.N, theta, self.scale, self.Nthreads))
+
+    cdef int maxcolumn(self):
+        return self.T*(<int>ceil(2.0*RAYHALF*self.dx/self.dp) + 5)
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    @cython.cdivision(True)
+    cdef int column(self, int j, int* rows, double* vals) noexcept nogil:
+        cdef int n = j // self.N
+        cdef int m = j % self.N
+        cdef int t, r, rlo, rhi
+        cdef int nnz = 0
+        cdef double proj, ray
+        for t in range(self.T):
+            proj = (self.xmin+m*self.dx)*self.cs[t] + (self.ymin+n*self.dx)*self.ss[t]
+            rlo = <int>floor((proj - RAYHALF*self.dx - self.pmin)/self.dp) - 1
+            rhi = <int>ceil((proj + RAYHALF*self.dx - self.pmin)/self.dp) + 1
+            if (rlo < 0):
+                rlo = 0
+            if (rhi > self.R-1):
+                rhi = self.R-1
+            for r in range(rlo, rhi+1):
+                ray = self.dx/2.0 * gsc(2.0*(self.pmin+r*self.dp -(self.xmin+m*self.dx)*self.cs[t]-(self.ymin+n*self.dx)*self.ss[t] )/self.dx,self.gct[t],self.gst[t],self.gtn[t])
+                if (ray > 0.0):
+                    rows[nnz] = r*self.T+t
+                    vals[nnz] = self.scale*ray
+                    nnz = nnz + 1
+        return nnz
+
+    # Projection. Every thread handles its own rho values, so the rows of the result are written without races.
+    # Pixel rows (or columns, for steep rays) are visited only within the ray's footprint.
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    @cython.cdivision(True)
+    def matvec(self, x):
+        cdef double [:, ::1] xv = x
+        cdef int K = xv.shape[1]
+        out = np.zeros((self.R*self.T, K))
+        cdef double [:, ::1] outv = out
+        cdef int N = self.N
+        cdef int T = self.T
+        cdef double dx = self.dx
+        cdef double xmin = self.xmin
+        cdef double ymin = self.ymin
+        cdef double pmin = self.pmin
+        cdef double dp = self.dp
+        cdef double scale = self.scale
+        cdef int r, t, n, m, k, lo, hi, row
+        cdef double rho, c, s, a, b, ray
+        for r in prange(self.R, nogil=True, num_threads=self.Nthreads):
+            rho = pmin + r*dp
+            for t in range(T):
+                c = self.cs[t]
+                s = self.ss[t]
+                row = r*T + t
+                if (fabs(c) >= fabs(s)):
+                    for n in range(N):
+                        a = (rho - (ymin+n*dx)*s - RAYHALF*dx)/c
+                        b = (rho - (ymin+n*dx)*s + RAYHALF*dx)/c
+                        if (a > b):
+                            a, b = b, a
+                        lo = <int>floor((a - xmin)/dx) - 1
+                        hi = <int>ceil((b - xmin)/dx) + 1
+                        if (lo < 0):
+                            lo = 0
+                        if (hi > N-1):
+                            hi = N-1
+                        for m in range(lo, hi+1):
+                            ray = dx/2.0 * gsc(2.0*(pmin+r*dp -(xmin+m*dx)*c-(ymin+n*dx)*s )/dx,self.gct[t],self.gst[t],self.gtn[t])
+                            if (ray > 0.0):
+                                for k in range(K):
+                                    outv[row, k] += scale*ray*xv[n*N+m, k]
+                else:
+                    for m in range(N):
+                        a = (rho - (xmin+m*dx)*c - RAYHALF*dx)/s
+                        b = (rho - (xmin+m*dx)*c + RAYHALF*dx)/s
+                        if (a > b):
+                            a, b = b, a
+                        lo = <int>floor((a - ymin)/dx) - 1
+                        hi = <int>ceil((b - ymin)/dx) + 1
+                        if (lo < 0):
+                            lo = 0
+                        if (hi > N-1):
+                            hi = N-1
+                        for n in range(lo, hi+1):
+                            ray = dx/2.0 * gsc(2.0*(pmin+r*dp -(xmin+m*dx)*c-(ymin+n*dx)*s )/dx,self.gct[t],self.gst[t],self.gtn[t])
+                            if (ray > 0.0):
+                                for k in range(K):
+                                    outv[row, k] += scale*ray*xv[n*N+m, k]
+        return out
+
+    # Backprojection. Every pixel is a column of the operator, so the pixels are divided between threads.
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    @cython.cdivision(True)
+    def rmatvec(self, y):
+        cdef double [:, ::1] yv = y
+        cdef int K = yv.shape[1]
+        cdef int D = self.N*self.N
+        out = np.zeros((D, K))
+        cdef double [:, ::1] outv = out
+        cdef int size = self.maxcolumn()
+        rowbuf = np.zeros((self.Nthreads, size), dtype=np.intc)
+        valbuf = np.zeros((self.Nthreads, size))
+        cdef int [:, ::1] rowbufv = rowbuf
+        cdef double [:, ::1] valbufv = valbuf
+        cdef int j, i, k, nnz, th
+        for j in prange(D, nogil=True, num_threads=self.Nthreads):
+            th = thid()
+            nnz = self.column(j, &rowbufv[th, 0], &valbufv[th, 0])
+            for i in range(nnz):
+                for k in range(K):
+                    outv[j, k] += valbufv[th, i]*yv[rowbufv[th, i], k]
+        return out
+
+
+# Difference operators of the priors as 2-D stencils on a row-major N x N image. They are the same matrices that were
+# built with Kronecker products, but nothing is stored: rows, columns and products are calculated from the pixel indices.
+# Kinds:
+# 'anisotropic': The horizontal and vertical differences of the given order (2, otherwise 1) followed by the boundary pixels.
+#                The rows are in the order of sp.vstack([regy, regx, regx2, regy2]), where regy = kron(regN, I) and regx = kron(I, regN).
+# 'isotropicx', 'isotropicy': Forward differences x[n,m+1]-x[n,m] and x[n+1,m]-x[n,m] at every pixel. The rows of the last image row and column are zero.
+# 'boundary': Diagonal matrix, which picks the pixels of the last image row and column.
+# 'neighbours': The pixels whose isotropic differences depend on a pixel (all weights are one). Used by the MwG sampler of the isotropic Cauchy prior.
+cdef enum:
+    DANISOTROPIC = 0
+    DISOX = 1
+    DISOY = 2
+    DBOUNDARY = 3
+    DNEIGHBOURS = 4
+
+differencekinds = {'anisotropic': DANISOTROPIC, 'isotropicx': DISOX, 'isotropicy': DISOY, 'boundary': DBOUNDARY, 'neighbours': DNEIGHBOURS}
+
+cdef class differenceoperator(linearoperator):
+    cdef int N
+    cdef int kind
+    cdef public int order
+    cdef int w
+    cdef int L
+    cdef double coef[3]
+    cdef int offx
+    cdef int offx2
+    cdef int offy2
+    cdef public str kindname
+
+    def __init__(self, size, kind='anisotropic', order=1, Nthreads=4):
+        if kind not in differencekinds:
+            raise Exception('Unknown difference operator ' + str(kind) + '.')
+        if (size < 3):
+            raise Exception('Image size must be at least 3.')
+        self.N = size
+        self.kind = differencekinds[kind]
+        self.kindname = kind
+        self.order = order
+        self.Nthreads = Nthreads
+        # As in the tomography class, any other order than 2 means first order differences.
+        if (order == 2):
+            self.w = 3
+            self.coef[0] = -1.0
+            self.coef[1] = 2.0
+            self.coef[2] = -1.0
+        else:
+            self.w = 2
+            self.coef[0] = 1.0
+            self.coef[1] = -1.0
+        self.L = self.N - self.w + 1
+        self.offx = self.L*self.N
+        self.offx2 = 2*self.L*self.N
+        self.offy2 = self.offx2 + 2*(self.N-2)
+        if (self.kind == DANISOTROPIC):
+            self.shape = (self.offy2 + 2*self.N, self.N*self.N)
+        else:
+            self.shape = (self.N*self.N, self.N*self.N)
+
+    def __reduce__(self):
+        return (differenceoperator, (self.N, self.kindname, self.order, self.Nthreads))
+
+    # Side length of the image.
+    @property
+    def size(self):
+        return self.N
+
+    cdef int maxcolumn(self):
+        return 2*self.w + 2
+
+    # Row i of the operator: the columns and weights are written to cols and vals.
+    @cython.cdivision(True)
+    cdef int row(self, int i, int* cols, double* vals) noexcept nogil:
+        cdef int N = self.N
+        cdef int n, m, a, q, k
+        if (self.kind == DANISOTROPIC):
+            if (i < self.offx):
+                a = i % N
+                q = i // N
+                for k in range(self.w):
+                    cols[k] = (q+k)*N + a
+                    vals[k] = self.coef[k]
+                return self.w
+            elif (i < self.offx2):
+                q = i - self.offx
+                a = q // self.L
+                q = q % self.L
+                for k in range(self.w):
+                    cols[k] = a*N + q + k
+                    vals[k] = self.coef[k]
+                return self.w
+            elif (i < self.offy2):
+                q = i - self.offx2
+                vals[0] = 1.0
+                if (q % 2 == 0):
+                    cols[0] = (q//2+1)*N
+                else:
+                    cols[0] = (q//2+1)*N + N-1
+                return 1
+            else:
+                q = i - self.offy2
+                vals[0] = 1.0
+                if (q < N):
+                    cols[0] = q
+                else:
+                    cols[0] = (N-1)*N + q - N
+                return 1
+        n = i // N
+        m = i % N
+        if (self.kind == DBOUNDARY):
+            if (n == N-1 or m == N-1):
+                cols[0] = i
+                vals[0] = 1.0
+                return 1
+            return 0
+        if (n == N-1 or m == N-1):
+            return 0
+        cols[0] = i
+        if (self.kind == DISOX):
+            cols[1] = i + 1
+            vals[0] = -1.0
+            vals[1] = 1.0
+            return 2
+        elif (self.kind == DISOY):
+            cols[1] = i + N
+            vals[0] = -1.0
+            vals[1] = 1.0
+            return 2
+        cols[1] = i + 1
+        cols[2] = i + N
+        vals[0] = 1.0
+        vals[1] = 1.0
+        vals[2] = 1.0
+        return 3
+
+    # Column j of the operator, i.e. the rows (differences) which depend on pixel j, in increasing order.
+    @cython.cdivision(True)
+    cdef int column(self, int j, int* rows, double* vals) noexcept nogil:
+        cdef int N = self.N
+        cdef int n = j // N
+        cdef int m = j % N
+        cdef int k, q
+        cdef int nnz = 0
+        if (self.kind == DANISOTROPIC):
+            for k in range(self.w-1, -1, -1):
+                q = n - k
+                if (q >= 0 and q < self.L):
+                    rows[nnz] = q*N + m
+                    vals[nnz] = self.coef[k]
+                    nnz = nnz + 1
+            for k in range(self.w-1, -1, -1):
+                q = m - k
+                if (q >= 0 and q < self.L):
+                    rows[nnz] = self.offx + n*self.L + q
+                    vals[nnz] = self.coef[k]
+                    nnz = nnz + 1
+            if (n >= 1 and n <= N-2):
+                if (m == 0):
+                    rows[nnz] = self.offx2 + 2*(n-1)
+                    vals[nnz] = 1.0
+                    nnz = nnz + 1
+                elif (m == N-1):
+                    rows[nnz] = self.offx2 + 2*(n-1) + 1
+                    vals[nnz] = 1.0
+                    nnz = nnz + 1
+            if (n == 0):
+                rows[nnz] = self.offy2 + m
+                vals[nnz] = 1.0
+                nnz = nnz + 1
+            elif (n == N-1):
+                rows[nnz] = self.offy2 + N + m
+                vals[nnz] = 1.0
+                nnz = nnz + 1
+            return nnz
+        if (self.kind == DBOUNDARY):
+            if (n == N-1 or m == N-1):
+                rows[0] = j
+                vals[0] = 1.0
+                return 1
+            return 0
+        if (self.kind != DISOX and n >= 1 and m < N-1):
+            rows[nnz] = j - N
+            vals[nnz] = 1.0
+            nnz = nnz + 1
+        if (self.kind != DISOY and m >= 1 and n < N-1):
+            rows[nnz] = j - 1
+            vals[nnz] = 1.0
+            nnz = nnz + 1
+        if (n < N-1 and m < N-1):
+            rows[nnz] = j
+            if (self.kind == DNEIGHBOURS):
+                vals[nnz] = 1.0
+            else:
+                vals[nnz] = -1.0
+            nnz = nnz + 1
+        return nnz
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def matvec(self, x):
+        cdef double [:, ::1] xv = x
+        cdef int K = xv.shape[1]
+        cdef int R = self.shape[0]
+        out = np.zeros((R, K))
+        cdef double [:, ::1] outv = out
+        colbuf = np.zeros((self.Nthreads, 3), dtype=np.intc)
+        valbuf = np.zeros((self.Nthreads, 3))
+        cdef int [:, ::1] colbufv = colbuf
+        cdef double [:, ::1] valbufv = valbuf
+        cdef int i, l, k, nnz, th
+        for i in prange(R, nogil=True, num_threads=self.Nthreads):
+            th = thid()
+            nnz = self.row(i, &colbufv[th, 0], &valbufv[th, 0])
+            for l in range(nnz):
+                for k in range(K):
+                    outv[i, k] += valbufv[th, l]*xv[colbufv[th, l], k]
+        return out
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def rmatvec(self, y):
+        cdef double [:, ::1] yv = y
+        cdef int K = yv.shape[1]
+        cdef int D = self.N*self.N
+        out = np.zeros((D, K))
+        cdef double [:, ::1] outv = out
+        cdef int size = self.maxcolumn()
+        rowbuf = np.zeros((self.Nthreads, size), dtype=np.intc)
+        valbuf = np.zeros((self.Nthreads, size))
+        cdef int [:, ::1] rowbufv = rowbuf
+        cdef double [:, ::1] valbufv = valbuf
+        cdef int j, l, k, nnz, th
+        for j in prange(D, nogil=True, num_threads=self.Nthreads):
+            th = thid()
+            nnz = self.column(j, &rowbufv[th, 0], &valbufv[th, 0])
+            for l in range(nnz):
+                for k in range(K):
+                    outv[j, k] += valbufv[th, l]*yv[rowbufv[th, l], k]
+        return out
+
+
+# One level of the periodized DWT along the rows of a (s x s). The lowpass (H) coefficients are written to lo and the highpass (G) ones to hi (s x s/2).
+# The filters are the reversed g and h, and the indexing is the same as in waveletonce.
+@cython.cdivision(True)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void dwtrows(double[:, ::1] a, double[:, ::1] lo, double[:, ::1] hi, double[::1] fg, double[::1] fh, int Nth) noexcept nogil:
+    cdef int s = a.shape[0]
+    cdef int s2 = s/2
+    cdef int fl = fg.shape[0]
+    cdef int fl2 = fl/2
+    cdef int r, k, col, c
+    cdef double sl, sh
+    for r in prange(s, num_threads=Nth):
+        for k in range(s2):
+            sl = 0.0
+            sh = 0.0
+            for col in range(fl):
+                c = modulo(-fl2 + col + 1 + k*2, s)
+                sl = sl + fg[col]*a[r, c]
+                sh = sh + fh[col]*a[r, c]
+            lo[r, k] = sl
+            hi[r, k] = sh
+
+# The same along the columns of t (s x s/2): outh = H t and outg = G t (s/2 x s/2).
+@cython.cdivision(True)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void dwtcols(double[:, ::1] t, double[:, ::1] outh, double[:, ::1] outg, double[::1] fg, double[::1] fh, int Nth) noexcept nogil:
+    cdef int s = t.shape[0]
+    cdef int s2 = t.shape[1]
+    cdef int fl = fg.shape[0]
+    cdef int fl2 = fl/2
+    cdef int k, c, col, rr
+    for k in prange(s2, num_threads=Nth):
+        for c in range(s2):
+            outh[k, c] = 0.0
+            outg[k, c] = 0.0
+        for col in range(fl):
+            rr = modulo(-fl2 + col + 1 + k*2, s)
+            for c in range(s2):
+                outh[k, c] = outh[k, c] + fg[col]*t[rr, c]
+                outg[k, c] = outg[k, c] + fh[col]*t[rr, c]
+
+# Adjoint of dwtrows: a = lo H^T + hi G^T. Row index c of the signal gets the coefficient k for which -fl2+col+1+2k = c (mod s).
+@cython.cdivision(True)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void idwtrows(double[:, ::1] lo, double[:, ::1] hi, double[:, ::1] a, double[::1] fg, double[::1] fh, int Nth) noexcept nogil:
+    cdef int s = a.shape[0]
+    cdef int fl = fg.shape[0]
+    cdef int fl2 = fl/2
+    cdef int r, c, col, q, k
+    cdef double sa
+    for r in prange(s, num_threads=Nth):
+        for c in range(s):
+            sa = 0.0
+            for col in range(fl):
+                q = modulo(c + fl2 - 1 - col, s)
+                if (q % 2 == 0):
+                    k = q/2
+                    sa = sa + fg[col]*lo[r, k] + fh[col]*hi[r, k]
+            a[r, c] = sa
+
+# Adjoint of dwtcols: t = H^T uh + G^T ug (s x s/2).
+@cython.cdivision(True)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void idwtcols(double[:, ::1] uh, double[:, ::1] ug, double[:, ::1] t, double[::1] fg, double[::1] fh, int Nth) noexcept nogil:
+    cdef int s = t.shape[0]
+    cdef int s2 = t.shape[1]
+    cdef int fl = fg.shape[0]
+    cdef int fl2 = fl/2
+    cdef int rr, c, col, q, k
+    for rr in prange(s, num_threads=Nth):
+        for c in range(s2):
+            t[rr, c] = 0.0
+        for col in range(fl):
+            q = modulo(rr + fl2 - 1 - col, s)
+            if (q % 2 == 0):
+                k = q/2
+                for c in range(s2):
+                    t[rr, c] = t[rr, c] + fg[col]*uh[k, c] + fh[col]*ug[k, c]
+
+
+# Multilevel 2-D DWT as an operator. The result is exactly the matrix of totalmatrix (same filters, periodization and row order),
+# but the transform and its adjoint are calculated with the cascade of one-level transforms in O(N^2 x filter length).
+# The rows of totalmatrix are the coarsest approximation followed by the details of every level from the coarsest to the finest,
+# each level in the order HG, GH, GG (vertical x horizontal filter).
+# For the columns (MwG), the one-dimensional level matrices H_i P_i and G_i P_i (P_i is the product of the lowpass matrices of the
+# finer levels) are stored as CSC, and a column is the outer product of their columns.
+cdef class waveletoperator(linearoperator):
+    cdef int N
+    cdef int levels
+    cdef double[::1] fg
+    cdef double[::1] fh
+    cdef int[:, ::1] colptr
+    cdef int[::1] colidx
+    cdef double[::1] colval
+    cdef int[:, ::1] blocks
+    cdef int maxcol
+    cdef object g
+    cdef object h
+
+    def __init__(self, size, levels, g, h, Nthreads=4):
+        cdef int i, n
+        if (levels < 1 or np.mod(size, 2**levels) != 0):
+            raise Exception('DWT level mismatch.')
+        g = np.ravel(np.asarray(g, dtype=np.float64))
+        h = np.ravel(np.asarray(h, dtype=np.float64))
+        if ((np.mod(g.shape[0], 2) != 0) or (g.shape[0] != h.shape[0])):
+            raise Exception('Signal or filter length is not divisible by 2.')
+        self.N = size
+        self.levels = levels
+        self.g = g
+        self.h = h
+        self.fg = np.ascontiguousarray(np.flip(g, 0))
+        self.fh = np.ascontiguousarray(np.flip(h, 0))
+        self.Nthreads = Nthreads
+        self.shape = (size*size, size*size)
+
+        # One-dimensional level matrices for the column access. Index 2*i is H_i P_i and 2*i+1 is G_i P_i.
+        mats = []
+        P = None
+        for i in range(levels):
+            (Gi, Hi) = waveletonce(g, h, int(size/(2**i)))
+            Gi = csc_matrix(Gi)
+            Hi = csc_matrix(Hi)
+            if P is None:
+                mats.append(csc_matrix(Hi))
+                mats.append(csc_matrix(Gi))
+                P = Hi
+            else:
+                mats.append(csc_matrix(Hi.dot(P)))
+                mats.append(csc_matrix(Gi.dot(P)))
+                P = Hi.dot(P)
+        ptr = np.zeros((2*levels, size+1), dtype=np.intc)
+        base = 0
+        for i in range(2*levels):
+            mats[i].sort_indices()
+            ptr[i, :] = mats[i].indptr + base
+            base = base + mats[i].nnz
+        self.colptr = ptr
+        self.colidx = np.concatenate([m.indices for m in mats]).astype(np.intc)
+        self.colval = np.concatenate([m.data for m in mats]).astype(np.float64)
+
+        # Blocks in the order of the rows: (vertical matrix, horizontal matrix, row offset, block width).
+        blocks = []
+        n = size//(2**levels)
+        blocks.append((2*(levels-1), 2*(levels-1), 0, n))
+        offset = n*n
+        for i in range(levels-1, -1, -1):
+            n = size//(2**(i+1))
+            blocks.append((2*i, 2*i+1, offset, n))
+            blocks.append((2*i+1, 2*i, offset + n*n, n))
+            blocks.append((2*i+1, 2*i+1, offset + 2*n*n, n))
+            offset = offset + 3*n*n
+        self.blocks = np.array(blocks, dtype=np.intc)
+        widths = np.array([np.max(np.diff(m.indptr)) for m in mats])
+        self.maxcol = int(sum([widths[b[0]]*widths[b[1]] for b in blocks]))
+
+    def __reduce__(self):
+        return (waveletoperator, (self.N, self.levels, self.g, self.h, self.Nthreads))
+
+    # Side length of the image.
+    @property
+    def size(self):
+        return self.N
+
+    cdef int maxcolumn(self):
+        return self.maxcol
+
+    @cython.cdivision(True)
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef int column(self, int j, int* rows, double* vals) noexcept nogil:
+        cdef int p = j // self.N
+        cdef int q = j % self.N
+        cdef int b, ka, kb, A, B, off, w
+        cdef int nnz = 0
+        for b in range(self.blocks.shape[0]):
+            A = self.blocks[b, 0]
+            B = self.blocks[b, 1]
+            off = self.blocks[b, 2]
+            w = self.blocks[b, 3]
+            for ka in range(self.colptr[A, p], self.colptr[A, p+1]):
+                for kb in range(self.colptr[B, q], self.colptr[B, q+1]):
+                    rows[nnz] = off + self.colidx[ka]*w + self.colidx[kb]
+                    vals[nnz] = self.colval[ka]*self.colval[kb]
+                    nnz = nnz + 1
+        return nnz
+
+    def matvec(self, x):
+        cdef int K = x.shape[1]
+        cdef int D = self.N*self.N
+        cdef int Nth = self.Nthreads
+        cdef int i, k, s, s2, off
+        out = np.zeros((D, K))
+        cdef double[:, ::1] a, lo, hi, ah, ag
+        for k in range(K):
+            a = np.ascontiguousarray(np.reshape(x[:, k], (self.N, self.N)))
+            res = np.zeros((D,))
+            s = self.N
+            off = D
+            for i in range(self.levels):
+                s2 = s//2
+                lo = np.zeros((s, s2))
+                hi = np.zeros((s, s2))
+                dwtrows(a, lo, hi, self.fg, self.fh, Nth)
+                off = off - 3*s2*s2
+                # HH is the next approximation, the details are HG, GH and GG.
+                ah = np.zeros((s2, s2))
+                ag = np.reshape(res[off+s2*s2:off+2*s2*s2], (s2, s2))
+                dwtcols(lo, ah, ag, self.fg, self.fh, Nth)
+                dwtcols(hi, np.reshape(res[off:off+s2*s2], (s2, s2)), np.reshape(res[off+2*s2*s2:off+3*s2*s2], (s2, s2)), self.fg, self.fh, Nth)
+                a = ah
+                s = s2
+            res[0:s*s] = np.ravel(a)
+            out[:, k] = res
+        return out
+
+    def rmatvec(self, y):
+        cdef int K = y.shape[1]
+        cdef int D = self.N*self.N
+        cdef int Nth = self.Nthreads
+        cdef int i, k, s, s2, off
+        out = np.zeros((D, K))
+        cdef double[:, ::1] a, lo, hi
+        for k in range(K):
+            yk = np.ascontiguousarray(y[:, k])
+            s2 = self.N >> self.levels
+            a = np.ascontiguousarray(np.reshape(yk[0:s2*s2], (s2, s2)))
+            off = s2*s2
+            for i in range(self.levels-1, -1, -1):
+                s2 = self.N >> (i+1)
+                s = 2*s2
+                lo = np.zeros((s, s2))
+                hi = np.zeros((s, s2))
+                idwtcols(a, np.reshape(yk[off+s2*s2:off+2*s2*s2], (s2, s2)), lo, self.fg, self.fh, Nth)
+                idwtcols(np.reshape(yk[off:off+s2*s2], (s2, s2)), np.reshape(yk[off+2*s2*s2:off+3*s2*s2], (s2, s2)), hi, self.fg, self.fh, Nth)
+                a = np.zeros((s, s))
+                idwtrows(lo, hi, a, self.fg, self.fh, Nth)
+                off = off + 3*s2*s2
+            out[:, k] = np.ravel(a)
+        return out
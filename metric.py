@@ -0,0 +1,127 @@
+import numpy as np
+
+# Inverse metric (inverse mass matrix) of the HMC samplers and its adaptation during the warmup.
+# The inverse metric is diag(s) (I + U diag(l) U^T) diag(s), where s^2 is the diagonal part (the marginal variances of the
+# posterior) and the columns of U are orthonormal directions in which the standardized posterior is wider (l > 0) or
+# narrower than the diagonal part. Without U it is the usual diagonal metric. The momenta are drawn from N(0, M), where M is
+# the inverse of it, so that the leapfrog steps see a posterior of roughly unit scale in every direction.
+class inversemetric:
+    def __init__(self, diagonal, vectors=None, values=None):
+        self.diagonal = np.ravel(np.array(diagonal, dtype=np.float64))
+        self.scale = np.sqrt(self.diagonal)
+        if (vectors is None or values is None or np.size(values) == 0):
+            self.vectors = np.zeros((self.diagonal.shape[0], 0))
+            self.values = np.zeros((0,))
+        else:
+            self.vectors = np.reshape(np.array(vectors, dtype=np.float64), (self.diagonal.shape[0], -1))
+            self.values = np.ravel(np.array(values, dtype=np.float64))
+        if (np.any(self.diagonal <= 0) or np.any(self.values <= -1.0)):
+            raise Exception('Inverse metric is not positive definite.')
+        # Factor of the momentum draws in the low-rank directions, (1 + l)^(-1/2) - 1.
+        self.factor = 1.0/np.sqrt(1.0 + self.values) - 1.0
+
+    # Momentum from a standard normal vector z.
+    def momentum(self, z):
+        p = np.ravel(z)
+        if (self.values.shape[0] > 0):
+            p = p + self.vectors.dot(self.factor*self.vectors.T.dot(p))
+        return np.reshape(p/self.scale, np.shape(z))
+
+    # Velocity M^-1 p.
+    def velocity(self, p):
+        v = self.scale*np.ravel(p)
+        if (self.values.shape[0] > 0):
+            v = v + self.vectors.dot(self.values*self.vectors.T.dot(v))
+        return np.reshape(self.scale*v, np.shape(p))
+
+    def kinetic(self, p):
+        return 0.5*np.dot(np.ravel(p), np.ravel(self.velocity(p)))
+
+    # Stores the metric to a result container.
+    def store(self, res):
+        res.metricdiag = self.diagonal
+        res.metricvectors = self.vectors
+        res.metricvalues = self.values
+
+# Inverse metric given as an inversemetric or a result container of an earlier run (see inversemetric.store).
+def asmetric(metric):
+    if (metric is None or isinstance(metric, inversemetric)):
+        return metric
+    if hasattr(metric, 'metricdiag'):
+        return inversemetric(metric.metricdiag, metric.metricvectors, metric.metricvalues)
+    raise Exception('Unknown metric.')
+
+# Windowed warmup as in Stan. The warmup iterations are split into an initial fast window (only the step size is adapted),
+# a series of slow windows, whose lengths double, and a terminal fast window. At the end of each slow window the inverse
+# metric is estimated from the draws of that window and the step size adaptation is restarted. If the warmup is too short
+# for the default windows, 15%, 75% and 10% of it are used.
+# Kind is 'diag' (marginal variances) or 'lowrank' (in addition, the rank leading eigenvectors of the covariance of the
+# standardized draws). The estimates are shrunk towards the identity (or towards the diagonal) like in Stan.
+class metricadaptation:
+    def __init__(self, dim, warmup, kind='diag', rank=5, metric=None, initial=75, terminal=50, base=25):
+        if (kind not in ('diag', 'lowrank')):
+            raise Exception('Unknown metric adaptation ' + str(kind) + '.')
+        if (initial + terminal + base > warmup):
+            initial = int(0.15*warmup)
+            terminal = int(0.1*warmup)
+            base = warmup - initial - terminal
+        self.dim = dim
+        self.kind = kind
+        self.rank = rank
+        self.metric = asmetric(metric)
+        self.ends = []
+        start = initial
+        size = base
+        while (size > 0):
+            end = start + size
+            if (end + 2*size > warmup - terminal):
+                self.ends.append(warmup - terminal)
+                break
+            self.ends.append(end)
+            start = end
+            size = 2*size
+        self.start = initial
+        self.count = 0
+        self.draws = []
+        self.n = 0
+        self.mean = np.zeros((dim,))
+        self.m2 = np.zeros((dim,))
+
+    # Adds the draw x of the next warmup iteration. Returns True if a window ended and the metric was updated.
+    def add(self, x):
+        self.count = self.count + 1
+        if (self.count <= self.start or len(self.ends) == 0):
+            return False
+        x = np.ravel(x)
+        self.n = self.n + 1
+        delta = x - self.mean
+        self.mean = self.mean + delta/self.n
+        self.m2 = self.m2 + delta*(x - self.mean)
+        if (self.kind == 'lowrank'):
+            self.draws.append(np.copy(x))
+        if (self.count < self.ends[0]):
+            return False
+        self.update()
+        self.start = self.ends.pop(0)
+        self.draws = []
+        self.n = 0
+        self.mean = np.zeros((self.dim,))
+        self.m2 = np.zeros((self.dim,))
+        return True
+
+    def update(self):
+        n = self.n
+        if (n < 3):
+            return
+        var = self.m2/(n - 1)
+        diagonal = n/(n + 5.0)*var + 1e-3*5.0/(n + 5.0)
+        vectors = None
+        values = None
+        if (self.kind == 'lowrank'):
+            z = (np.array(self.draws) - self.mean)/np.sqrt(diagonal)
+            (_, sv, vt) = np.linalg.svd(z/np.sqrt(n - 1), full_matrices=False)
+            e = sv**2
+            k = int(min(self.rank, np.sum(e > 1.0)))
+            vectors = vt[0:k, :].T
+            values = n*(e[0:k] - 1.0)/(n + 5.0)
+        self.metric = inversemetric(diagonal, vectors, values)
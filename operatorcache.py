@@ -0,0 +1,168 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+import scipy.sparse as sp
+
+# On-disk cache for the Radon operators.
+# An operator is stored in a directory named by a hash of every parameter used in its construction, so that two different
+# geometries never share a file. The CSC arrays are stored as uncompressed .npy files and loaded back as memory maps.
+# Hence all the processes using the same geometry share one copy of the operator in the page cache and loading it takes only milliseconds.
+# The CSR copy, which sparseoperator needs for the parallel product, is stored in the same way under the key followed by 't'.
+# The memory maps are opened in copy-on-write mode, so writing to them never changes the files.
+
+# Version tag of the cached operators. Increase it when radonmatrix changes so that the old files become invalid.
+OPERATORVERSION = 1
+
+# Hash of the construction parameters. Theta is hashed as raw bytes, so even tiny differences in the angles give a different key.
+def operatorkey(size, theta, scale=1.0, variant='pixel', dtype=np.float64, **kwargs):
+    theta = np.ascontiguousarray(theta, dtype=np.float64)
+    params = {'version': OPERATORVERSION, 'size': int(size), 'scale': float(scale), 'variant': variant,
+              'dtype': np.dtype(dtype).str, 'ntheta': int(theta.shape[0])}
+    params.update(kwargs)
+    h = hashlib.sha256()
+    h.update(json.dumps(params, sort_keys=True).encode())
+    h.update(theta.tobytes())
+    return h.hexdigest()[0:32]
+
+# Returns the cached operator as a CSC matrix, whose arrays are memory maps, or None if it's not in the cache.
+def loadoperator(key, directory='radonmatrix'):
+    path = os.path.join(directory, key)
+    if not os.path.isfile(os.path.join(path, 'shape.json')):
+        return None
+    with open(os.path.join(path, 'shape.json'), 'r') as f:
+        shape = tuple(json.load(f)['shape'])
+    data = np.load(os.path.join(path, 'data.npy'), mmap_mode='c')
+    indices = np.load(os.path.join(path, 'indices.npy'), mmap_mode='c')
+    indptr = np.load(os.path.join(path, 'indptr.npy'), mmap_mode='c')
+    return sp.csc_matrix((data, indices, indptr), shape=shape, copy=False)
+
+# Stores a CSC matrix to the cache. The files are first written to a temporary directory, which is then renamed,
+# so that other processes never see a partially written operator.
+def saveoperator(key, A, directory='radonmatrix', **meta):
+    A = sp.csc_matrix(A)
+    if not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, key)
+    if os.path.isdir(path):
+        return path
+    tmp = tempfile.mkdtemp(prefix='.' + key, dir=directory)
+    np.save(os.path.join(tmp, 'data.npy'), A.data)
+    np.save(os.path.join(tmp, 'indices.npy'), A.indices)
+    np.save(os.path.join(tmp, 'indptr.npy'), A.indptr)
+    return commitoperator(tmp, path, A.shape, meta)
+
+# Writes the shape file of an operator written to the temporary directory tmp and renames it to path. The shape file
+# is written last, since loadoperator uses it to check if the operator exists.
+def commitoperator(tmp, path, shape, meta):
+    meta = dict(meta)
+    meta['shape'] = [int(shape[0]), int(shape[1])]
+    with open(os.path.join(tmp, 'shape.json'), 'w') as f:
+        json.dump(meta, f)
+    try:
+        os.rename(tmp, path)
+    except OSError:
+        # Another process has stored the same operator in the meanwhile.
+        shutil.rmtree(tmp, ignore_errors=True)
+    return path
+
+# Loads the Radon operator of the given geometry from the cache, or constructs and stores it, if it's not found.
+# The weights are multiplied by scale before storing, so that loading does not need to make a scaled copy.
+# Returns (csc, csr). The CSR copy of sparseoperator is stored too, as the CSC arrays of the transpose, so that it's also
+# a memory map shared by the processes instead of a conversion in every one of them. It's added to operators cached before.
+def cachedradonmatrix(size, theta, scale=1.0, directory='radonmatrix'):
+    key = operatorkey(size, theta, scale=scale)
+    A = loadoperator(key, directory)
+    meta = {'size': int(size), 'scale': float(scale), 'theta': [float(t) for t in theta]}
+    if A is None:
+        from matrices import radonmatrix
+        A = radonmatrix(size, theta)
+        A = sp.csc_matrix(A * scale)
+        saveoperator(key, A, directory, **meta)
+        A = loadoperator(key, directory)
+    B = loadoperator(key + 't', directory)
+    if B is None:
+        saveoperator(key + 't', A.tocsr().T, directory, **meta)
+        B = loadoperator(key + 't', directory)
+    return (A, B.T)
+
+# Ingestion of external operators, e.g. the system matrices of measured data, which are stored as sparse MATLAB v7.3
+# (HDF5) matrices: a group with the datasets data, ir (row indices) and jc (column pointers) of the CSC format.
+# The arrays are read in chunks directly into their final arrays, and HDF5 converts the index types (usually 64-bit) to
+# the 32-bit ones of sparseoperator on the way, so the peak memory is the size of the matrix and no more. An uncompressed
+# data array of the right type is not read at all, but memory mapped from the file. If the operator is persisted, the final
+# arrays are memory maps of the .npy files of the cache, so the operator is written in the native format while it's read,
+# and later loads are just memory maps. The CSR copy of sparseoperator is then stored too, as the CSC arrays of the transpose.
+
+# Key of an external operator, which changes when the file is modified.
+def filekey(filename, name):
+    st = os.stat(filename)
+    params = {'version': OPERATORVERSION, 'file': os.path.abspath(filename), 'name': name, 'mtime': st.st_mtime_ns,
+              'bytes': st.st_size}
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()[0:32]
+
+# Returns the dataset as a memory map of the file, or None if it's chunked, compressed or of another type than dtype.
+def mapdataset(filename, ds, dtype):
+    offset = ds.id.get_offset()
+    if (offset is None or ds.chunks is not None or ds.dtype != np.dtype(dtype) or ds.size == 0):
+        return None
+    return np.memmap(filename, dtype=ds.dtype, mode='c', offset=offset, shape=ds.shape)
+
+# Reads the one-dimensional dataset to out in chunks of chunk elements.
+def readdataset(ds, out, chunk):
+    n = out.shape[0]
+    for k in range(0, n, chunk):
+        ds.read_direct(out, np.s_[k:min(k + chunk, n)], np.s_[k:min(k + chunk, n)])
+    return out
+
+# Sparse matrix of the group name of an HDF5 file as (csc, csr); csr is None unless the operator is persisted. The number
+# of rows is from shape, or from the MATLAB_sparse attribute of the group. With persist the operator is stored in directory.
+def readhdf5operator(filename, name, shape=None, persist=False, directory='radonmatrix', chunk=1 << 24):
+    import h5py
+    key = filekey(filename, name)
+    if persist:
+        A = loadoperator(key, directory)
+        if A is not None:
+            return (A, loadoperator(key + 't', directory).T)
+    with h5py.File(filename, 'r') as f:
+        group = f[name]
+        nnz = group['data'].shape[0]
+        cols = group['jc'].shape[0] - 1
+        if shape is None:
+            shape = (int(group.attrs['MATLAB_sparse']), cols)
+        if (shape[1] != cols):
+            raise Exception('Operator has ' + str(cols) + ' columns instead of ' + str(shape[1]) + '.')
+        if (shape[0] > 2147483647 or nnz > 2147483647):
+            raise Exception('Operator is too large for 32-bit indices.')
+        tmp = None
+        if persist:
+            if not os.path.exists(directory):
+                os.makedirs(directory, exist_ok=True)
+            tmp = tempfile.mkdtemp(prefix='.' + key, dir=directory)
+
+        def target(fname, n, dtype):
+            if tmp is None:
+                return np.empty((n,), dtype=dtype)
+            return np.lib.format.open_memmap(os.path.join(tmp, fname), mode='w+', dtype=dtype, shape=(n,))
+
+        try:
+            data = None if persist else mapdataset(filename, group['data'], np.float64)
+            if data is None:
+                data = readdataset(group['data'], target('data.npy', nnz, np.float64), chunk)
+            indices = readdataset(group['ir'], target('indices.npy', nnz, np.intc), chunk)
+            indptr = readdataset(group['jc'], target('indptr.npy', cols + 1, np.intc), chunk)
+        except BaseException:
+            if tmp is not None:
+                shutil.rmtree(tmp, ignore_errors=True)
+            raise
+    if not persist:
+        return (sp.csc_matrix((data, indices, indptr), shape=shape, copy=False), None)
+    for a in (data, indices, indptr):
+        a.flush()
+    del data, indices, indptr
+    commitoperator(tmp, os.path.join(directory, key), shape, {'file': os.path.abspath(filename), 'name': name})
+    A = loadoperator(key, directory)
+    saveoperator(key + 't', A.tocsr().T, directory, file=os.path.abspath(filename), name=name)
+    return (A, loadoperator(key + 't', directory).T)
@@ -0,0 +1,145 @@
+import numpy as np
+
+# First-order MAP solvers for the l1 priors (TV and Besov), which minimize the exact objective
+#     1/(2*s2) ||Mx - y||^2 + alpha ||Lx||_1
+# instead of smoothing the absolute value with sqrt(v^2 + beta) like the gradient based methods do. L is the difference
+# operator of TV or the wavelet transform. The solvers need only the products with M and L and their transposes, so they
+# work with all the operators of the library (sparse matrices, sparseoperator, radonprojector, differenceoperator and
+# waveletoperator). The objective is multiplied by s2 (the l1 weight is then alpha*s2), so that the step sizes depend only
+# on the operator norms. Every solver takes the estimates of ||M|| and ||L|| (see operatornorm), a starting point x0, and
+# stops when the relative change of the objective over every iterations is below tol, or after maxiter iterations.
+# Callback is called after every iteration. Returns the estimate and the number of iterations.
+
+# Largest singular value of A by power iteration on A^T A.
+def operatornorm(A, maxiter=100, tol=1e-6, seed=0):
+    x = np.random.RandomState(seed).randn(A.shape[1])
+    x = x/np.linalg.norm(x)
+    s = 0.0
+    for k in range(maxiter):
+        z = np.ravel(A.T.dot(np.ravel(A.dot(x))))
+        n = np.linalg.norm(z)
+        if (n == 0):
+            return 0.0
+        x = z/n
+        snew = np.sqrt(n)
+        if (abs(snew - s) <= tol*snew):
+            return snew
+        s = snew
+    return s
+
+# True if L^T L = I (e.g. the periodized DWT with orthonormal filters), checked with a random vector.
+def isometry(L, seed=1):
+    if (L.shape[0] != L.shape[1]):
+        return False
+    x = np.random.RandomState(seed).randn(L.shape[1])
+    return np.linalg.norm(np.ravel(L.T.dot(np.ravel(L.dot(x)))) - x) <= 1e-10*np.linalg.norm(x)
+
+def soft(v, t):
+    return np.sign(v)*np.maximum(np.abs(v) - t, 0.0)
+
+def objective(M, y, L, lam, x):
+    r = np.ravel(M.dot(x)) - y
+    return 0.5*np.dot(r, r) + lam*np.sum(np.abs(np.ravel(L.dot(x))))
+
+# Stopping test of the solvers, called after every iteration k. Returns True when the objective has converged.
+class convergence:
+    def __init__(self, M, y, L, lam, tol, every):
+        self.M = M
+        self.y = y
+        self.L = L
+        self.lam = lam
+        self.tol = tol
+        self.every = every
+        self.value = np.inf
+
+    def check(self, k, x):
+        if ((k + 1) % self.every != 0):
+            return False
+        value = objective(self.M, self.y, self.L, self.lam, x)
+        done = abs(self.value - value) <= self.tol*abs(value)
+        self.value = value
+        return done
+
+# FISTA (Beck and Teboulle). The proximal operator of the l1 term is the soft thresholding of the coefficients, if L is
+# an isometry (orthonormal wavelets). Otherwise (TV) it is solved from its dual with inner accelerated projected gradient
+# iterations, which are started from the dual of the previous iteration.
+def fista(M, y, s2, L, alpha, x0, normM, normL, maxiter=400, tol=1e-6, every=10, inner=5, callback=None):
+    y = np.ravel(y)
+    lam = alpha*s2
+    step = 1.0/normM**2
+    orthogonal = isometry(L)
+    x = np.array(np.ravel(x0), dtype=np.float64)
+    z = np.copy(x)
+    q = np.zeros((L.shape[0],))
+    t = 1.0
+    test = convergence(M, y, L, lam, tol, every)
+    k = 0
+    for k in range(maxiter):
+        v = z - step*np.ravel(M.T.dot(np.ravel(M.dot(z)) - y))
+        thr = step*lam
+        if orthogonal:
+            xnew = np.ravel(L.T.dot(soft(np.ravel(L.dot(v)), thr)))
+        else:
+            # Dual of min 1/2 ||x - v||^2 + thr ||Lx||_1: x = v - L^T q with |q| <= thr.
+            np.clip(q, -thr, thr, out=q)
+            r = np.copy(q)
+            ti = 1.0
+            for i in range(inner):
+                qnew = np.clip(r + np.ravel(L.dot(v - np.ravel(L.T.dot(r))))/normL**2, -thr, thr)
+                tinew = (1.0 + np.sqrt(1.0 + 4.0*ti*ti))/2.0
+                r = qnew + (ti - 1.0)/tinew*(qnew - q)
+                q = qnew
+                ti = tinew
+            xnew = v - np.ravel(L.T.dot(q))
+        tnew = (1.0 + np.sqrt(1.0 + 4.0*t*t))/2.0
+        z = xnew + (t - 1.0)/tnew*(xnew - x)
+        x = xnew
+        t = tnew
+        if callback is not None:
+            callback(x)
+        if test.check(k, x):
+            break
+    return (x, k + 1)
+
+# ADMM with the splitting Lx = w. The x-update (M^T M + rho L^T L) x = M^T y + rho L^T (w - u) is solved inexactly with
+# cgiter conjugate gradient iterations started from the previous x. Rho is relative to ||M||^2/||L||^2.
+def admm(M, y, s2, L, alpha, x0, normM, normL, maxiter=400, tol=1e-6, every=10, rho=0.1, cgiter=5, callback=None):
+    y = np.ravel(y)
+    lam = alpha*s2
+    rho = rho*normM**2/normL**2
+    x = np.array(np.ravel(x0), dtype=np.float64)
+    Lx = np.ravel(L.dot(x))
+    w = np.copy(Lx)
+    u = np.zeros((L.shape[0],))
+    Mty = np.ravel(M.T.dot(y))
+    test = convergence(M, y, L, lam, tol, every)
+
+    def normal(v):
+        return np.ravel(M.T.dot(np.ravel(M.dot(v)))) + rho*np.ravel(L.T.dot(np.ravel(L.dot(v))))
+
+    k = 0
+    for k in range(maxiter):
+        b = Mty + rho*np.ravel(L.T.dot(w - u))
+        r = b - normal(x)
+        d = np.copy(r)
+        rr = np.dot(r, r)
+        for i in range(cgiter):
+            if (rr == 0):
+                break
+            Ad = normal(d)
+            a = rr/np.dot(d, Ad)
+            x = x + a*d
+            r = r - a*Ad
+            rrnew = np.dot(r, r)
+            d = r + rrnew/rr*d
+            rr = rrnew
+        Lx = np.ravel(L.dot(x))
+        w = soft(Lx + u, lam/rho)
+        u = u + Lx - w
+        if callback is not None:
+            callback(x)
+        if test.check(k, x):
+            break
+    return (x, k + 1)
+
+solvers = {'fista': fista, 'admm': admm}
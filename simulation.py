@@ -0,0 +1,71 @@
+import os
+from collections import OrderedDict
+import numpy as np
+import scipy.sparse as sp
+
+# Simulation of the inverse-crime free sinograms. The noiseless sinogram of the large grid depends only on the image
+# file, its size (dimbig) and the angles (thetabig), so it is computed once per process and shared by all the instances
+# of a sweep, which then only draw their noise. The sinogram is resampled to the rays and angles of the reconstruction
+# grid with a sparse bilinear interpolation matrix, which is also cached.
+
+# The last maxcached sinograms and interpolation matrices.
+sinogramcache = OrderedDict()
+interpolationcache = OrderedDict()
+maxcached = 8
+
+def cached(cache, key, compute, maxsize=maxcached):
+    if key in cache:
+        cache.move_to_end(key)
+        return cache[key]
+    value = compute()
+    cache[key] = value
+    while (len(cache) > maxsize):
+        cache.popitem(last=False)
+    return value
+
+# Key of an image file, which changes when the file is modified.
+def filekey(filename):
+    st = os.stat(filename)
+    return (os.path.abspath(filename), st.st_mtime_ns, st.st_size)
+
+# Noiseless sinogram of the large grid (rows are the rays, columns the angles). Simulate is called with no arguments
+# if the sinogram is not in the cache. The returned array is read-only, since it's shared.
+def noiselesssinogram(filename, dimbig, thetabig, simulate):
+    key = filekey(filename) + (int(dimbig), np.ascontiguousarray(thetabig, dtype=np.float64).tobytes())
+
+    def compute():
+        s = np.array(simulate(), dtype=np.float64)
+        s.setflags(write=False)
+        return s
+
+    return cached(sinogramcache, key, compute)
+
+# Indices and weights of the linear interpolation from the increasing grid to the points. Points outside the grid get
+# the value of the nearest end, as in the evaluation of RectBivariateSpline.
+def linearweights(grid, points):
+    i = np.clip(np.searchsorted(grid, points, side='right') - 1, 0, grid.shape[0] - 2)
+    t = np.clip((points - grid[i])/(grid[i + 1] - grid[i]), 0.0, 1.0)
+    return (i, t)
+
+# Sparse matrix of the bilinear interpolation of a sinogram on the grid (x, y) to the grid (xi, yi), both sinograms
+# vectorized in row-major order. The grids must be increasing, as in RectBivariateSpline with kx=ky=1.
+def interpolationmatrix(x, y, xi, yi):
+    x = np.ascontiguousarray(x, dtype=np.float64)
+    y = np.ascontiguousarray(y, dtype=np.float64)
+    xi = np.ascontiguousarray(xi, dtype=np.float64)
+    yi = np.ascontiguousarray(yi, dtype=np.float64)
+    key = (x.tobytes(), y.tobytes(), xi.tobytes(), yi.tobytes())
+
+    def compute():
+        (ix, tx) = linearweights(x, xi)
+        (iy, ty) = linearweights(y, yi)
+        rows = np.arange(xi.shape[0]*yi.shape[0])
+        (IX, IY) = np.meshgrid(ix, iy, indexing='ij')
+        (TX, TY) = np.meshgrid(tx, ty, indexing='ij')
+        (IX, IY, TX, TY) = (np.ravel(IX), np.ravel(IY), np.ravel(TX), np.ravel(TY))
+        n = y.shape[0]
+        cols = np.concatenate((IX*n + IY, IX*n + IY + 1, (IX + 1)*n + IY, (IX + 1)*n + IY + 1))
+        vals = np.concatenate(((1 - TX)*(1 - TY), (1 - TX)*TY, TX*(1 - TY), TX*TY))
+        return sp.csr_matrix((vals, (np.tile(rows, 4), cols)), shape=(rows.shape[0], x.shape[0]*n))
+
+    return cached(interpolationcache, key, compute)
@@ -0,0 +1,14 @@
+from matrices cimport linearoperator
+
+# Sparse matrix which keeps both CSC and CSR copies, so that both the product and the transposed product
+# are row-parallel without write conflicts.
+cdef class sparseoperator(linearoperator):
+    cdef public object csc
+    cdef public object csr
+    cdef int[::1] cscptr
+    cdef int[::1] cscindices
+    cdef double[::1] cscdata
+    cdef int[::1] csrptr
+    cdef int[::1] csrindices
+    cdef double[::1] csrdata
+    cdef int maxcol
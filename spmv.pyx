@@ -0,0 +1,126 @@
+import numpy as np
+cimport numpy as np
+cimport cython
+import scipy.sparse as sp
+from cython.parallel import prange
+from scipy.sparse import csr_matrix,csc_matrix
+from matrices cimport linearoperator
+
+# OpenMP sparse matrix-vector products.
+# Scipy's products are single threaded and the transposed product of a CSC matrix is done by converting it to CSR on every call.
+# Sparseoperator keeps the matrix in both CSC and CSR formats: the product is a parallel loop over the rows of the CSR copy
+# and the transposed product a parallel loop over the rows of the CSC copy (the columns of the matrix). Every thread writes only its
+# own rows of the result, so no atomics or per-thread result vectors are needed. The price is that the matrix is stored twice.
+# The weights must be 64-bit floats and the indices must fit 32-bit integers. A matrix of 32-bit weights (e.g.
+# radonmatrix(dtype=np.float32)) is rejected rather than copied to 64 bits, since the copy would cost more memory than the
+# 64-bit matrix itself.
+cdef class sparseoperator(linearoperator):
+
+    # If the CSR copy is already available (e.g. in shared memory or in the operator cache), it can be given as csr and it's
+    # used as it is. Otherwise it's converted from A, which costs a transpose of the matrix and its memory.
+    def __init__(self, A, Nthreads=4, csr=None):
+        if (np.issubdtype(A.dtype, np.floating) and A.dtype.itemsize < 8):
+            raise Exception('Sparseoperator needs 64-bit weights, but the matrix has ' + str(A.dtype) + ' weights.')
+        A = csc_matrix(A, dtype=np.float64)
+        if (A.nnz > 2147483647 or A.shape[0] > 2147483647):
+            raise Exception('Sparseoperator supports at most 2^31-1 nonzeros and rows. Use the matrix-free operator instead.')
+        A.indptr = A.indptr.astype(np.intc, copy=False)
+        A.indices = A.indices.astype(np.intc, copy=False)
+        if not A.has_sorted_indices:
+            A.sort_indices()
+        if csr is None:
+            B = csr_matrix(A)
+        else:
+            B = csr_matrix(csr, dtype=np.float64)
+            if (B.shape != A.shape or B.nnz != A.nnz):
+                raise Exception('CSR copy does not match the matrix.')
+        B.indptr = B.indptr.astype(np.intc, copy=False)
+        B.indices = B.indices.astype(np.intc, copy=False)
+        self.csc = A
+        self.csr = B
+        self.cscptr = A.indptr
+        self.cscindices = A.indices
+        self.cscdata = A.data
+        self.csrptr = B.indptr
+        self.csrindices = B.indices
+        self.csrdata = B.data
+        self.shape = (int(A.shape[0]), int(A.shape[1]))
+        self.Nthreads = Nthreads
+        if (A.shape[1] > 0):
+            self.maxcol = int(np.max(np.diff(A.indptr)))
+        else:
+            self.maxcol = 0
+
+    def __reduce__(self):
+        return (sparseoperator, (self.csc, self.Nthreads, self.csr))
+
+    # Number of nonzeros.
+    @property
+    def nnz(self):
+        return self.csc.nnz
+
+    cdef int maxcolumn(self):
+        return max(self.maxcol, 1)
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef int column(self, int j, int* rows, double* vals) noexcept nogil:
+        cdef int k
+        cdef int start = self.cscptr[j]
+        cdef int stop = self.cscptr[j+1]
+        for k in range(start, stop):
+            rows[k-start] = self.cscindices[k]
+            vals[k-start] = self.cscdata[k]
+        return stop - start
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def matvec(self, x):
+        cdef double [:, ::1] xv = x
+        cdef int K = xv.shape[1]
+        cdef int nrows = self.shape[0]
+        cdef int [::1] ptr = self.csrptr
+        cdef int [::1] ind = self.csrindices
+        cdef double [::1] data = self.csrdata
+        out = np.zeros((nrows, K))
+        cdef double [:, ::1] outv = out
+        cdef int i, j, k
+        cdef double s
+        if (K == 1):
+            for i in prange(nrows, nogil=True, num_threads=self.Nthreads):
+                s = 0.0
+                for j in range(ptr[i], ptr[i+1]):
+                    s = s + data[j]*xv[ind[j], 0]
+                outv[i, 0] = s
+        else:
+            for i in prange(nrows, nogil=True, num_threads=self.Nthreads):
+                for j in range(ptr[i], ptr[i+1]):
+                    for k in range(K):
+                        outv[i, k] += data[j]*xv[ind[j], k]
+        return out
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def rmatvec(self, y):
+        cdef double [:, ::1] yv = y
+        cdef int K = yv.shape[1]
+        cdef int ncols = self.shape[1]
+        cdef int [::1] ptr = self.cscptr
+        cdef int [::1] ind = self.cscindices
+        cdef double [::1] data = self.cscdata
+        out = np.zeros((ncols, K))
+        cdef double [:, ::1] outv = out
+        cdef int i, j, k
+        cdef double s
+        if (K == 1):
+            for i in prange(ncols, nogil=True, num_threads=self.Nthreads):
+                s = 0.0
+                for j in range(ptr[i], ptr[i+1]):
+                    s = s + data[j]*yv[ind[j], 0]
+                outv[i, 0] = s
+        else:
+            for i in prange(ncols, nogil=True, num_threads=self.Nthreads):
+                for j in range(ptr[i], ptr[i+1]):
+                    for k in range(K):
+                        outv[i, k] += data[j]*yv[ind[j], k]
+        return out
@@ -0,0 +1,9 @@
+import os
+from chainio import uniquename
+
+# Names that are taken get a suffix, and the directory is created.
+def test_uniquename(tmp_path):
+    base = os.path.join(str(tmp_path), 'run', 'chain')
+    names = [uniquename(base, '.hdf5') for k in range(3)]
+    assert names == [base + '.hdf5', base + '-1.hdf5', base + '-2.hdf5']
+    assert all(os.path.exists(name) for name in names)
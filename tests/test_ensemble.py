@@ -0,0 +1,30 @@
+import numpy as np
+import scipy.sparse as sp
+import ensemble
+from spmv import sparseoperator
+
+# The blocks of an attached operator are opened once by name and closed only after the operator and its views are gone.
+def test_attach_and_detach():
+    A = sp.random(50, 40, density=0.1, format='csc', random_state=1)
+    blocks = []
+    try:
+        handle = ensemble.shareoperator(sparseoperator(A, Nthreads=1), blocks)
+        B = ensemble.attachoperator(handle)
+        C = ensemble.attachoperator(handle)
+        assert len(ensemble.attached) == 6
+        x = np.ones((40,))
+        ensemble.detachall()
+        assert len(ensemble.attached) == 6
+        assert np.allclose(np.ravel(B.dot(x)), A.dot(x))
+        v = B.csc.data[3:]
+        B = None
+        C = None
+        ensemble.detachall()
+        assert len(ensemble.attached) == 1
+        assert np.allclose(v, A.data[3:])
+        v = None
+        ensemble.detachall()
+        assert len(ensemble.attached) == 0
+    finally:
+        ensemble.detachall()
+        ensemble.releaseshared(blocks)
@@ -0,0 +1,18 @@
+import numpy as np
+import pytest
+from gaussian import tikhonovsystem
+from matrices import radonmatrix, differenceoperator
+
+# The preconditioned conjugate gradients reach the same MAP estimate with every preconditioner.
+@pytest.mark.parametrize('alpha', [1.0, 1e4])
+def test_preconditioners(alpha):
+    N = 16
+    M = radonmatrix(N, np.linspace(0.0, np.pi, 10, endpoint=False))
+    system = tikhonovsystem(M, differenceoperator(N, 'anisotropic'), 0.01, alpha)
+    b = system.rhs(M.dot(np.random.RandomState(0).rand(N*N)))
+    solutions = [system.solve(b, 'cg', kind, maxiter=2000, tol=1e-10)[0] for kind in (None, 'jacobi', 'diagsplu')]
+    for x in solutions:
+        assert np.linalg.norm(b - system.matvec(x)) <= 1e-9*np.linalg.norm(b)
+        assert np.allclose(x, solutions[0], rtol=0, atol=1e-6*np.max(np.abs(solutions[0])))
+    with pytest.raises(Exception):
+        system.preconditioner('ic')
@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+import scipy.sparse as sp
+import cyt
+from cyt import argumentspack, blockvalgrad, blockpriors
+from matrices import radonmatrix, differenceoperator, waveletoperator
+
+N = 16
+
+# Posterior of a small geometry with the matrices, which the MAP estimates of tomography set for each prior.
+def posterior(prior):
+    theta = np.linspace(0, np.pi, 9, endpoint=False)
+    M = radonmatrix(N, theta, Nthreads=2)/N
+    rng = np.random.RandomState(3)
+    y = M.dot(rng.rand(N*N)).reshape((-1, 1)) + 0.01*rng.randn(M.shape[0], 1)
+    Q = argumentspack(M=M, y=y, b=0.01, s2=1e-3, a=0.5)
+    empty = sp.csc_matrix((1, N*N))
+    if (prior == 'tikhonov'):
+        (Q.Lx, Q.Ly) = (differenceoperator(N, 'anisotropic', order=2), empty)
+    elif (prior == 'tv' or prior == 'cauchy'):
+        Q.Lx = differenceoperator(N, 'anisotropic')
+        Q.Ly = empty
+        if (prior == 'cauchy'):
+            Q.a = 0.05
+    elif (prior == 'isocauchy'):
+        (Q.Lx, Q.Ly) = (differenceoperator(N, 'isotropicx'), differenceoperator(N, 'isotropicy'))
+        Q.boun = differenceoperator(N, 'boundary')
+        (Q.a, Q.boundarya) = (0.05, 0.05)
+    else:
+        g = np.array([1.0, 1.0])/np.sqrt(2)
+        Q.Lx = waveletoperator(N, 2, g, np.array([-1.0, 1.0])/np.sqrt(2), Nthreads=2)
+        Q.Ly = empty
+    return Q
+
+# The log-posteriors of the original implementation. The Besov prior MAP estimate used tfun_tv with the empty Ly,
+# so its value includes the constant -a*sqrt(b) of that one row.
+references = {'tikhonov': cyt.tfun_tikhonov, 'tv': cyt.tfun_tv, 'cauchy': cyt.tfun_cauchy, 'isocauchy': cyt.tfun_isocauchy,
+              'wavelet': cyt.tfun_tv}
+kernels = {'tikhonov': cyt.tikhonov_valgrad, 'tv': cyt.tv_valgrad, 'cauchy': cyt.cauchy_valgrad,
+           'isocauchy': cyt.isocauchy_valgrad, 'wavelet': cyt.wavelet_valgrad}
+
+@pytest.mark.parametrize('prior', sorted(kernels))
+def test_value_matches_original(prior):
+    Q = posterior(prior)
+    x = 1 + 0.1*np.random.RandomState(0).randn(N*N)
+    (v, _) = kernels[prior](x, Q)
+    assert np.isclose(v, np.ravel(references[prior](x, Q))[0], rtol=1e-12, atol=1e-9)
+
+# The gradient is compared to central differences along random directions.
+@pytest.mark.parametrize('prior', sorted(kernels))
+def test_gradient_finite_differences(prior):
+    Q = posterior(prior)
+    rng = np.random.RandomState(1)
+    x = 1 + 0.1*rng.randn(N*N)
+    (v, gr) = kernels[prior](x, Q)
+    gr = np.copy(gr)
+    h = 1e-6
+    for k in range(5):
+        d = rng.randn(N*N)
+        fd = (kernels[prior](x + h*d, Q)[0] - kernels[prior](x - h*d, Q)[0])/(2*h)
+        assert np.isclose(np.dot(gr, d), fd, rtol=1e-5, atol=1e-6*np.linalg.norm(gr))
+
+@pytest.mark.parametrize('prior', sorted(kernels))
+def test_block_kernel_matches_fused(prior):
+    Q = posterior(prior)
+    X = 1 + 0.1*np.random.RandomState(2).randn(N*N, 3)
+    Q.y = np.tile(Q.y, (1, 3))
+    (values, grads) = blockvalgrad(X, Q, blockpriors[prior])
+    for k in range(3):
+        Qk = posterior(prior)
+        (v, gr) = kernels[prior](X[:, k], Qk)
+        assert np.isclose(values[k], v, rtol=1e-12)
+        assert np.allclose(grads[:, k], gr, rtol=1e-10, atol=1e-8)
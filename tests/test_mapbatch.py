@@ -0,0 +1,31 @@
+import os
+import numpy as np
+import pytest
+from main import tomography
+
+image = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'shepp.png')
+
+# Sinograms of four different slices: the phantom with noise, scaled and flipped.
+def stack(t):
+    rng = np.random.RandomState(3)
+    s = np.reshape(t.lines, t.sgram.shape, order=t.lineorder)
+    slices = [s, 0.5*s, s[::-1, :], 2.0*s]
+    return np.stack([v + 0.02*np.max(v)*rng.randn(*v.shape) for v in slices])
+
+# A slice's estimate must not depend on the slices batched with it, and every slice must stop on its own.
+@pytest.mark.parametrize('prior, alpha', [('tikhonov', 5.0), ('tv', 5.0), ('cauchy', 0.05)])
+def test_map_batch_slices_independent(tmp_path, monkeypatch, prior, alpha):
+    monkeypatch.chdir(tmp_path)
+    np.random.seed(0)
+    t = tomography(image, 24, 12, 0.02, num_threads=1)
+    sinograms = stack(t)
+    np.random.seed(1)
+    alone = []
+    for k in range(len(sinograms)):
+        alone.append(t.map_batch(prior, sinograms[k:k+1], alpha, batchsize=1, warmstart=False, lhdev=0.02, retim=False))
+    np.random.seed(1)
+    res = t.map_batch(prior, sinograms, alpha, batchsize=4, warmstart=False, lhdev=0.02, retim=False)
+    for k in range(len(sinograms)):
+        assert np.allclose(res.result[k], alone[k].result[0], rtol=0, atol=1e-10)
+        assert res.iterations[k] == alone[k].iterations[0]
+    assert len(set(res.iterations)) > 1
@@ -0,0 +1,21 @@
+import os
+import numpy as np
+import pytest
+from main import tomography
+
+image = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'shepp.png')
+
+def chain(method, threads, **kwargs):
+    np.random.seed(0)
+    t = tomography(image, 24, 12, 0.02, num_threads=threads)
+    res = getattr(t, method)(M=30, Madapt=15, thinning=1, retim=False, interstep=1, seed=1234, stream=1, **kwargs)
+    return np.asarray(res.chain)
+
+# The MwG chains of a fixed seed and stream must not depend on the number of threads.
+@pytest.mark.parametrize('method, kwargs', [('mwg_tv', {'alpha': 10.0}), ('mwg_cauchy', {'alpha': 0.05, 'isotropic': False}),
+                                            ('mwg_cauchy', {'alpha': 0.05, 'isotropic': True})])
+def test_mwg_chain_independent_of_threads(tmp_path, monkeypatch, method, kwargs):
+    monkeypatch.chdir(tmp_path)
+    single = chain(method, 1, **kwargs)
+    for threads in (2, 3):
+        assert np.array_equal(chain(method, threads, **kwargs), single)
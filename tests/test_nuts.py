@@ -0,0 +1,124 @@
+import numpy as np
+import pytest
+import cyt
+from test_gradients import posterior
+
+# Transcription of the original recursive NUTS (leapfrog, initialeps, buildtree and hmc without the intermediate files).
+def leapfrog(theta, r, epsilon, Q, currgrad):
+    r = r + epsilon*0.5*currgrad
+    theta = theta + epsilon*r
+    currdensity = Q.logdensity(theta, Q)
+    currgrad = Q.gradi(theta, Q)
+    r = r + epsilon*0.5*currgrad
+    return (theta, r, currdensity, currgrad)
+
+def initialeps(theta, Q, currdensity, currgrad):
+    def totalenergy(r, cd):
+        return (cd - 0.5*np.dot(r.T, r))
+    eps = 1.0
+    r = np.random.randn(theta.shape[0], 1)
+    (theta2, r2, currdensity2, currgrad2) = leapfrog(theta, r, eps, Q, currgrad)
+    a = 2.0*(np.exp(totalenergy(r2, currdensity2) - totalenergy(r, currdensity)) > 0.5) - 1.0
+    while a*(totalenergy(r2, currdensity2) - totalenergy(r, currdensity)) > -a*np.log(2):
+        eps = 2.0**(a)*eps
+        (theta2, r2, currdensity2, currgrad2) = leapfrog(theta, r, eps, Q, currgrad)
+    return eps
+
+def buildtree(theta, r, logu, v, j, epsilon, theta0, r0, Q, initialdr, currgrad):
+    if (j == 0):
+        thetatilde, rtilde, currdensitytilde, currgradtilde = leapfrog(theta, r, v*epsilon, Q, currgrad)
+        diff = np.min(np.array([np.exp(currdensitytilde - 0.5*np.dot(rtilde.T, rtilde) - initialdr), 1]))
+        ntilde = int(logu <= (currdensitytilde - 0.5*np.dot(rtilde.T, rtilde)))
+        stilde = int(logu < (1000.0 + currdensitytilde - 0.5*np.dot(rtilde.T, rtilde)))
+        return thetatilde, rtilde, thetatilde, rtilde, thetatilde, ntilde, stilde, diff, 1, currdensitytilde, currgradtilde, currgradtilde, currgradtilde
+    thetaminus, rminus, thetaplus, rplus, thetatilde, ntilde, stilde, alfatilde, nalfatilde, currdensitytilde, currgradtilde, gradplus, gradminus = buildtree(theta, r, logu, v, j - 1, epsilon, theta0, r0, Q, initialdr, currgrad)
+    if (stilde == 1):
+        if (v == -1):
+            thetaminus, rminus, _, _, thetatildetilde, ntildetilde, stildetilde, alfatildetilde, nalfatildetilde, currdensitytildetilde, currgradtildetilde, _, gradminus = buildtree(
+                thetaminus, rminus, logu, v, j - 1, epsilon, theta0, r0, Q, initialdr, gradminus)
+        else:
+            _, _, thetaplus, rplus, thetatildetilde, ntildetilde, stildetilde, alfatildetilde, nalfatildetilde, currdensitytildetilde, currgradtildetilde, gradplus, _ = buildtree(
+                thetaplus, rplus, logu, v, j - 1, epsilon, theta0, r0, Q, initialdr, gradplus)
+        if (np.random.rand() <= ntildetilde/np.max(np.array([ntilde + ntildetilde, 1]))):
+            thetatilde = thetatildetilde
+            currdensitytilde = currdensitytildetilde
+            currgradtilde = currgradtildetilde
+        alfatilde = alfatilde + alfatildetilde
+        nalfatilde = nalfatilde + nalfatildetilde
+        stilde = stildetilde*(float(np.dot((thetaplus - thetaminus).T, rminus) >= 0)*(np.dot((thetaplus - thetaminus).T, rplus) >= 0))
+        ntilde = ntilde + ntildetilde
+    return thetaminus, rminus, thetaplus, rplus, thetatilde, ntilde, stilde, alfatilde, nalfatilde, currdensitytilde, currgradtilde, gradplus, gradminus
+
+def recursivehmc(M, theta0, Q, Madapt, de=0.6, gamma=0.05, t0=10.0, kappa=0.75):
+    theta0 = np.reshape(theta0, (-1, 1))
+    dim = theta0.shape[0]
+    theta = np.zeros((dim, M + 1))
+    theta[:, 0] = np.ravel(theta0)
+    currdensity = float(Q.logdensity(theta0, Q))
+    currgrad = Q.gradi(theta0, Q)
+    epsilon = initialeps(theta0, Q, currdensity, currgrad)
+    epsilonhat = 1.0
+    myy = np.log(10*epsilon)
+    Hhat = 0.0
+    for i in range(1, M + 1):
+        r0 = np.random.randn(dim, 1)
+        logu = float(currdensity - 0.5*np.dot(r0.T, r0)) + np.log(np.random.rand())
+        initialdr = float(currdensity - 0.5*np.dot(r0.T, r0))
+        (thetaminus, thetaplus, rminus, rplus, gradminus, gradplus) = (theta0, theta0, r0, r0, currgrad, currgrad)
+        (j, n, s) = (0, 1.0, 1.0)
+        theta[:, i] = np.ravel(theta0)
+        while (s == 1):
+            vj = np.random.choice(np.array([-1, 1]))
+            if (vj == -1):
+                thetaminus, rminus, _, _, thetatilde, ntilde, stilde, alfa, nalfa, currdensitytilde, currgradtilde, _, gradminus = buildtree(thetaminus, rminus, logu, vj, j, epsilon, theta0, r0, Q, initialdr, gradminus)
+            else:
+                _, _, thetaplus, rplus, thetatilde, ntilde, stilde, alfa, nalfa, currdensitytilde, currgradtilde, gradplus, _ = buildtree(thetaplus, rplus, logu, vj, j, epsilon, theta0, r0, Q, initialdr, gradplus)
+            if (stilde == 1):
+                if (np.random.rand() < ntilde/n):
+                    theta[:, i] = np.ravel(thetatilde)
+                    theta0 = thetatilde
+                    currdensity = currdensitytilde
+                    currgrad = currgradtilde
+            n = n + ntilde
+            s = stilde*(float(np.dot((thetaplus - thetaminus).T, rminus) >= 0)*(np.dot((thetaplus - thetaminus).T, rplus) >= 0))
+            j = j + 1
+        if (i <= Madapt):
+            Hhat = (1.0 - 1.0/(i + t0))*Hhat + 1.0/(i + t0)*(de - alfa/nalfa)
+            epsilon = np.exp(myy - np.sqrt(i)/gamma*Hhat)
+            epsilonhat = np.exp(i**(-kappa)*np.log(epsilon) + (1.0 - i**(-kappa))*np.log(epsilonhat))
+        else:
+            epsilon = epsilonhat
+    return theta
+
+densities = {'tv': (cyt.tfun_tv, cyt.tv_grad), 'cauchy': (cyt.tfun_cauchy, cyt.cauchy_grad),
+             'tikhonov': (cyt.tfun_tikhonov, cyt.tikhonov_grad)}
+
+def setup(prior):
+    Q = posterior(prior)
+    (Q.logdensity, Q.gradi) = densities[prior]
+    x0 = 1 + 0.05*np.random.RandomState(5).randn(Q.M.shape[1], 1)
+    return Q, x0
+
+def iterativehmc(Q, x0, fused):
+    np.random.seed(42)
+    (_, chain) = cyt.hmc(12, x0, Q, 6, de=0.65, istep=1, fused=fused)
+    return np.asarray(chain)
+
+# With fused=False the iterative NUTS calls Q.logdensity and Q.gradi exactly as the recursive one, and it draws the
+# random numbers in the same order, so the chains of a fixed seed are identical.
+@pytest.mark.parametrize('prior', sorted(densities))
+def test_iterative_nuts_matches_recursive(prior):
+    (Q, x0) = setup(prior)
+    np.random.seed(42)
+    old = recursivehmc(12, x0, Q, 6, de=0.65)
+    assert np.array_equal(iterativehmc(Q, x0, False), old)
+
+# The fused kernel evaluates the same log-density and gradient with other summation orders, so its chain may differ from
+# the recursive one by rounding. With one thread the reductions have a fixed order and the chains agree.
+@pytest.mark.parametrize('prior', sorted(densities))
+def test_fused_nuts_matches_recursive(prior):
+    (Q, x0) = setup(prior)
+    Q.Nthreads = 1
+    np.random.seed(42)
+    old = recursivehmc(12, x0, Q, 6, de=0.65)
+    assert np.allclose(iterativehmc(Q, x0, True), old, rtol=0, atol=1e-10)
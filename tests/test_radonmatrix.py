@@ -0,0 +1,104 @@
+import math
+import numpy as np
+import pytest
+import scipy.sparse as sp
+from matrices import radonmatrix, radonprojector
+
+# Transcription of the original radonmatrix, which looped over every ray and pixel and collected the nonzeros as COO
+# triplets. Returns the CSC matrix and a mask of the entries, which are at a tie of gs (see below).
+def oldradonmatrix(N, theta):
+    T = theta.shape[0]
+    R = math.ceil(math.sqrt(2)*N)
+    xmin = -(N - 1.0)/2.0
+    dp = 2.0*math.sqrt(2)*abs(xmin)/(R - 1.0)
+    pmin = -(R - 1.0)/2.0*dp
+    dt = 0 if T == 1 else theta[1] - theta[0]
+    (n, m) = np.divmod(np.arange(N*N), N)
+    (x, y) = (xmin + m*1.0, xmin + n*1.0)
+    rows, cols, vals, ties = [], [], [], []
+    for r in range(R):
+        for t in range(T):
+            tt = -(theta[0] + t*dt)
+            p = np.abs(2.0*(pmin + r*dp - x*math.cos(tt) - y*math.sin(tt))/1.0)
+            f = math.fmod(math.fmod(tt, math.pi/2) + math.pi/2, math.pi/2)
+            if (f >= math.pi/4):
+                f = math.pi/2 - f
+            with np.errstate(divide='ignore', invalid='ignore'):
+                x1m = p/math.cos(f) + math.tan(f)
+                x1 = p/math.cos(f) - math.tan(f)
+                y1 = p/math.sin(f) - 1.0/math.tan(f) if f != 0 else np.full_like(p, -np.inf)
+                g = np.where((x1 < 1.0) & (x1m < 1.0), np.sqrt(4.0 + (x1 - x1m)**2),
+                             np.where((x1 < 1.0) & (x1m > 1.0), np.sqrt((1.0 - x1)**2 + (1.0 - y1)**2), 0.0))
+            g[p > math.sqrt(2)] = 0.0
+            ray = 1.0/2.0*g
+            tie = (np.abs(x1m - 1.0) < 1e-9) | (np.abs(x1 - 1.0) < 1e-9) | (np.abs(p - math.sqrt(2)) < 1e-9)
+            keep = (ray > 0.0) | tie
+            rows.append(np.full(np.count_nonzero(keep), r*T + t))
+            cols.append(np.nonzero(keep)[0])
+            vals.append(ray[keep])
+            ties.append(tie[keep])
+    (rows, cols) = (np.concatenate(rows), np.concatenate(cols))
+    A = sp.csc_matrix((np.concatenate(vals), (rows, cols)), shape=(R*T, N*N))
+    A.eliminate_zeros()
+    tie = sp.csc_matrix((np.concatenate(ties).astype(np.float64), (rows, cols)), shape=(R*T, N*N))
+    return A, tie.toarray() > 0
+
+# Geometries with angles over the half circle, the full circle (the multiples of 90 degrees hit exactly), an asymmetric
+# range around zero, both ends included and odd sizes.
+geometries = [(16, np.linspace(0, np.pi, 10, endpoint=False)),
+              (17, np.linspace(0, np.pi, 12, endpoint=False)),
+              (16, np.radians(np.arange(0, 360, 45.0))),
+              (16, np.radians(np.linspace(-45, 45, 7))),
+              (12, np.radians(np.linspace(-45, 45, 7))),
+              (20, np.linspace(0, np.pi, 20)),
+              (9, np.radians(np.array([10.0, 100.0, 190.0])))]
+
+# The new construction must give the same operator as the old one. The only exceptions are the ties of gs, where the
+# branch is decided by rounding, and the distance of a pixel from a ray is computed in another order of operations
+# (the compiled old construction itself keeps or drops these entries depending on the compiler's floating point contraction):
+# - x1m == 1.0, the ray passes exactly through a pixel corner. E.g. 12x12 at -45..45 degrees with 7 angles, where the old
+#   construction keeps two weights 2/sqrt(3) = 1.1547 and the new one drops them, since gs returns its -9.0 fallback for
+#   an exact tie. Similarly the full circle in steps of 45 degrees drops weights sqrt(2) at the 135 and 315 degree rays.
+# - x1 == 1.0 and the edge of the footprint |p| == sqrt(2), where the weight is zero or of the order 1e-16.
+@pytest.mark.parametrize('N, theta', geometries)
+def test_radonmatrix_matches_old_construction(N, theta):
+    B, tie = oldradonmatrix(N, theta)
+    A = radonmatrix(N, theta, Nthreads=2)
+    assert A.shape == B.shape
+    (Ad, Bd) = (A.toarray(), B.toarray())
+    differ = (Ad != 0) != (Bd != 0)
+    assert not np.any(differ & ~tie)
+    assert np.max(np.abs(Ad - Bd)[~differ]) < 1e-12
+    # Every column is sorted by row, as scipy's CSC format would give.
+    assert A.has_sorted_indices
+
+def test_radonmatrix_tie_at_asymmetric_range():
+    theta = np.radians(np.linspace(-45, 45, 7))
+    B, tie = oldradonmatrix(12, theta)
+    A = radonmatrix(12, theta, Nthreads=1)
+    dropped = ((B.toarray() != 0) & (A.toarray() == 0))
+    assert np.all(tie[dropped])
+    assert np.allclose(B.toarray()[dropped & (B.toarray() > 1e-12)], 2/np.sqrt(3))
+
+@pytest.mark.parametrize('N, theta', geometries[0:3])
+def test_radonmatrix_threads_and_projector(N, theta):
+    A = radonmatrix(N, theta, Nthreads=1)
+    for th in (2, 3):
+        assert (radonmatrix(N, theta, Nthreads=th) != A).nnz == 0
+    P = radonprojector(N, theta, 1.0, 2)
+    x = np.random.RandomState(0).rand(N*N)
+    y = np.random.RandomState(1).rand(A.shape[0])
+    assert np.allclose(P.dot(x), A.dot(x), atol=1e-12)
+    assert np.allclose(P.T.dot(y), A.T.dot(y), atol=1e-12)
+
+def test_radonmatrix_dtype_and_index64():
+    theta = np.linspace(0, np.pi, 6, endpoint=False)
+    A = radonmatrix(16, theta, Nthreads=2)
+    B = radonmatrix(16, theta, Nthreads=2, dtype=np.float32, index64=True)
+    assert B.data.dtype == np.float32 and B.indices.dtype == np.int64 and B.indptr.dtype == np.int64
+    assert np.array_equal(A.indices, B.indices) and np.array_equal(A.indptr, B.indptr)
+    assert np.array_equal(A.data.astype(np.float32), B.data)
+    # Sparseoperator does not silently copy the 32-bit weights to 64 bits.
+    from spmv import sparseoperator
+    with pytest.raises(Exception):
+        sparseoperator(B)
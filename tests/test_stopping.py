@@ -0,0 +1,43 @@
+import numpy as np
+from cyt import posteriorstats, stoppingrule
+
+# Feeds samples of the given generator to the statistics and the rule. Returns the iteration at which the rule fired.
+def run(rule, sample, dim=200, n=20000):
+    stats = posteriorstats(dim, quantiles=())
+    rule.begin()
+    for i in range(1, n+1):
+        stats.update(sample(i))
+        if rule.check(stats, i):
+            return i
+    return None
+
+# Independent samples, except for a few pixels that hardly move (a random walk with tiny steps).
+def sampler(stuck):
+    rng = np.random.RandomState(0)
+    walk = np.zeros((stuck,))
+
+    def sample(i):
+        x = rng.randn(200)
+        walk[:] = walk + 0.01*rng.randn(stuck)
+        x[0:stuck] = walk
+        return x
+    return sample
+
+def test_stopping_fires_on_independent_samples():
+    rule = stoppingrule(miness=500, maxrhat=1.05, every=100)
+    assert run(rule, sampler(0)) is not None
+    assert rule.reason == 'converged'
+
+# A few stuck pixels block the minimum, but not the 1% quantile, and they can be masked out.
+def test_stopping_quantile_and_mask():
+    assert run(stoppingrule(miness=500, maxrhat=1.05, every=100, quantile=0.0), sampler(2)) is None
+    assert run(stoppingrule(miness=500, maxrhat=1.05, every=100), sampler(1)) is not None
+    mask = np.ones((200,), dtype=bool)
+    mask[0:5] = False
+    assert run(stoppingrule(miness=500, maxrhat=1.05, every=100, quantile=0.0, mask=mask), sampler(5)) is not None
+
+# The time budget is checked at every iteration, not only every `every` iterations.
+def test_stopping_time_every_iteration():
+    rule = stoppingrule(maxtime=0.0, every=1000)
+    assert run(rule, sampler(0)) == 1
+    assert rule.reason == 'time'
@@ -0,0 +1,77 @@
+import os
+import numpy as np
+from chainio import compressionargs
+
+# Streaming input and output of the batched reconstructions (see tomography.map_batch).
+# Readsinograms yields the sinograms of a stack one at a time, so that only the slices of the current batch are in memory.
+# Volumewriter appends the reconstructed slices to a resizable, chunked HDF5 dataset 'volume' (slices x dim x dim), one
+# chunk per slice, and flushes the file after every batch, so that a stopped run leaves the finished slices readable.
+
+# Sinograms of a stack. Source is an HDF5 file (the dataset name, slices along the first axis), a .npy file (memory mapped)
+# or a list of .mat and .npy files with one sinogram each (the variable name in the .mat files).
+def readsinograms(source, name='m'):
+    if isinstance(source, str) and source.endswith(('.h5', '.hdf5')):
+        import h5py
+        with h5py.File(source, 'r') as f:
+            data = f[name]
+            for k in range(data.shape[0]):
+                yield np.array(data[k], dtype=np.float64)
+        return
+    if isinstance(source, str):
+        source = [source]
+    for fname in source:
+        if fname.endswith('.npy'):
+            stack = np.load(fname, mmap_mode='r')
+            if (stack.ndim == 3):
+                for k in range(stack.shape[0]):
+                    yield np.array(stack[k], dtype=np.float64)
+            else:
+                yield np.array(stack, dtype=np.float64)
+        elif fname.endswith('.mat'):
+            import scipy.io
+            yield np.array(scipy.io.loadmat(fname)[name], dtype=np.float64)
+        else:
+            raise Exception('Unknown sinogram file ' + str(fname) + '.')
+
+class volumewriter:
+    def __init__(self, filename, dim, compression='lzf', dtype=np.float32):
+        import h5py
+        path = os.path.dirname(os.path.abspath(filename))
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.filename = filename
+        self.dim = dim
+        self.count = 0
+        self.file = h5py.File(filename, 'w')
+        self.dataset = self.file.create_dataset('volume', shape=(0, dim, dim), maxshape=(None, dim, dim), dtype=dtype,
+                                                chunks=(1, dim, dim), **compressionargs(compression))
+
+    # Appends the slices (k x dim x dim) to the volume.
+    def append(self, slices):
+        slices = np.reshape(slices, (-1, self.dim, self.dim))
+        self.dataset.resize((self.count + slices.shape[0], self.dim, self.dim))
+        self.dataset[self.count:self.count + slices.shape[0]] = slices
+        self.count = self.count + slices.shape[0]
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+# Groups the items of an iterable into lists of at most size items.
+def batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if (len(batch) == size):
+            yield batch
+            batch = []
+    if (len(batch) > 0):
+        yield batch